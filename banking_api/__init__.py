@@ -1,9 +1,7 @@
 """Script containing Flask app to create banking API."""
 
-from flask import Flask
+from flask import Blueprint, Flask
 from flask_restful import Api
-import os
-import markdown
 
 
 def create_app(config_filename):
@@ -13,27 +11,68 @@ def create_app(config_filename):
 
     app.config.from_pyfile(config_filename)
 
+    from banking_api.database import engine_options, configure_engine
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(
+        engine_options(app.config), **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+
     from banking_api.model import db
     db.init_app(app)
 
-    @app.route("/")
-    def index():
-        """Show API documentation on homepage."""
-        with open(os.path.dirname(app.instance_path) + '/README.md', 'r') as md_file:
+    from banking_api.metrics import init_metrics
+    with app.app_context():
+        configure_engine(db.engine, app.config)
+        init_metrics(app, db.engine)
+
+    from banking_api.cache import init_cache
+    init_cache(app)
+
+    from banking_api.transfer_queue import init_queue
+    init_queue(app)
+
+    from banking_api.sharding import init_sharding
+    init_sharding(app)
+
+    from banking_api.replica import init_replica
+    init_replica(app)
+
+    from banking_api.account_index import init_account_index
+    init_account_index(app)
 
-            content = md_file.read()
+    from banking_api.limits import init_limits
+    init_limits(app)
 
-            return markdown.markdown(content)
+    from banking_api.homepage import init_homepage
+    init_homepage(app)
 
-    from banking_api.routes import (api_bp, Customers, Accounts, Account_id,
-                                    Transactions, AccountTransactions)
+    from banking_api.routes import (Customers, Accounts, Account_id,
+                                    Transactions, TransactionsBatch, TransactionStatus,
+                                    AccountTransactions, AccountBalance,
+                                    AccountSummary, CustomerSummary, CacheStats,
+                                    ReplicaStats, AccountIndexStats,
+                                    AccountIndexVerify, Events, EventConsumers)
+    from banking_api.serializers import output_json
 
+    # a new blueprint per app, so more than one app can be created per process
+    api_bp = Blueprint('routes', 'banking_api.routes')
     api = Api(api_bp)
+    # responses are encoded with orjson when it is installed
+    api.representation('application/json')(output_json)
     api.add_resource(Customers, '/customers')
     api.add_resource(Accounts, '/accounts')
     api.add_resource(Account_id, '/account/<int:account_id>')
     api.add_resource(Transactions, '/transactions')
+    api.add_resource(TransactionsBatch, '/transactions/batch')
+    api.add_resource(TransactionStatus, '/transactions/<string:transaction_uuid>')
     api.add_resource(AccountTransactions, '/account/<int:account_id>/transactions')
+    api.add_resource(AccountBalance, '/account/<int:account_id>/balance')
+    api.add_resource(AccountSummary, '/account/<int:account_id>/summary')
+    api.add_resource(CustomerSummary, '/customers/<int:customer_id>/summary')
+    api.add_resource(CacheStats, '/cache/stats')
+    api.add_resource(ReplicaStats, '/replica/stats')
+    api.add_resource(AccountIndexStats, '/account-index/stats')
+    api.add_resource(AccountIndexVerify, '/account-index/verify')
+    api.add_resource(Events, '/events')
+    api.add_resource(EventConsumers, '/events/consumers/<string:name>')
 
     app.register_blueprint(api_bp)
 
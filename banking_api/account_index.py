@@ -0,0 +1,337 @@
+"""In-process index of account balances, for existence checks and balance reads.
+
+With ACCOUNT_INDEX = 1 every process keeps the balance in cents of every
+account in arrays of 64 bit integers instead of ORM objects or cached rows.
+While ids are dense, below DENSE_RATIO times the number of accounts plus
+CHUNK_SIZE, one array indexed by account id holds the balances, about 8 bytes
+an account.
+Otherwise, as after an import of far apart ids, the sorted ids and their
+balances are held in two arrays searched with bisect, 16 bytes an account. GET
+/account/<id> reads balances from it, and the history and balance routes and
+queued transfers check with it that an account exists, without a query.
+Accounts not in the index are looked up in the database as before.
+
+The index is loaded in a background thread when a worker starts (see
+wsgi.py), reads go to the database until it is ready. It then follows the
+ledger like the transfer limits: a read first adds the entries appended
+since the last one, by this process or any other, at most every
+ACCOUNT_INDEX_REFRESH_MS and right after a transfer of this process. So a
+process reads its own transfers at once and those of other processes after
+at most ACCOUNT_INDEX_REFRESH_MS. Accounts are never deleted, so an account
+in the index exists. An account created after loading is only added if that
+keeps the arrays bounded: in the dense array when its id is within
+DENSE_RATIO times the number of accounts, in the sorted arrays when its id is
+above all others. Other accounts are read from the database.
+
+The balances loaded are those of the account table, the ledger only has to
+hold the changes made while the process runs. Accounts added by the bulk
+importer after loading have no ledger entries, they are read from the
+database until the next restart, and ``python -m banking_api.ledger
+backfill`` must not run while the index is on. ``GET /account-index/verify``
+compares the index of the process answering with the account table.
+
+Catching up reads the entries after the last id seen, which misses none only
+where ledger ids commit in order, so the index needs SQLite, with its single
+writer, and is not supported with SHARD_URIS.
+"""
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+
+from banking_api.model import db
+
+log = logging.getLogger(__name__)
+
+# defaults used when a setting is missing from the config file
+DEFAULTS = {
+    'ACCOUNT_INDEX': False,
+    'ACCOUNT_INDEX_REFRESH_MS': 100,
+}
+
+# accounts read per query while loading and verifying
+CHUNK_SIZE = 100000
+# balance of the ids without an account
+MISSING = -2 ** 63
+# largest dense array, in ids per account, past which ids are held sorted
+DENSE_RATIO = 2
+
+LAST_ENTRY = text('SELECT MAX(id) FROM ledger_entry')
+ACCOUNT_RANGE = text('SELECT COUNT(*), MAX(id) FROM account')
+NEW_ENTRIES = text('''
+    SELECT id, account_id, amount, transaction_uuid FROM ledger_entry
+    WHERE id > :position ORDER BY id''')
+# run on the DBAPI cursor, building SQLAlchemy rows triples the time to load
+ACCOUNTS = 'SELECT id, balance FROM account ORDER BY id'
+
+
+def setting(config, name):
+    """Return an account index setting from config, or its default."""
+    return config.get(name, DEFAULTS[name])
+
+
+class AccountIndex():
+    """Balances of all accounts in cents, in arrays of 64 bit integers."""
+
+    def __init__(self, refresh=0.1):
+        """Create empty index catching up with the ledger every refresh seconds."""
+        self.refresh = refresh
+        # sorted account ids, None while balances is indexed by account id
+        self.ids = None
+        self.balances = array('q')
+        self.accounts = 0
+        self.position = 0
+        self.engine = None
+        self.ready = False
+        # balance reads served by the index and by the database
+        self.hits = 0
+        self.misses = 0
+        self.catch_ups = 0
+        self._stale = False
+        self._next_refresh = 0
+        self._lock = threading.Lock()
+        self._counters_lock = threading.Lock()
+
+    def load(self, engine, chunk_size=CHUNK_SIZE):
+        """Read every account of the database behind engine, as one snapshot."""
+        # id 0 is never an account
+        ids, balances = None, array('q', [MISSING])
+        accounts = 0
+        with engine.connect() as connection, _snapshot(connection):
+            position = connection.execute(LAST_ENTRY).scalar() or 0
+            count, last_id = connection.execute(ACCOUNT_RANGE).one()
+            if (last_id or 0) >= _dense_limit(count):
+                ids, balances = array('q'), array('q')
+            for rows in _account_chunks(connection, chunk_size):
+                first, last = rows[0][0], rows[-1][0]
+                if ids is not None:
+                    ids.extend(array('q', [account_id for account_id, _ in rows]))
+                    balances.extend(array('q', [balance for _, balance in rows]))
+                elif first == len(balances) and last - first + 1 == len(rows):
+                    # ids without gaps, the usual case
+                    balances.extend(array('q', [balance for _, balance in rows]))
+                else:
+                    _grow(balances, last)
+                    for account_id, balance in rows:
+                        balances[account_id] = balance
+                accounts += len(rows)
+
+        with self._lock:
+            self.ids = ids
+            self.balances = balances
+            self.accounts = accounts
+            self.position = position
+            self.engine = engine
+            self._next_refresh = time.monotonic() + self.refresh
+            self.ready = True
+
+    def balance(self, account_id):
+        """Return balance of an account in cents, None if it is not in the index."""
+        if not self.ready:
+            return None
+        if self._stale or time.monotonic() >= self._next_refresh:
+            self.catch_up()
+        ids, balances = self.ids, self.balances
+        slot = _slot(ids, balances, account_id) if type(account_id) is int else -1
+        with self._counters_lock:
+            if slot < 0:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return balances[slot]
+
+    def changed(self):
+        """Make the next read catch up, after a write of this process committed."""
+        self._stale = True
+
+    def catch_up(self):
+        """Add the ledger entries appended since the last catch up."""
+        with self._lock:
+            # a write committing from now on marks the index stale again
+            self._stale = False
+            self._next_refresh = time.monotonic() + self.refresh
+            with self.engine.connect() as connection:
+                self._catch_up(connection)
+            self.catch_ups += 1
+
+    def _catch_up(self, connection):
+        """Add the ledger entries connection sees after position, under the lock."""
+        rows = connection.execute(NEW_ENTRIES, {'position': self.position}).fetchall()
+        ids, balances = self.ids, self.balances
+        for entry_id, account_id, amount, transaction_uuid in rows:
+            self.position = entry_id
+            slot = _slot(ids, balances, account_id)
+            if slot >= 0:
+                balances[slot] += amount
+            elif transaction_uuid is None:
+                # the opening deposit of an account created after loading
+                self._add(account_id, amount)
+            # else an account outside the index, read from the database
+
+    def _add(self, account_id, balance):
+        """Add a new account if the arrays stay bounded, under the lock."""
+        ids, balances = self.ids, self.balances
+        if ids is None:
+            if account_id >= _dense_limit(self.accounts + 1):
+                return
+            _grow(balances, account_id)
+            balances[account_id] = balance
+        else:
+            if ids and account_id <= ids[-1]:
+                return
+            # a read finding the id must find its balance
+            balances.append(balance)
+            ids.append(account_id)
+        self.accounts += 1
+
+    def verify(self, chunk_size=CHUNK_SIZE, max_report=100):
+        """Compare the index with the account table and return what differs.
+
+        The index is caught up with the snapshot read and copied, so reads go
+        on while the copy is compared.
+        """
+        with self.engine.connect() as connection, _snapshot(connection):
+            with self._lock:
+                # the snapshot starts with this first read, no catch up can
+                # have read past it
+                self._catch_up(connection)
+                ids = None if self.ids is None else array('q', self.ids)
+                balances = array('q', self.balances)
+                position = self.position
+            checked, indexed, missing, mismatches, different = 0, 0, 0, 0, []
+            for rows in _account_chunks(connection, chunk_size):
+                for account_id, balance in rows:
+                    slot = _slot(ids, balances, account_id)
+                    if slot < 0:
+                        missing += 1
+                        continue
+                    found = balances[slot]
+                    indexed += 1
+                    if found == balance:
+                        continue
+                    mismatches += 1
+                    if len(different) < max_report:
+                        different.append({'account_id': account_id,
+                                          'index': found, 'database': balance})
+                checked += len(rows)
+        present = len(balances) - balances.count(MISSING)
+        return {'position': position, 'accounts': checked, 'indexed': indexed,
+                'not_indexed': missing, 'unknown': present - indexed,
+                'mismatches': mismatches, 'different': different}
+
+    def stats(self):
+        """Return size, memory and read counters."""
+        ids, balances = self.ids, self.balances
+        with self._counters_lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {'ready': self.ready, 'accounts': self.accounts,
+                'position': self.position, 'sorted_ids': ids is not None,
+                'bytes': (len(balances) + len(ids or ())) * balances.itemsize,
+                'hits': hits, 'misses': misses,
+                'hit_ratio': hits / lookups if lookups else None,
+                'catch_ups': self.catch_ups}
+
+
+@contextmanager
+def _snapshot(connection):
+    """Run the reads of connection in one transaction, seeing one committed state."""
+    if connection.dialect.name != 'sqlite':
+        connection.execution_options(isolation_level='REPEATABLE READ')
+    transaction = connection.begin()
+    # pysqlite only opens a transaction before the first write statement
+    if connection.dialect.name == 'sqlite' and not connection.connection.in_transaction:
+        connection.exec_driver_sql('BEGIN')
+    try:
+        yield connection
+    finally:
+        transaction.rollback()
+
+
+def _account_chunks(connection, chunk_size):
+    """Yield lists of (id, balance) of all accounts in id order, chunk_size at a time."""
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(ACCOUNTS)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        cursor.close()
+
+
+def _dense_limit(accounts):
+    """Return the first account id past the dense array of that many accounts."""
+    return DENSE_RATIO * accounts + CHUNK_SIZE
+
+
+def _slot(ids, balances, account_id):
+    """Return position of the balance of an account, -1 if it is not in the index."""
+    if ids is None:
+        if 0 < account_id < len(balances) and balances[account_id] != MISSING:
+            return account_id
+        return -1
+    slot = bisect_left(ids, account_id)
+    if slot < len(ids) and ids[slot] == account_id:
+        return slot
+    return -1
+
+
+def _grow(balances, account_id):
+    """Extend balances with missing accounts up to account_id."""
+    if account_id >= len(balances):
+        balances.extend(array('q', [MISSING]) * (account_id + 1 - len(balances)))
+
+
+def init_account_index(app):
+    """Create the empty account index of app when ACCOUNT_INDEX is on."""
+    if not setting(app.config, 'ACCOUNT_INDEX'):
+        return
+    if app.config.get('SHARD_URIS'):
+        raise ValueError('ACCOUNT_INDEX is not supported with SHARD_URIS')
+    if make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name() != 'sqlite':
+        raise ValueError('ACCOUNT_INDEX needs SQLite, where ledger ids commit in order')
+    app.extensions['account_index'] = AccountIndex(
+        setting(app.config, 'ACCOUNT_INDEX_REFRESH_MS') / 1000)
+
+
+def start_loading(app):
+    """Load the account index of app in a background thread, return it or None."""
+    index = app.extensions.get('account_index')
+    if index is None:
+        return None
+
+    def load():
+        with app.app_context():
+            try:
+                began = time.perf_counter()
+                index.load(db.engine)
+                log.info('account index of %d accounts loaded in %.1f s',
+                         index.accounts, time.perf_counter() - began)
+            except Exception:
+                log.exception('loading the account index failed, reading accounts '
+                              'from the database')
+
+    loader = threading.Thread(target=load, name='account-index-loader', daemon=True)
+    loader.start()
+    return loader
+
+
+def account_index():
+    """Return account index of current app, None when it is off."""
+    return current_app.extensions.get('account_index')
+
+
+def mark_changed():
+    """Make the account index catch up before its next read, after a commit."""
+    index = account_index()
+    if index is not None:
+        index.changed()
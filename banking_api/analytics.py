@@ -0,0 +1,358 @@
+"""Transaction analytics computed with pandas, for exports to finance.
+
+The transaction table is read once, straight from the database, in chunks
+of ``chunk_size`` rows. Each transaction is spilled, from the side of either
+account, to a temporary file per range of accounts holding about
+``rows_per_pass`` rows, and the ranges are then reduced one at a time with
+vectorized group-bys and written out, so memory does not grow with the number
+of transactions. Reports:
+
+- ``daily_volume`` amounts and transfers in and out per account and day
+- ``top_counterparties`` the ``top`` accounts each account exchanged most with
+- ``daily_balances`` end of day balance of each account, from cumulative sums
+  of its daily net flows, ending at its current balance
+- ``customer_flows`` net and gross amounts between each pair of customers,
+  added up over all ranges, so the only report held in memory as a whole
+
+Each report is written to ``<output dir>/<report>.csv.gz``::
+
+    python -m banking_api.analytics --output-dir exports
+
+Amounts are written as integer cents, in columns named ``*_cents``, which
+keeps them exact and the files quick to write. Transfers of an account to
+itself are left out of counterparties and flows. With sharding, point
+``--config`` at a configuration of one shard at a time.
+"""
+import argparse
+import contextlib
+import gzip
+import os
+import sys
+import tempfile
+import time
+
+import numpy
+import pandas
+from sqlalchemy import Integer, func, select, type_coerce
+
+from banking_api.model import db, Account, Transaction
+
+CHUNK_SIZE = 100000
+ROWS_PER_PASS = 1000000
+TOP_COUNTERPARTIES = 10
+
+# partial totals are combined once their rows add up to this many
+COMBINE_ROWS = 1000000
+
+# fast compression, the files are written once and the level hardly changes their size
+GZIP_LEVEL = 1
+
+REPORTS = ('daily_volume', 'top_counterparties', 'daily_balances', 'customer_flows')
+
+# one transaction seen from one of its accounts, as spilled to range files
+SIDE = numpy.dtype([('account_id', 'i8'), ('counterparty_id', 'i8'), ('day', 'M8[D]'),
+                    ('amount', 'i8'), ('outgoing', 'i1')])
+
+# columns in cents, their names get a _cents suffix in the files
+MONEY = ('amount_in', 'amount_out', 'sent', 'received', 'net', 'gross', 'balance')
+
+
+class Totals():
+    """Sums of columns per index value, added up chunk by chunk."""
+
+    def __init__(self, combine_rows=COMBINE_ROWS):
+        """Create totals without any rows."""
+        self.parts = []
+        self.rows = 0
+        self.combine_rows = combine_rows
+
+    def add(self, frame):
+        """Add the sums of frame to the totals."""
+        self.parts.append(frame)
+        self.rows += len(frame)
+        if self.rows >= self.combine_rows:
+            self._combine()
+            # keep adding chunks between two combines once the totals grow large
+            self.combine_rows = max(self.combine_rows, 2 * self.rows)
+
+    def _combine(self):
+        """Replace the partial totals by their sum."""
+        if len(self.parts) > 1:
+            combined = pandas.concat(self.parts)
+            self.parts = [combined.groupby(level=list(range(combined.index.nlevels)))
+                          .sum()]
+        self.rows = len(self.parts[0]) if self.parts else 0
+
+    def result(self, empty):
+        """Return the totals, sorted by index, or the frame empty if there are none."""
+        self._combine()
+        return self.parts[0].sort_index() if self.parts else empty
+
+
+def read_transactions(connection, chunk_size=CHUNK_SIZE):
+    """Yield all transactions as DataFrames of at most chunk_size rows.
+
+    Columns are account_id_from, account_id_to, amount in cents and day.
+    """
+    table = Transaction.__table__
+    # plain integers, converting every amount through the Cents type is slow
+    amount = type_coerce(table.c.amount, Integer).label('amount')
+    result = connection.execution_options(stream_results=True).execute(
+        select(table.c.account_id_from, table.c.account_id_to, amount,
+               func.substr(table.c.transaction_timestamp, 1, 10).label('day')))
+    columns = list(result.keys())
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            return
+        chunk = pandas.DataFrame.from_records(rows, columns=columns)
+        chunk['day'] = pandas.to_datetime(chunk['day'], format='%Y-%m-%d')
+        yield chunk
+
+
+def _empty_chunk():
+    """Return a chunk of transactions without rows."""
+    return pandas.DataFrame({'account_id_from': numpy.array([], dtype='int64'),
+                             'account_id_to': numpy.array([], dtype='int64'),
+                             'amount': numpy.array([], dtype='int64'),
+                             'day': numpy.array([], dtype='datetime64[ns]')})
+
+
+def read_customers(connection):
+    """Return customer ids of all accounts, indexed by account id."""
+    table = Account.__table__
+    rows = connection.execute(select(table.c.id, table.c.customer_id)).fetchall()
+    frame = pandas.DataFrame.from_records(rows, columns=['account_id', 'customer_id'],
+                                          index='account_id')
+    return frame['customer_id']
+
+
+def read_balances(connection, first, last):
+    """Return balances in cents of accounts first to last, indexed by account id."""
+    table = Account.__table__
+    rows = connection.execute(
+        select(table.c.id, type_coerce(table.c.balance, Integer))
+        .where(table.c.id.between(first, last))).fetchall()
+    frame = pandas.DataFrame.from_records(rows, columns=['account_id', 'balance'],
+                                          index='account_id')
+    return frame['balance']
+
+
+def account_ranges(connection, rows_per_pass=ROWS_PER_PASS):
+    """Return (first, last) account ids of consecutive ranges of accounts.
+
+    Ranges hold about rows_per_pass transaction rows, counting each
+    transaction once for either account.
+    """
+    n_accounts = connection.execute(select(func.count()).select_from(Account)).scalar()
+    n_rows = 2 * connection.execute(
+        select(func.count()).select_from(Transaction)).scalar()
+    per_pass = max(1, n_accounts * rows_per_pass // max(1, n_rows))
+    ids = connection.execute(select(Account.id).order_by(Account.id)).scalars().all()
+    return [(ids[i], ids[min(i + per_pass, len(ids)) - 1])
+            for i in range(0, len(ids), per_pass)]
+
+
+def sides(chunk, outgoing):
+    """Return a SIDE record per transaction of chunk, for its payer or its payee."""
+    records = numpy.empty(len(chunk), dtype=SIDE)
+    account_from = chunk['account_id_from'].to_numpy(dtype='int64')
+    account_to = chunk['account_id_to'].to_numpy(dtype='int64')
+    records['account_id'] = account_from if outgoing else account_to
+    records['counterparty_id'] = account_to if outgoing else account_from
+    records['day'] = chunk['day'].to_numpy(dtype='datetime64[D]')
+    records['amount'] = chunk['amount'].to_numpy(dtype='int64')
+    records['outgoing'] = outgoing
+    return records
+
+
+def partition(chunks, ranges, files):
+    """Append both sides of the transactions to the file of the range of their account.
+
+    Sides of accounts outside all ranges go to the range before them.
+    """
+    firsts = numpy.array([first for first, _ in ranges[1:]], dtype='int64')
+    for chunk in chunks:
+        for outgoing in (True, False):
+            records = sides(chunk, outgoing)
+            records = records[numpy.argsort(records['account_id'], kind='stable')]
+            cuts = numpy.searchsorted(records['account_id'], firsts)
+            for part, range_file in zip(numpy.split(records, cuts), files):
+                if len(part):
+                    part.tofile(range_file)
+
+
+def side_frame(records):
+    """Return SIDE records as a DataFrame of amounts and transfers in and out."""
+    outgoing = records['outgoing'].astype(bool)
+    amount = records['amount']
+    return pandas.DataFrame({
+        'account_id': records['account_id'],
+        'counterparty_id': records['counterparty_id'],
+        'day': records['day'].astype('datetime64[ns]'),
+        'amount_in': numpy.where(outgoing, 0, amount),
+        'amount_out': numpy.where(outgoing, amount, 0),
+        'transfers_in': (~outgoing).astype('int64'),
+        'transfers_out': outgoing.astype('int64'),
+    })
+
+
+def daily_volume(account_sides):
+    """Return amounts and transfers in and out per account and day."""
+    return (account_sides.drop(columns='counterparty_id')
+            .groupby(['account_id', 'day']).sum())
+
+
+def top_counterparties(account_sides, top=TOP_COUNTERPARTIES):
+    """Return the top counterparties of each account by amount exchanged."""
+    pairs = account_sides[account_sides['account_id']
+                          != account_sides['counterparty_id']]
+    totals = (pairs.drop(columns='day').groupby(['account_id', 'counterparty_id'])
+              .sum().reset_index())
+    totals = pandas.DataFrame({
+        'account_id': totals['account_id'],
+        'counterparty_id': totals['counterparty_id'],
+        'sent': totals['amount_out'],
+        'received': totals['amount_in'],
+        'transfers': totals['transfers_in'] + totals['transfers_out'],
+        'total': totals['amount_out'] + totals['amount_in'],
+    })
+    totals = totals.sort_values(['account_id', 'total', 'counterparty_id'],
+                                ascending=[True, False, True])
+    totals['rank'] = totals.groupby('account_id').cumcount() + 1
+    return (totals[totals['rank'] <= top].drop(columns='total')
+            .set_index(['account_id', 'rank']))
+
+
+def daily_balances(volume, balances):
+    """Return end of day balance of each account with transfers that day.
+
+    Balances are cumulative sums of the daily net flows, starting from the
+    current balance less all flows, so the last one is the current balance.
+    """
+    net = (volume['amount_in'] - volume['amount_out']).rename('net')
+    running = net.groupby(level='account_id').cumsum()
+    total = net.groupby(level='account_id').sum()
+    opening = balances.reindex(total.index) - total
+    account_ids = running.index.get_level_values('account_id')
+    result = pandas.DataFrame({
+        'net': net,
+        'balance': running.to_numpy() + opening.reindex(account_ids).to_numpy(),
+    }, index=running.index)
+    return result.dropna().astype('int64')
+
+
+def customer_flows(chunk, customers):
+    """Return net and gross amounts between pairs of customers in chunk.
+
+    ``customers`` maps account ids to customer ids, accounts missing from it
+    count as customer 0. Pairs are ordered, net is what customer_a paid
+    customer_b less what it received from customer_b.
+    """
+    customer_from = _customers_of(chunk['account_id_from'], customers)
+    customer_to = _customers_of(chunk['account_id_to'], customers)
+    amount = chunk['amount'].to_numpy(dtype='int64')
+    between = customer_from != customer_to
+    customer_from, customer_to = customer_from[between], customer_to[between]
+    amount = amount[between]
+    flows = pandas.DataFrame({
+        'customer_a': numpy.minimum(customer_from, customer_to),
+        'customer_b': numpy.maximum(customer_from, customer_to),
+        'net': numpy.where(customer_from < customer_to, amount, -amount),
+        'gross': amount,
+        'transfers': numpy.ones(len(amount), dtype='int64'),
+    })
+    return flows.groupby(['customer_a', 'customer_b']).sum()
+
+
+def _customers_of(account_ids, customers):
+    """Return array of the customer ids of account_ids, 0 for unknown accounts."""
+    return account_ids.map(customers).fillna(0).to_numpy(dtype='int64')
+
+
+def analyze(connection, top=TOP_COUNTERPARTIES, chunk_size=CHUNK_SIZE,
+            rows_per_pass=ROWS_PER_PASS):
+    """Yield (report, DataFrame) of all reports, one range of accounts at a time.
+
+    The transactions are read once, both sides of each are spilled to a
+    temporary file per range of accounts, then the ranges are reduced one
+    after the other. Account reports come in order of account id,
+    ``customer_flows`` last.
+    """
+    customers = read_customers(connection)
+    ranges = account_ranges(connection, rows_per_pass)
+    flows = Totals()
+
+    def chunks():
+        for chunk in read_transactions(connection, chunk_size):
+            flows.add(customer_flows(chunk, customers))
+            yield chunk
+
+    with tempfile.TemporaryDirectory(prefix='banking_analytics_') as directory:
+        paths = [os.path.join(directory, f'{i}.sides') for i in range(len(ranges))]
+        with contextlib.ExitStack() as stack:
+            files = [stack.enter_context(open(path, 'wb')) for path in paths]
+            partition(chunks(), ranges, files)
+
+        for (first, last), path in zip(ranges, paths):
+            account_sides = side_frame(numpy.fromfile(path, dtype=SIDE))
+            volume = daily_volume(account_sides)
+            yield 'daily_volume', volume
+            yield 'top_counterparties', top_counterparties(account_sides, top)
+            yield 'daily_balances', daily_balances(
+                volume, read_balances(connection, first, last))
+    yield 'customer_flows', flows.result(customer_flows(_empty_chunk(), customers))
+
+
+def write_report(frame, report_file, header=True):
+    """Write a report frame to an open text file, amounts in cents columns."""
+    frame = frame.rename(columns={c: f'{c}_cents' for c in MONEY if c in frame})
+    frame.to_csv(report_file, header=header)
+
+
+def export(output_dir, reports=REPORTS, top=TOP_COUNTERPARTIES, chunk_size=CHUNK_SIZE,
+           rows_per_pass=ROWS_PER_PASS, connection=None):
+    """Compute reports and write them to output_dir, return {report: (path, rows)}."""
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {report: os.path.join(output_dir, f'{report}.csv.gz') for report in reports}
+    rows = {}
+    with contextlib.ExitStack() as stack:
+        files = {report: stack.enter_context(gzip.open(
+            path, 'wt', compresslevel=GZIP_LEVEL, newline=''))
+            for report, path in paths.items()}
+        if connection is None:
+            connection = stack.enter_context(db.engine.connect())
+        for report, frame in analyze(connection, top, chunk_size, rows_per_pass):
+            if report in files:
+                write_report(frame, files[report], header=report not in rows)
+                rows[report] = rows.get(report, 0) + len(frame)
+    return {report: (path, rows.get(report, 0)) for report, path in paths.items()}
+
+
+def main(argv=None):
+    """Compute and write analytics reports from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--config', default='config.py')
+    parser.add_argument('--output-dir', default='analytics')
+    parser.add_argument('--reports', nargs='+', choices=REPORTS, default=list(REPORTS))
+    parser.add_argument('--top', type=int, default=TOP_COUNTERPARTIES,
+                        help='counterparties listed per account')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--rows-per-pass', type=int, default=ROWS_PER_PASS,
+                        help='transaction rows held in memory at once')
+    args = parser.parse_args(argv)
+
+    from banking_api import create_app
+
+    app = create_app(args.config)
+    start = time.perf_counter()
+    with app.app_context():
+        written = export(args.output_dir, args.reports, args.top, args.chunk_size,
+                         args.rows_per_pass)
+    for report, (path, rows) in written.items():
+        print(f'{report}: {rows} rows written to {path}')
+    print(f'done in {time.perf_counter() - start:.1f} s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
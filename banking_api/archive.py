@@ -0,0 +1,404 @@
+"""Archive of old transactions, moved out of the database to compressed files.
+
+::
+
+    python -m banking_api.archive run      # move transactions older than the horizon
+    python -m banking_api.archive verify   # check the files against the database
+
+``run`` moves the transactions older than ARCHIVE_HORIZON_DAYS out of the
+transaction table into files under ARCHIVE_DIR, partitioned by month: each
+run adds segment files of up to ``--segment-rows`` transactions of one month
+to ``<ARCHIVE_DIR>/<YYYY-MM>/`` and never changes a file once written. A
+segment holds each transaction once per account it involves, sorted by
+account, timestamp and uuid, in zlib compressed blocks of BLOCK_ROWS rows,
+followed by an index of the first and last key of every block, so the history
+of one account is read from the few blocks holding it.
+
+The totals of the archived transfers of every account are carried forward in
+ArchivedStats, which ``stats backfill`` adds to those of the transactions
+left in the table. ``GET /account/<id>/transactions`` merges the archived
+transactions of an account with the table when the page or time range it
+asks for starts before the last archived one, in the same order and with the
+same cursors. ``GET /transactions/<uuid>`` finds an archived transaction
+from its ledger entries, which are kept. Other reads (over all accounts, the
+analytics export) only see the table, and the importer only checks uuids
+against the table.
+
+A segment is recorded before its rows are deleted from the table, in chunks
+of ``--chunk-size`` rows with a transaction each so transfers are not held
+up, and a history returns a transaction found in both once. A run stopped
+while deleting finishes first the next time. Run one job at a time, and not
+with sharding.
+"""
+import argparse
+import bisect
+import functools
+import itertools
+import json
+import os
+import struct
+import sys
+import uuid
+import zlib
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import delete, func, insert, select, update
+
+from banking_api import stats
+from banking_api.model import (db, ArchiveSegment, ArchivedStats, LedgerEntry,
+                               Transaction, from_cents, from_utc, utc_now)
+from banking_api.serializers import dumps
+
+# defaults used when a setting is missing from the config file
+DEFAULTS = {
+    'ARCHIVE_DIR': 'archive',
+    'ARCHIVE_HORIZON_DAYS': 365,
+}
+
+# transactions per segment file, held in memory while it is written
+SEGMENT_ROWS = 200000
+# rows per compressed block, the unit read from a segment
+BLOCK_ROWS = 100
+# transactions deleted from the table per write transaction
+CHUNK_SIZE = 500
+COMPRESSION_LEVEL = 6
+FORMAT_VERSION = 1
+# the last 8 bytes of a segment hold the length of its index
+TRAILER = struct.Struct('<Q')
+
+
+def setting(config, name):
+    """Return an archive setting from config, or its default."""
+    return config.get(name, DEFAULTS[name])
+
+
+def archive_dir(app=None):
+    """Return the archive directory of app, relative paths are relative to the app."""
+    app = app or current_app
+    return os.path.join(app.root_path, setting(app.config, 'ARCHIVE_DIR'))
+
+
+def write_segment(path, transactions):
+    """Write transaction rows to a new segment file at path, return its size in bytes.
+
+    The file is written under a temporary name and renamed once complete.
+    """
+    sides = []
+    for transaction in transactions:
+        row = [from_utc(transaction['transaction_timestamp']), transaction['uuid'],
+               transaction['account_id_from'], transaction['account_id_to'],
+               transaction['amount']]
+        sides.append([transaction['account_id_from']] + row)
+        # a transfer of an account to itself is in its history once
+        if transaction['account_id_to'] != transaction['account_id_from']:
+            sides.append([transaction['account_id_to']] + row)
+    sides.sort()
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = path + '.tmp'
+    blocks = []
+    with open(temporary, 'wb') as segment:
+        for first in range(0, len(sides), BLOCK_ROWS):
+            block = sides[first:first + BLOCK_ROWS]
+            data = zlib.compress(dumps(block), COMPRESSION_LEVEL)
+            # offset, length, first account, timestamp and uuid, last account
+            blocks.append([segment.tell(), len(data)] + block[0][:3] + [block[-1][0]])
+            segment.write(data)
+        index = dumps({'version': FORMAT_VERSION, 'transactions': len(transactions),
+                       'rows': len(sides), 'blocks': blocks})
+        segment.write(index)
+        segment.write(TRAILER.pack(len(index)))
+        segment.flush()
+        os.fsync(segment.fileno())
+        size = segment.tell()
+    os.replace(temporary, path)
+    return size
+
+
+class Segment():
+    """Segment file opened for reading, with the index of its blocks."""
+
+    def __init__(self, path):
+        """Read the index of the segment at path."""
+        with open(path, 'rb') as segment:
+            segment.seek(-TRAILER.size, os.SEEK_END)
+            length, = TRAILER.unpack(segment.read(TRAILER.size))
+            segment.seek(-TRAILER.size - length, os.SEEK_END)
+            index = json.loads(segment.read(length))
+        if index.get('version') != FORMAT_VERSION:
+            raise ValueError(f'{path} has unknown format {index.get("version")!r}')
+        self.path = path
+        self.transactions = index['transactions']
+        self.rows = index['rows']
+        self.blocks = index['blocks']
+        # (account id, timestamp, uuid) of the first row of each block
+        self.keys = [tuple(block[2:5]) for block in self.blocks]
+
+    def read_block(self, number):
+        """Return the rows of a block, [account id, timestamp, uuid, from, to, amount]."""
+        offset, length = self.blocks[number][:2]
+        with open(self.path, 'rb') as segment:
+            segment.seek(offset)
+            return json.loads(zlib.decompress(segment.read(length)))
+
+    def all_rows(self):
+        """Yield every row of the segment, in order."""
+        for number in range(len(self.blocks)):
+            yield from self.read_block(number)
+
+    def history(self, account_id, after=('', ''), end=None):
+        """Yield rows of an account after a (timestamp, uuid) position, before end.
+
+        Timestamps are compared as the text written by from_utc.
+        """
+        lower = (account_id,) + tuple(after)
+        number = max(0, bisect.bisect_right(self.keys, lower) - 1)
+        for number in range(number, len(self.blocks)):
+            if self.blocks[number][2] > account_id:
+                return
+            if self.blocks[number][5] < account_id:
+                continue
+            for row in self.read_block(number):
+                if row[0] < account_id:
+                    continue
+                if row[0] > account_id or (end is not None and row[1] >= end):
+                    return
+                if tuple(row[:3]) > lower:
+                    yield row
+
+
+@functools.lru_cache(maxsize=1024)
+def open_segment(path):
+    """Return the Segment at path, segments never change so they are opened once."""
+    return Segment(path)
+
+
+def account_history(account_id, session, after=None, start=None, end=None):
+    """Return record iterators of the archived history of an account, to be merged.
+
+    ``after`` is the (timestamp, uuid) position of a cursor, ``start`` and
+    ``end`` the UTC time range, as for the history in the table. The list is
+    empty when the account has no archived transaction at or after them.
+    """
+    last = session.execute(select(ArchivedStats.last_activity)
+                           .where(ArchivedStats.account_id == account_id)).scalar()
+    if last is None:
+        return []
+    times = [time for time in (after[0] if after else None, start) if time is not None]
+    lowest = max(times) if times else None
+    if lowest is not None and lowest > last:
+        return []
+
+    query = select(ArchiveSegment.path, ArchiveSegment.first_timestamp,
+                   ArchiveSegment.last_timestamp).order_by(ArchiveSegment.first_timestamp)
+    if lowest is not None:
+        query = query.where(ArchiveSegment.last_timestamp >= lowest)
+    if end is not None:
+        query = query.where(ArchiveSegment.first_timestamp < end)
+    # segments following each other in time are read one after the other,
+    # only those overlapping (written by later runs) are merged
+    chains = []
+    for path, first, last in session.execute(query):
+        for chain in chains:
+            if chain[-1][1] < first:
+                chain.append((path, last))
+                break
+        else:
+            chains.append([(path, last)])
+
+    position = ('', '')
+    if start is not None:
+        position = (from_utc(start), '')
+    if after:
+        position = max(position, (from_utc(after[0]), after[1]))
+    end = from_utc(end) if end is not None else None
+    directory = archive_dir()
+    return [itertools.chain.from_iterable(
+        _records(open_segment(os.path.join(directory, path)), account_id, position, end)
+        for path, _ in chain) for chain in chains]
+
+
+def find_transaction(transaction_uuid, session):
+    """Return the archived transaction record with a uuid, None if it is not archived.
+
+    The ledger keeps the entries of archived transactions, they give the
+    account and time to read in the segments.
+    """
+    entry = session.execute(select(LedgerEntry.account_id, LedgerEntry.created_at)
+                            .where(LedgerEntry.transaction_uuid == transaction_uuid)
+                            .limit(1)).first()
+    if entry is None:
+        return None
+    account_id, timestamp = entry
+    for records in account_history(account_id, session, start=timestamp,
+                                   end=timestamp + timedelta(microseconds=1)):
+        for record in records:
+            if record['uuid'] == transaction_uuid:
+                return record
+    return None
+
+
+def _records(segment, account_id, after, end):
+    """Yield the archived history of an account as records, with UTC datetimes."""
+    for _, timestamp, transaction_uuid, account_id_from, account_id_to, amount \
+            in segment.history(account_id, after, end):
+        yield {'uuid': transaction_uuid, 'account_id_from': account_id_from,
+               'account_id_to': account_id_to, 'amount': from_cents(amount),
+               'transaction_timestamp': datetime.fromisoformat(timestamp)}
+
+
+def _next_month(timestamp):
+    """Return the start of the month after the one of timestamp."""
+    return datetime(timestamp.year + timestamp.month // 12, timestamp.month % 12 + 1, 1)
+
+
+def move_transactions(directory, cutoff, segment_rows=SEGMENT_ROWS,
+                      chunk_size=CHUNK_SIZE, session=None):
+    """Move transactions before UTC time cutoff to segment files in directory.
+
+    Return (transactions, segments) written.
+    """
+    from banking_api.transfers import run_write_transaction
+
+    session = session or db.session
+    finish_deletes(directory, chunk_size, session)
+    table = Transaction.__table__
+    moved, written = 0, 0
+    while True:
+        oldest = session.execute(select(func.min(table.c.transaction_timestamp))
+                                 .where(table.c.transaction_timestamp < cutoff)).scalar()
+        session.commit()
+        if oldest is None:
+            return moved, written
+
+        transactions = [dict(row._mapping) for row in session.execute(
+            select(table.c.uuid, table.c.account_id_from, table.c.account_id_to,
+                   table.c.amount, table.c.transaction_timestamp)
+            .where(table.c.transaction_timestamp < min(cutoff, _next_month(oldest)))
+            .order_by(table.c.transaction_timestamp, table.c.uuid)
+            .limit(segment_rows))]
+        session.commit()
+        first = transactions[0]['transaction_timestamp']
+        last = transactions[-1]['transaction_timestamp']
+        path = os.path.join(f'{first:%Y-%m}',
+                            f'{first:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}.seg')
+        write_segment(os.path.join(directory, path), transactions)
+
+        def record():
+            segment_id = session.execute(insert(ArchiveSegment.__table__).values(
+                month=f'{first:%Y-%m}', path=path, first_timestamp=first,
+                last_timestamp=last, transactions=len(transactions),
+                state='deleting', created_at=utc_now())).inserted_primary_key[0]
+            stats.record_transfers(transactions, session, table=ArchivedStats.__table__)
+            return segment_id
+
+        segment_id = run_write_transaction(record, session)
+        _delete(segment_id, [t['uuid'] for t in transactions], chunk_size, session)
+        moved += len(transactions)
+        written += 1
+
+
+def finish_deletes(directory, chunk_size=CHUNK_SIZE, session=None):
+    """Delete from the table the rows of segments a stopped run left in both."""
+    session = session or db.session
+    segments = session.execute(select(ArchiveSegment.id, ArchiveSegment.path)
+                               .where(ArchiveSegment.state == 'deleting')).all()
+    session.commit()
+    for segment_id, path in segments:
+        segment = Segment(os.path.join(directory, path))
+        uuids = sorted({row[2] for row in segment.all_rows()})
+        _delete(segment_id, uuids, chunk_size, session)
+
+
+def _delete(segment_id, uuids, chunk_size, session):
+    """Delete archived transactions from the table in chunks, then mark segment done."""
+    from banking_api.transfers import run_write_transaction
+
+    table = Transaction.__table__
+    for first in range(0, len(uuids), chunk_size):
+        chunk = uuids[first:first + chunk_size]
+        run_write_transaction(
+            lambda: session.execute(delete(table).where(table.c.uuid.in_(chunk))),
+            session)
+    segments = ArchiveSegment.__table__
+    run_write_transaction(lambda: session.execute(
+        update(segments).where(segments.c.id == segment_id).values(state='done')),
+        session)
+
+
+def verify(directory, session=None):
+    """Check every segment against its record and the totals carried forward.
+
+    Return a list of problems, empty when the archive is consistent.
+    """
+    session = session or db.session
+    problems = []
+    transactions, rows, amount = 0, 0, 0
+    for path, recorded in session.execute(
+            select(ArchiveSegment.path, ArchiveSegment.transactions)
+            .order_by(ArchiveSegment.id)):
+        try:
+            segment = Segment(os.path.join(directory, path))
+            paid, number = 0, 0
+            for number, row in enumerate(segment.all_rows(), start=1):
+                # the row of the payer is there exactly once per transaction
+                if row[0] == row[3]:
+                    paid += 1
+                    amount += row[5]
+        except (OSError, ValueError, zlib.error) as error:
+            problems.append(f'{path} cannot be read: {error}')
+            continue
+        if not paid == segment.transactions == recorded or number != segment.rows:
+            problems.append(f'{path} holds {paid} transactions in {number} rows, '
+                            f'{recorded} recorded')
+        transactions += paid
+        rows += number
+
+    carried = session.execute(select(func.coalesce(func.sum(ArchivedStats.total_out), 0),
+                                     func.coalesce(func.sum(ArchivedStats.transfer_count),
+                                                   0))).one()
+    if tuple(carried) != (amount, rows):
+        problems.append(f'archived stats hold {carried[1]} transfers of {carried[0]} '
+                        f'cents, the segments {rows} of {amount} cents')
+    return problems
+
+
+def main(argv=None):
+    """Run an archive job from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('job', choices=['run', 'verify'])
+    parser.add_argument('--config', default='config.py')
+    parser.add_argument('--horizon-days', type=float,
+                        help='age of the transactions moved (default '
+                             'ARCHIVE_HORIZON_DAYS)')
+    parser.add_argument('--segment-rows', type=int, default=SEGMENT_ROWS)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    from banking_api import create_app
+
+    app = create_app(args.config)
+    if app.config.get('SHARD_URIS'):
+        raise SystemExit('the archive is not supported with SHARD_URIS')
+    with app.app_context():
+        directory = archive_dir(app)
+        if args.job == 'run':
+            horizon = args.horizon_days
+            if horizon is None:
+                horizon = setting(app.config, 'ARCHIVE_HORIZON_DAYS')
+            moved, written = move_transactions(
+                directory, utc_now() - timedelta(days=horizon), args.segment_rows,
+                args.chunk_size)
+            print(f'{moved} transactions moved to {written} segments')
+        else:
+            problems = verify(directory)
+            for problem in problems:
+                print(f'ARCHIVE CHECK FAILED: {problem}')
+            print('archive consistent' if not problems else
+                  f'{len(problems)} problems found')
+            sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
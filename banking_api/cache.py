@@ -0,0 +1,290 @@
+"""Read-through cache of account balances for GET /account/<id>.
+
+The cache is selected with the BALANCE_CACHE setting:
+
+- ``off``: every lookup reads the database,
+- ``local``: an LRU cache with TTL inside each process. Before every lookup
+  it reads the ledger entries appended since the previous one, by any
+  process, and drops the balances they changed, so a worker never returns a
+  balance older than a write another worker committed. SQLite only, where
+  ledger ids commit in order, and not with SHARD_URIS,
+- ``shared``: Redis at BALANCE_CACHE_URL, shared by all workers.
+
+Writers invalidate the balances they changed after committing. A write
+counter stored next to the balances stops a lookup that read the database
+before a write from caching the old balance after that write.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+
+from banking_api.model import db
+
+WRITE_COUNTER_KEY = 'balance:writes'
+
+LAST_ENTRY = text('SELECT MAX(id) FROM ledger_entry')
+CHANGED_ACCOUNTS = text('''
+    SELECT id, account_id FROM ledger_entry WHERE id > :position ORDER BY id''')
+
+
+class LRUCache():
+    """In-process least recently used cache whose entries expire after ttl seconds."""
+
+    def __init__(self, maxsize=100000, ttl=5):
+        """Create empty cache."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return cached value, None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Cache value, evicting least recently used entries when full."""
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + (ttl or self.ttl))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        """Remove keys from cache."""
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove every entry, counters are kept."""
+        with self._lock:
+            self._entries.clear()
+
+    def incr(self, key):
+        """Increment and return a counter, counters never expire or get evicted."""
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def counter(self, key):
+        """Return current value of a counter."""
+        with self._lock:
+            return self._counters.get(key, 0)
+
+
+class SharedCache():
+    """Cache in a store shared between processes, with a Redis-like client.
+
+    The client needs ``get``, ``set(key, value, ex=seconds)``, ``delete(*keys)``
+    and ``incr``, as provided by redis.Redis and LocalSharedStore.
+    """
+
+    def __init__(self, client, ttl=5):
+        """Create cache on top of client."""
+        self.client = client
+        self.ttl = ttl
+
+    def get(self, key):
+        """Return cached value, None if missing or expired."""
+        value = self.client.get(key)
+        return None if value is None else int(value)
+
+    def set(self, key, value, ttl=None):
+        """Cache value with expiry."""
+        self.client.set(key, value, ex=ttl or self.ttl)
+
+    def delete(self, *keys):
+        """Remove keys from cache."""
+        if keys:
+            self.client.delete(*keys)
+
+    def incr(self, key):
+        """Increment and return a counter."""
+        return int(self.client.incr(key))
+
+    def counter(self, key):
+        """Return current value of a counter."""
+        return int(self.client.get(key) or 0)
+
+
+class LocalSharedStore():
+    """Minimal in-memory stand-in for a Redis client, for tests and benchmarks."""
+
+    def __init__(self):
+        """Create empty store."""
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return value of key, None if missing or expired."""
+        with self._lock:
+            value, expires = self._data.get(key, (None, None))
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        """Set key, expiring after ex seconds if given."""
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ex if ex else None)
+
+    def delete(self, *keys):
+        """Remove keys."""
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def incr(self, key):
+        """Increment integer value of key."""
+        with self._lock:
+            value = int(self._data.get(key, (0, None))[0]) + 1
+            self._data[key] = (value, None)
+            return value
+
+
+class BalanceCache():
+    """Account balances in cents cached by account id, with hit and miss counters."""
+
+    def __init__(self, backend, follow_ledger=False):
+        """Create balance cache storing entries in backend.
+
+        With follow_ledger every lookup first drops the balances changed by the
+        ledger entries appended since the previous one, for backends inside
+        the process that do not see the writes of other processes.
+        """
+        self.backend = backend
+        self.follow_ledger = follow_ledger
+        # last ledger entry seen, None until the first lookup
+        self.position = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def get_balance(self, account_id, load):
+        """Return cached balance, or load(account_id) and cache it if not None."""
+        if self.follow_ledger:
+            self.catch_up()
+        key = f'balance:{account_id}'
+        balance = self.backend.get(key)
+        if balance is not None:
+            with self._lock:
+                self.hits += 1
+            return balance
+
+        with self._lock:
+            self.misses += 1
+        writes = self.backend.counter(WRITE_COUNTER_KEY)
+        balance = load(account_id)
+        # a write committed while loading may have been missed by this read
+        if balance is not None and self.backend.counter(WRITE_COUNTER_KEY) == writes:
+            self.backend.set(key, balance)
+            # writers count before they delete, so a write that deleted the
+            # key before this set changed the counter
+            if self.backend.counter(WRITE_COUNTER_KEY) != writes:
+                self.backend.delete(key)
+        return balance
+
+    def set_balance(self, account_id, balance):
+        """Cache balance of a newly committed account."""
+        self.backend.set(f'balance:{account_id}', balance)
+
+    def invalidate(self, account_ids):
+        """Drop balances changed by a committed write."""
+        self.backend.incr(WRITE_COUNTER_KEY)
+        self.backend.delete(*(f'balance:{a}' for a in account_ids))
+        with self._lock:
+            self.invalidations += 1
+
+    def catch_up(self):
+        """Drop balances changed by the ledger entries appended since the last call.
+
+        The ledger is read outside the lock, so lookups do not queue behind
+        one query. Entries also read by a concurrent catch up are dropped twice.
+        """
+        position = self.position
+        with db.engine.connect() as connection:
+            if position is None:
+                last = connection.execute(LAST_ENTRY).scalar() or 0
+            else:
+                rows = connection.execute(CHANGED_ACCOUNTS,
+                                          {'position': position}).fetchall()
+        with self._lock:
+            if position is not None:
+                if rows:
+                    # a lookup loading a balance meanwhile must not cache it
+                    self.backend.incr(WRITE_COUNTER_KEY)
+                    self.backend.delete(*{f'balance:{account_id}'
+                                          for _, account_id in rows})
+                    self.position = max(self.position, rows[-1][0])
+                    self.invalidations += 1
+                return
+            if self.position is None:
+                # balances cached before the first catch up cannot be
+                # checked against the ledger
+                self.position = last
+                self.backend.clear()
+                return
+        # another lookup started following the ledger meanwhile, from a later entry
+        self.catch_up()
+
+    def stats(self):
+        """Return hit, miss and invalidation counters."""
+        with self._lock:
+            hits, misses, invalidations = self.hits, self.misses, self.invalidations
+        lookups = hits + misses
+        return {'hits': hits, 'misses': misses, 'invalidations': invalidations,
+                'hit_ratio': hits / lookups if lookups else None}
+
+
+def init_cache(app):
+    """Create balance cache selected by app config, if any."""
+    mode = app.config.get('BALANCE_CACHE', 'off')
+    ttl = app.config.get('BALANCE_CACHE_TTL', 5)
+
+    if mode == 'off':
+        return
+    elif mode == 'local':
+        if app.config.get('SHARD_URIS'):
+            raise ValueError("BALANCE_CACHE 'local' is not supported with SHARD_URIS")
+        if make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name() != 'sqlite':
+            raise ValueError("BALANCE_CACHE 'local' needs SQLite, use 'shared'")
+        backend = LRUCache(app.config.get('BALANCE_CACHE_SIZE', 100000), ttl)
+        app.extensions['balance_cache'] = BalanceCache(backend, follow_ledger=True)
+    elif mode == 'shared':
+        url = app.config.get('BALANCE_CACHE_URL')
+        if not url:
+            raise ValueError("BALANCE_CACHE 'shared' needs BALANCE_CACHE_URL")
+        import redis
+        backend = SharedCache(redis.Redis.from_url(url), ttl)
+        app.extensions['balance_cache'] = BalanceCache(backend)
+    else:
+        raise ValueError(f'unknown BALANCE_CACHE {mode!r}, '
+                         "use 'off', 'local' or 'shared'")
+
+
+def balance_cache():
+    """Return balance cache of current app, None if caching is off."""
+    return current_app.extensions.get('balance_cache')
+
+
+def invalidate_balances(account_ids):
+    """Drop cached balances of accounts changed by a committed write."""
+    cache = balance_cache()
+    if cache is not None:
+        cache.invalidate(account_ids)
@@ -0,0 +1,84 @@
+"""Database engine options and per-connection tuning for SQLite."""
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool, QueuePool
+
+# defaults used when a setting is missing from the config file
+DEFAULTS = {
+    'DB_POOL_SIZE': 10,
+    'DB_MAX_OVERFLOW': 20,
+    'DB_POOL_TIMEOUT': 30,
+    'DB_POOL_RECYCLE': 1800,
+    'DB_POOL_PRE_PING': True,
+    'SQLITE_JOURNAL_MODE': 'WAL',
+    'SQLITE_SYNCHRONOUS': 'NORMAL',
+    'SQLITE_BUSY_TIMEOUT': 5000,
+    'SQLITE_MMAP_SIZE': 256 * 2 ** 20,
+}
+
+
+def setting(config, name):
+    """Return a database setting from config, or its default."""
+    return config.get(name, DEFAULTS[name])
+
+
+def engine_options(config):
+    """Return SQLAlchemy engine options for the configured database."""
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    sqlite = url.get_backend_name() == 'sqlite'
+    if sqlite and url.database in (None, '', ':memory:'):
+        return {}
+
+    connect_args = {
+        'check_same_thread': False,
+        'timeout': setting(config, 'SQLITE_BUSY_TIMEOUT') / 1000} if sqlite else {}
+
+    # a pool size of 0 opens a new connection for every checkout
+    if setting(config, 'DB_POOL_SIZE') == 0:
+        return {'poolclass': NullPool, 'connect_args': connect_args}
+
+    pool = {
+        'pool_size': setting(config, 'DB_POOL_SIZE'),
+        'max_overflow': setting(config, 'DB_MAX_OVERFLOW'),
+        'pool_timeout': setting(config, 'DB_POOL_TIMEOUT'),
+    }
+
+    if not sqlite:
+        return dict(pool,
+                    pool_recycle=setting(config, 'DB_POOL_RECYCLE'),
+                    pool_pre_ping=setting(config, 'DB_POOL_PRE_PING'))
+
+    # SQLAlchemy opens a new SQLite connection per checkout by default, keep
+    # connections open so pragmas and the memory map are only set up once
+    return dict(pool, poolclass=QueuePool, connect_args=connect_args)
+
+
+def absolute_uri(uri, root_path):
+    """Return URI with a relative SQLite path made relative to root_path."""
+    url = make_url(uri)
+    if (url.get_backend_name() == 'sqlite' and url.database
+            and url.database != ':memory:' and not url.database.startswith('/')):
+        url = url.set(database=f'{root_path}/{url.database}')
+    return str(url)
+
+
+def configure_engine(engine, config):
+    """Register a connect hook applying SQLite pragmas to new connections."""
+    if engine.dialect.name != 'sqlite':
+        return
+
+    pragmas = {
+        'journal_mode': setting(config, 'SQLITE_JOURNAL_MODE'),
+        'synchronous': setting(config, 'SQLITE_SYNCHRONOUS'),
+        'busy_timeout': setting(config, 'SQLITE_BUSY_TIMEOUT'),
+        'mmap_size': setting(config, 'SQLITE_MMAP_SIZE'),
+    }
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            # an empty setting keeps the SQLite default
+            if value not in (None, ''):
+                cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
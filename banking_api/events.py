@@ -0,0 +1,190 @@
+"""Outbox of committed transfers, followed by downstream consumers in order.
+
+Every transfer appends a TransferEvent in the same commit as its Transaction,
+so an event exists exactly when its transfer does. Events are numbered by
+``seq`` in commit order: SQLite commits one write transaction at a time, so a
+reader that has seen event N never finds a new event numbered N or lower
+later. Server databases may commit concurrent transfers out of seq order,
+there the single writer of TRANSFER_MODE = 'async' keeps the order.
+
+Consumers read ``GET /events?after=<seq>``, which returns the next events at
+once or, with ``wait``, holds the request until one is committed (long
+polling). A named consumer stores the seq of the last event it handled with
+``PUT /events/consumers/<name>`` and goes on with ``GET
+/events?consumer=<name>`` after a restart. Storing the position after
+handling each page delivers every event once and in order, a consumer
+stopped in between gets that page again and can tell it by seq.
+
+Events handled by every consumer and older than EVENTS_RETENTION are deleted
+with::
+
+    python -m banking_api.events compact
+
+so a consumer gone for good must be deleted with ``DELETE
+/events/consumers/<name>``, or it holds events back. Imported transactions
+are history, not new transfers, and have no events. With sharding each shard
+keeps the events and consumers of the transfers paid from its accounts, read
+with ``shard=<index>``.
+"""
+import argparse
+import time
+from datetime import timedelta
+
+from flask import current_app
+from sqlalchemy import delete, func, insert, select
+
+from banking_api.model import db, EventConsumer, TransferEvent, utc_now
+
+# defaults used when a setting is missing from the config file
+DEFAULTS = {
+    'EVENTS_MAX_WAIT': 20,
+    'EVENTS_POLL_MS': 50,
+    'EVENTS_RETENTION': 7 * 24 * 3600,
+}
+
+# events deleted per transaction by compact
+CHUNK_SIZE = 10000
+
+
+def setting(config, name):
+    """Return an event setting from config, or its default."""
+    return config.get(name, DEFAULTS[name])
+
+
+def transfer_events(transactions):
+    """Return the event rows of new transaction rows."""
+    return [{'transaction_uuid': transaction['uuid'],
+             'account_id_from': transaction['account_id_from'],
+             'account_id_to': transaction['account_id_to'],
+             'amount': transaction['amount'],
+             'transaction_timestamp': transaction['transaction_timestamp']}
+            for transaction in transactions]
+
+
+def record_transfers(transactions, session=None):
+    """Append events of new transactions to the current session transaction."""
+    if transactions:
+        (session or db.session).execute(insert(TransferEvent.__table__),
+                                        transfer_events(transactions))
+
+
+def read(after, limit, wait=0, session=None):
+    """Return up to limit events after seq ``after``, oldest first.
+
+    When there are none yet, the database is polled every EVENTS_POLL_MS for
+    up to ``wait`` seconds, without holding a connection in between.
+    """
+    session = session or db.session
+    poll = setting(current_app.config, 'EVENTS_POLL_MS') / 1000
+    query = (select(TransferEvent.seq, TransferEvent.transaction_uuid.label('uuid'),
+                    TransferEvent.account_id_from, TransferEvent.account_id_to,
+                    TransferEvent.amount, TransferEvent.transaction_timestamp)
+             .where(TransferEvent.seq > after).order_by(TransferEvent.seq).limit(limit))
+    deadline = time.monotonic() + wait
+    while True:
+        rows = session.execute(query).all()
+        session.commit()
+        remaining = deadline - time.monotonic()
+        if rows or remaining <= 0:
+            return rows
+        time.sleep(min(poll, remaining))
+
+
+def position(name, session=None):
+    """Return seq of the last event handled by a consumer, None if unknown."""
+    return (session or db.session).execute(
+        select(EventConsumer.position).where(EventConsumer.name == name)).scalar()
+
+
+def store_position(name, seq, session=None):
+    """Record that a consumer handled the events up to seq, creating it if new.
+
+    Raise ValueError when seq is before the position already stored or after
+    the last event.
+    """
+    from banking_api.transfers import run_write_transaction
+
+    session = session or db.session
+
+    def work():
+        last = session.execute(select(func.max(TransferEvent.seq))).scalar() or 0
+        if seq > last:
+            raise ValueError(f'position {seq} is after the last event {last}')
+        consumer = session.get(EventConsumer, name)
+        if consumer is None:
+            session.add(EventConsumer(name=name, position=seq, updated_at=utc_now()))
+        elif seq < consumer.position:
+            raise ValueError(f'position cannot move back from {consumer.position}')
+        else:
+            consumer.position = seq
+            consumer.updated_at = utc_now()
+
+    run_write_transaction(work, session)
+
+
+def delete_consumer(name, session=None):
+    """Delete a consumer so it no longer holds events back, False if unknown."""
+    session = session or db.session
+    table = EventConsumer.__table__
+    deleted = session.execute(delete(table).where(table.c.name == name)).rowcount
+    session.commit()
+    return bool(deleted)
+
+
+def compact(retention, chunk_size=CHUNK_SIZE, session=None):
+    """Delete events every consumer handled and older than retention seconds.
+
+    The latest event is always kept, so the next seq stays known. Events are
+    deleted in chunks of ``chunk_size``, one transaction each. Return number
+    of events deleted.
+    """
+    from banking_api.transfers import run_write_transaction
+
+    session = session or db.session
+    cutoff = utc_now() - timedelta(seconds=retention)
+
+    def work():
+        last = session.execute(select(func.max(TransferEvent.seq))).scalar() or 0
+        handled = session.execute(select(func.min(EventConsumer.position))).scalar()
+        horizon = min(last - 1, last if handled is None else handled)
+        chunk = (select(TransferEvent.seq)
+                 .where(TransferEvent.seq <= horizon,
+                        TransferEvent.transaction_timestamp < cutoff)
+                 .order_by(TransferEvent.seq).limit(chunk_size))
+        table = TransferEvent.__table__
+        return session.execute(delete(table).where(table.c.seq.in_(chunk))).rowcount
+
+    deleted = 0
+    while True:
+        count = run_write_transaction(work, session)
+        deleted += count
+        if count < chunk_size:
+            return deleted
+
+
+def main(argv=None):
+    """Run an event maintenance job from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('job', choices=['compact'])
+    parser.add_argument('--config', default='config.py')
+    parser.add_argument('--retention', type=int,
+                        help='seconds events are kept (default EVENTS_RETENTION)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    from banking_api import create_app
+
+    app = create_app(args.config)
+    with app.app_context():
+        retention = args.retention
+        if retention is None:
+            retention = setting(app.config, 'EVENTS_RETENTION')
+        router = app.extensions.get('shard_router')
+        sessions = router.sessions if router is not None else [db.session]
+        deleted = sum(compact(retention, args.chunk_size, session)
+                      for session in sessions)
+        print(f'{deleted} events deleted')
+
+
+if __name__ == '__main__':
+    main()
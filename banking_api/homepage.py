@@ -0,0 +1,66 @@
+"""Homepage with the API documentation, and a health check for load balancers.
+
+README.md is rendered to HTML on the first request and again only when the
+file changes, not on every request. The page carries an ETag, so a browser or
+proxy revalidating it gets 304 Not Modified without a body. markdown is only
+imported by the first render, which keeps it out of worker start up.
+"""
+import hashlib
+import os
+import threading
+
+from flask import Response, request
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+from banking_api.model import db
+
+
+class RenderedFile():
+    """Markdown file rendered to HTML, rendered again when the file changes."""
+
+    def __init__(self, path):
+        """Create renderer for path, the file is read on first use."""
+        self.path = path
+        self.stamp = None
+        self.html = None
+        self.etag = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return (html, etag) of the current content of the file."""
+        stat = os.stat(self.path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if stamp != self.stamp:
+                import markdown
+
+                with open(self.path, 'r') as md_file:
+                    self.html = markdown.markdown(md_file.read())
+                self.etag = hashlib.sha1(self.html.encode()).hexdigest()[:20]
+                self.stamp = stamp
+            return self.html, self.etag
+
+
+def init_homepage(app):
+    """Register the homepage and /healthz."""
+    readme = RenderedFile(os.path.join(os.path.dirname(app.instance_path), 'README.md'))
+
+    @app.route("/")
+    def index():
+        """Show API documentation on homepage."""
+        html, etag = readme.get()
+        response = Response(html, mimetype='text/html')
+        response.set_etag(etag)
+        # clients may keep the page but must revalidate it, a 304 is cheap
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    @app.route("/healthz")
+    def healthz():
+        """Report whether the database answers a query."""
+        try:
+            db.session.execute(text('SELECT 1'))
+        except SQLAlchemyError:
+            return {'status': 'unavailable'}, 503
+        return {'status': 'ok'}
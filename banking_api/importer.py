@@ -0,0 +1,399 @@
+"""Bulk import of customers, accounts and transactions from CSV or JSON files.
+
+Records are streamed from the file and inserted in chunks with executemany,
+one database transaction per chunk. Every chunk also records how far into the
+file the import got, so running the same import again after a crash carries on
+after the last committed chunk. Invalid records are written to a reject file
+with the reason, instead of stopping the import. Run with::
+
+    python -m banking_api.importer customers data/customers.json
+    python -m banking_api.importer accounts data/accounts.csv
+    python -m banking_api.importer transactions data/transactions.csv
+
+Balances and amounts are read in currency units (10.50), timestamps as ISO 8601
+times, in UTC unless they have an offset. Imported transactions are history
+only: account balances are imported as they are, not recomputed.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+import uuid
+from itertools import islice
+
+from sqlalchemy import select, tuple_
+
+from banking_api.model import (db, Customer, Account, Transaction, ImportCheckpoint,
+                               parse_cents, to_utc)
+
+CHUNK_SIZE = 10000
+
+# names used for each column in source files, first match wins
+FIELDS = {
+    'customers': {
+        'id': ('id', 'customer_id'),
+        'name': ('name',),
+        'identification': ('identification',),
+    },
+    'accounts': {
+        'id': ('account_id', 'id'),
+        'customer_id': ('customer_id',),
+        'balance': ('balance', 'deposit'),
+    },
+    'transactions': {
+        'uuid': ('uuid', 'transaction_id', 'transctions_id'),
+        'account_id_from': ('account_id_from',),
+        'account_id_to': ('account_id_to',),
+        'amount': ('amount',),
+        'transaction_timestamp': ('transaction_timestamp', 'timestamp'),
+    },
+}
+
+TABLES = {'customers': Customer.__table__, 'accounts': Account.__table__,
+          'transactions': Transaction.__table__}
+
+
+class RejectedRecord(Exception):
+    """Raised when a record cannot be imported."""
+
+
+def read_records(path):
+    """Stream records from a CSV, JSON lines or JSON array file as dicts."""
+    with open(path, newline='') as source:
+        if path.endswith('.csv'):
+            yield from csv.DictReader(source)
+        elif path.endswith(('.jsonl', '.ndjson')):
+            for line in source:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from _iter_json_array(source)
+
+
+def _iter_json_array(source, block_size=2 ** 16):
+    """Decode the items of a top level JSON array one at a time."""
+    decoder = json.JSONDecoder()
+    buffer = source.read(block_size).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError('JSON file must contain an array of records')
+    buffer = buffer[1:]
+
+    while True:
+        buffer = buffer.lstrip().lstrip(',').lstrip()
+        if buffer.startswith(']'):
+            return
+        try:
+            item, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            block = source.read(block_size)
+            if not block:
+                raise
+            buffer += block
+            continue
+        yield item
+        buffer = buffer[end:]
+
+
+def _field(record, kind, column):
+    """Return the value of column in a source record, None if absent or empty."""
+    for name in FIELDS[kind][column]:
+        value = record.get(name)
+        if value not in (None, ''):
+            return value.strip() if isinstance(value, str) else value
+    return None
+
+
+def _integer(value, column):
+    """Parse an integer column."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise RejectedRecord(f'{column} must be an integer')
+
+
+def _money(value, column):
+    """Parse a money column in currency units as cents."""
+    try:
+        return parse_cents(value)
+    except ValueError as error:
+        raise RejectedRecord(f'{column}: {error}')
+
+
+def convert(kind, record):
+    """Convert a source record to a table row, raise RejectedRecord if invalid."""
+    if not isinstance(record, dict):
+        raise RejectedRecord('record must be an object')
+
+    values = {column: _field(record, kind, column) for column in FIELDS[kind]}
+
+    # accounts files may name the account "account_id" and its customer "id"
+    if kind == 'accounts' and 'account_id' in record and values['customer_id'] is None:
+        values['customer_id'] = record.get('id') or None
+
+    optional = {'customers': {'id'}, 'accounts': {'id'}, 'transactions': {'uuid'}}
+    missing = [c for c, v in values.items() if v is None and c not in optional[kind]]
+    if missing:
+        raise RejectedRecord(f'missing {missing}')
+
+    if kind == 'customers':
+        if values['id'] is not None:
+            values['id'] = _integer(values['id'], 'id')
+        values['name'] = str(values['name']).title()
+        values['identification'] = str(values['identification'])
+
+    elif kind == 'accounts':
+        if values['id'] is not None:
+            values['id'] = _integer(values['id'], 'id')
+        values['customer_id'] = _integer(values['customer_id'], 'customer_id')
+        values['balance'] = _money(values['balance'], 'balance')
+
+    elif kind == 'transactions':
+        values['uuid'] = str(values['uuid'] or uuid.uuid4())
+        for column in ('account_id_from', 'account_id_to'):
+            values[column] = _integer(values[column], column)
+        values['amount'] = _money(values['amount'], 'amount')
+        if values['amount'] <= 0:
+            raise RejectedRecord('amount must be positive and not zero')
+        try:
+            values['transaction_timestamp'] = to_utc(str(values['transaction_timestamp']))
+        except ValueError:
+            raise RejectedRecord('transaction_timestamp must be an ISO 8601 date')
+
+    return {column: value for column, value in values.items() if value is not None}
+
+
+def _existing(connection, column, values):
+    """Return the subset of values already present in column."""
+    values = list(values)
+    found = set()
+    for i in range(0, len(values), 500):
+        found.update(connection.execute(
+            select(column).where(column.in_(values[i:i + 500]))).scalars())
+    return found
+
+
+def check_references(connection, kind, rows):
+    """Return {index: reason} for rows clashing with or referring to missing data.
+
+    Checks are done with one query per column and chunk, never per row.
+    """
+    rejects = {}
+
+    def reject(predicate, reason):
+        for i, row in enumerate(rows):
+            if i not in rejects and predicate(row):
+                rejects[i] = reason
+
+    if kind == 'customers':
+        table = Customer.__table__
+        ids = _existing(connection, table.c.id, {r['id'] for r in rows if 'id' in r})
+        reject(lambda r: r.get('id') in ids, 'customer id already exists')
+
+        keys = [(r['identification'], r['name']) for r in rows]
+        found = set()
+        for i in range(0, len(keys), 500):
+            found.update(tuple(k) for k in connection.execute(
+                select(table.c.identification, table.c.name).where(
+                    tuple_(table.c.identification, table.c.name).in_(keys[i:i + 500]))))
+        reject(lambda r: (r['identification'], r['name']) in found,
+               'customer already exists')
+
+        seen = set()
+
+        def duplicate(row):
+            key = (row['identification'], row['name'])
+            if key in seen:
+                return True
+            seen.add(key)
+            return False
+        reject(duplicate, 'customer repeated in file')
+
+    elif kind == 'accounts':
+        table = Account.__table__
+        ids = _existing(connection, table.c.id, {r['id'] for r in rows if 'id' in r})
+        reject(lambda r: r.get('id') in ids, 'account id already exists')
+
+        customers = _existing(connection, Customer.__table__.c.id,
+                              {r['customer_id'] for r in rows})
+        reject(lambda r: r['customer_id'] not in customers, 'customer does not exist')
+
+    elif kind == 'transactions':
+        table = Transaction.__table__
+        uuids = _existing(connection, table.c.uuid, {r['uuid'] for r in rows})
+        reject(lambda r: r['uuid'] in uuids, 'transaction uuid already exists')
+
+        accounts = _existing(connection, Account.__table__.c.id, {
+            r[c] for r in rows for c in ('account_id_from', 'account_id_to')})
+        reject(lambda r: r['account_id_from'] not in accounts
+               or r['account_id_to'] not in accounts, 'account does not exist')
+
+    # explicit ids repeated within the chunk
+    key = 'uuid' if kind == 'transactions' else 'id'
+    seen_keys = set()
+
+    def repeated(row):
+        if key not in row:
+            return False
+        if row[key] in seen_keys:
+            return True
+        seen_keys.add(row[key])
+        return False
+    reject(repeated, f'{key} repeated in file')
+
+    return rejects
+
+
+def import_records(kind, records, source=None, chunk_size=CHUNK_SIZE,
+                   rejects=None, defer_indexes=False, progress=None):
+    """Import an iterable of source records into the table of kind.
+
+    ``source`` names the import for resuming, records already committed by an
+    earlier import of the same source are skipped; None disables resuming.
+    ``rejects`` is a csv.writer receiving (record number, reason, record).
+    ``defer_indexes`` drops the non-unique indexes of the table while loading
+    and builds them once at the end. ``progress`` is called with the stats
+    after every chunk. Return dict of record counts and rate.
+    """
+    table = TABLES[kind]
+    engine = db.engine
+    stats = {'kind': kind, 'read': 0, 'imported': 0, 'rejected': 0, 'skipped': 0}
+    start = time.perf_counter()
+
+    checkpoint = ImportCheckpoint.__table__
+    with engine.begin() as connection:
+        done = 0
+        if source is not None:
+            row = connection.execute(
+                select(checkpoint.c.records_done, checkpoint.c.imported,
+                       checkpoint.c.rejected)
+                .where(checkpoint.c.source == source, checkpoint.c.kind == kind)
+            ).first()
+            if row is not None:
+                done, stats['imported'], stats['rejected'] = row
+                stats['skipped'] = done
+
+        deferred = [index for index in table.indexes if not index.unique]
+        if defer_indexes:
+            for index in deferred:
+                index.drop(connection, checkfirst=True)
+
+    records = iter(records)
+    for _ in islice(records, done):
+        pass
+    number = done
+
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            break
+
+        rows, row_numbers, rejected = [], [], []
+        for record in chunk:
+            number += 1
+            try:
+                rows.append(convert(kind, record))
+                row_numbers.append(number)
+            except RejectedRecord as error:
+                rejected.append((number, str(error), record))
+
+        with engine.begin() as connection:
+            clashes = check_references(connection, kind, rows)
+            for i, reason in sorted(clashes.items()):
+                rejected.append((row_numbers[i], reason, rows[i]))
+            rows = [row for i, row in enumerate(rows) if i not in clashes]
+
+            # executemany needs every row to have the same columns
+            for columns in {tuple(sorted(row)) for row in rows}:
+                batch = [row for row in rows if tuple(sorted(row)) == columns]
+                connection.execute(table.insert(), batch)
+
+            stats['imported'] += len(rows)
+            stats['rejected'] += len(rejected)
+            if source is not None:
+                _save_checkpoint(connection, source, kind, number, stats)
+
+        if rejects is not None:
+            for rejected_number, reason, record in sorted(rejected, key=lambda r: r[0]):
+                rejects.writerow([rejected_number, reason, json.dumps(record)])
+
+        stats['read'] = number - done
+        stats['seconds'] = time.perf_counter() - start
+        stats['rows_per_second'] = stats['read'] / stats['seconds']
+        if progress is not None:
+            progress(stats)
+
+    if defer_indexes:
+        with engine.begin() as connection:
+            for index in deferred:
+                index.create(connection, checkfirst=True)
+
+    stats['read'] = number - done
+    stats['seconds'] = time.perf_counter() - start
+    stats['rows_per_second'] = stats['read'] / stats['seconds'] if stats['read'] else 0
+    return stats
+
+
+def _save_checkpoint(connection, source, kind, number, stats):
+    """Record number of records processed by an import, in its chunk transaction."""
+    checkpoint = ImportCheckpoint.__table__
+    values = {'records_done': number, 'imported': stats['imported'],
+              'rejected': stats['rejected']}
+    updated = connection.execute(
+        checkpoint.update()
+        .where(checkpoint.c.source == source, checkpoint.c.kind == kind)
+        .values(**values)).rowcount
+    if not updated:
+        connection.execute(checkpoint.insert().values(source=source, kind=kind,
+                                                      **values))
+
+
+def import_file(kind, path, rejects_path=None, **options):
+    """Import a CSV or JSON file, writing rejected records next to it by default."""
+    rejects_path = rejects_path or f'{path}.rejects.csv'
+    with open(rejects_path, 'a', newline='') as rejects_file:
+        rejects = csv.writer(rejects_file)
+        if rejects_file.tell() == 0:
+            rejects.writerow(['record', 'reason', 'data'])
+        return import_records(kind, read_records(path),
+                              source=os.path.realpath(path), rejects=rejects,
+                              **options)
+
+
+def main(argv=None):
+    """Run an import from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('kind', choices=sorted(TABLES))
+    parser.add_argument('path', help='CSV (.csv), JSON lines (.jsonl) or JSON file')
+    parser.add_argument('--config', default='config.py')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--rejects', help='reject file, default <path>.rejects.csv')
+    parser.add_argument('--defer-indexes', action='store_true',
+                        help='build non-unique indexes after loading')
+    args = parser.parse_args(argv)
+
+    from banking_api import create_app
+    from banking_api.migrations import upgrade
+
+    def progress(stats):
+        print(f"{stats['read']} records read, {stats['imported']} imported, "
+              f"{stats['rejected']} rejected, {stats['rows_per_second']:.0f} rows/s",
+              file=sys.stderr)
+
+    app = create_app(args.config)
+    with app.app_context():
+        upgrade(db.engine)
+        stats = import_file(args.kind, args.path, args.rejects,
+                            chunk_size=args.chunk_size,
+                            defer_indexes=args.defer_indexes, progress=progress)
+
+    if stats['skipped']:
+        print(f"resumed after {stats['skipped']} records already imported")
+    print(f"{args.kind}: {stats['read']} records read, {stats['imported']} imported, "
+          f"{stats['rejected']} rejected in {stats['seconds']:.1f} s "
+          f"({stats['rows_per_second']:.0f} rows/s)")
+
+
+if __name__ == '__main__':
+    main()
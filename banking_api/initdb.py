@@ -1,40 +1,40 @@
-"""Initialise database with given data."""
-import sqlite3
-import json
-import os
-import string
-print(os.getcwd())
-
-conn = sqlite3.connect('banking_api/bankingapi.db')
-
-cursor = conn.cursor()
-
-# delete all rows from all three tables
-cursor.execute("DELETE FROM 'transaction';")
-cursor.execute("DELETE FROM account;")
-cursor.execute("DELETE FROM customer;")
-conn.commit()
+"""Initialise database with given data.
 
-# initialise with given json
-json_obj = json.load(open('data/customers.json'))
-print(json_obj)
-
-alphabet = list(string.ascii_lowercase)
-
-for i, row in enumerate(json_obj):
+Run from the repository root with ``python -m banking_api.initdb``. All rows
+are deleted, then the customers, accounts and transactions in data/ are
+loaded with the bulk importer and their ledger entries and statistics written.
+"""
+import string
 
-    sql = """INSERT INTO customer (name, identification)
-          VALUES (?, ?)"""
+from banking_api import create_app, stats
+from banking_api.importer import import_file, import_records, read_records
+from banking_api.ledger import backfill
+from banking_api.migrations import upgrade
+from banking_api.model import (db, Customer, Account, Transaction, ImportCheckpoint,
+                               LedgerEntry, BalanceSnapshot, AccountStats)
 
-    params = (row['name'], alphabet[i] * 5)
+app = create_app('config.py')
 
-    cursor.execute(sql, params)
+with app.app_context():
+    upgrade(db.engine)
 
-    conn.commit()
+    # delete all rows from all tables
+    for model in (AccountStats, BalanceSnapshot, LedgerEntry, Transaction, Account,
+                  Customer, ImportCheckpoint):
+        db.session.query(model).delete()
+    db.session.commit()
 
-    print(row['name'], alphabet[i] * 5)
+    # the given customers have no identification, make one up for each
+    alphabet = list(string.ascii_lowercase)
+    customers = (dict(row, identification=alphabet[i] * 5)
+                 for i, row in enumerate(read_records('data/customers.json')))
+    print(import_records('customers', customers))
 
+    print(import_file('accounts', 'data/accounts.csv'))
+    print(import_file('transactions', 'data/transactions.csv'))
 
-conn.close()
+    # the importer writes rows directly, derive their ledger entries
+    print(f'{backfill()} ledger entries written')
+    print(f'statistics of {stats.backfill()} accounts built')
 
 print('Database initialised with data')
@@ -0,0 +1,306 @@
+"""Append-only double-entry ledger with incremental balance snapshots.
+
+Every transfer appends a debit and a credit LedgerEntry in the same commit as
+its Transaction and balance updates, and every new account a credit for its
+deposit. The balance of an account at any time is therefore the sum of its
+entries up to that time. To avoid summing a whole history, BalanceSnapshot
+rows store that sum at regular points in time, and a balance as of time T is
+the last snapshot at or before T plus the few entries between it and T, read
+from the (account_id, created_at) index. Maintenance jobs::
+
+    python -m banking_api.ledger backfill   # entries for data older than the ledger
+    python -m banking_api.ledger snapshot   # snapshot accounts with many new entries
+    python -m banking_api.ledger verify     # check new snapshots and balances
+"""
+import argparse
+from datetime import datetime, timedelta
+
+from sqlalchemy import (Boolean, DateTime, bindparam, delete, func, insert, select,
+                        text, update)
+
+from banking_api.model import db, Account, LedgerEntry, BalanceSnapshot, utc_now
+
+SNAPSHOT_EVERY = 1000
+SNAPSHOT_LAG = 60
+CHUNK_SIZE = 10000
+
+
+def transfer_entries(transactions):
+    """Return the debit and credit entry rows of new transaction rows."""
+    entries = []
+    for transaction in transactions:
+        created_at = transaction['transaction_timestamp']
+        entries.append({'account_id': transaction['account_id_from'],
+                        'transaction_uuid': transaction['uuid'],
+                        'amount': -transaction['amount'],
+                        'created_at': created_at})
+        entries.append({'account_id': transaction['account_id_to'],
+                        'transaction_uuid': transaction['uuid'],
+                        'amount': transaction['amount'],
+                        'created_at': created_at})
+    return entries
+
+
+def record_transfers(transactions, session=None):
+    """Append entries of new transactions to the current session transaction."""
+    if transactions:
+        (session or db.session).execute(insert(LedgerEntry.__table__),
+                                        transfer_entries(transactions))
+
+
+def record_opening(account_id, balance, session=None):
+    """Append the opening deposit of a new account to the current session transaction."""
+    (session or db.session).add(LedgerEntry(account_id=account_id, amount=balance,
+                                            created_at=utc_now()))
+
+
+def balance_as_of(account_id, as_of, session=None):
+    """Return balance of an account in cents at UTC time as_of, from the ledger."""
+    session = session or db.session
+    snapshot = session.execute(
+        select(BalanceSnapshot.created_at, BalanceSnapshot.balance)
+        .where(BalanceSnapshot.account_id == account_id,
+               BalanceSnapshot.created_at <= as_of)
+        .order_by(BalanceSnapshot.created_at.desc()).limit(1)).first()
+    since, balance = snapshot if snapshot is not None else (None, 0)
+
+    query = (select(func.coalesce(func.sum(LedgerEntry.amount), 0))
+             .where(LedgerEntry.account_id == account_id,
+                    LedgerEntry.created_at <= as_of))
+    if since is not None:
+        query = query.where(LedgerEntry.created_at > since)
+    return balance + int(session.execute(query).scalar())
+
+
+def _account_ranges(connection, chunk_size):
+    """Yield (first, last) account ids of consecutive chunks of accounts."""
+    last = 0
+    while True:
+        ids = connection.execute(
+            select(Account.id).where(Account.id > last)
+            .order_by(Account.id).limit(chunk_size)).scalars().all()
+        if not ids:
+            return
+        yield ids[0], ids[-1]
+        last = ids[-1]
+
+
+def _sql(statement, **types):
+    """Return text statement whose named parameters have the given column types."""
+    return text(statement).bindparams(
+        *(bindparam(name, type_=type_) for name, type_ in types.items()))
+
+
+# latest snapshot of each account in a range of account ids
+LATEST_SNAPSHOTS = '''
+    SELECT s.account_id, s.balance, s.created_at
+    FROM balance_snapshot s
+    JOIN (SELECT account_id, MAX(created_at) AS created_at FROM balance_snapshot
+          WHERE account_id BETWEEN :first AND :last GROUP BY account_id) l
+      ON l.account_id = s.account_id AND l.created_at = s.created_at
+'''
+
+
+def take_snapshots(every=SNAPSHOT_EVERY, lag=SNAPSHOT_LAG, chunk_size=CHUNK_SIZE):
+    """Snapshot accounts with at least ``every`` entries since their last snapshot.
+
+    Only entries older than ``lag`` seconds are covered, so transfers still
+    committing cannot add entries to a period already snapshotted. Accounts
+    are processed in chunks of ``chunk_size``, one transaction each. Return
+    number of snapshots taken.
+    """
+    cutoff = utc_now() - timedelta(seconds=lag)
+    taken = 0
+    with db.engine.connect() as connection:
+        for first, last in _account_ranges(connection, chunk_size):
+            with connection.begin():
+                rows = connection.execute(
+                    _sql(f'''
+                    SELECT e.account_id, COALESCE(l.balance, 0) + SUM(e.amount),
+                           MAX(e.created_at)
+                    FROM ledger_entry e
+                    LEFT JOIN ({LATEST_SNAPSHOTS}) l ON l.account_id = e.account_id
+                    WHERE e.account_id BETWEEN :first AND :last
+                      AND (l.created_at IS NULL OR e.created_at > l.created_at)
+                      AND e.created_at <= :cutoff
+                    GROUP BY e.account_id, l.balance
+                    HAVING COUNT(*) >= :every''', cutoff=DateTime()),
+                    {'first': first, 'last': last, 'cutoff': cutoff,
+                     'every': every}).fetchall()
+
+                snapshots = [{'account_id': account_id, 'balance': int(balance),
+                              'created_at': _datetime(created_at), 'verified': False}
+                             for account_id, balance, created_at in rows]
+                if snapshots:
+                    connection.execute(insert(BalanceSnapshot.__table__), snapshots)
+                taken += len(snapshots)
+    return taken
+
+
+def verify(chunk_size=CHUNK_SIZE):
+    """Check snapshots not verified yet and current balances against the ledger.
+
+    Each new snapshot is checked against the previous snapshot of its account
+    plus the entries in between, so work is proportional to new entries only.
+    Return dict with number of snapshots verified and lists of mismatches.
+    """
+    report = {'snapshots_verified': 0, 'snapshot_mismatches': [],
+              'balance_mismatches': []}
+
+    with db.engine.connect() as connection:
+        last = 0
+        while True:
+            with connection.begin():
+                rows = connection.execute(
+                    _sql('''
+                    SELECT s.id, s.account_id, s.created_at, s.balance,
+                           COALESCE(p.balance, 0) + COALESCE((
+                               SELECT SUM(e.amount) FROM ledger_entry e
+                               WHERE e.account_id = s.account_id
+                                 AND (p.created_at IS NULL
+                                      OR e.created_at > p.created_at)
+                                 AND e.created_at <= s.created_at), 0)
+                    FROM balance_snapshot s
+                    LEFT JOIN balance_snapshot p ON p.id = (
+                        SELECT p2.id FROM balance_snapshot p2
+                        WHERE p2.account_id = s.account_id
+                          AND p2.created_at < s.created_at
+                        ORDER BY p2.created_at DESC LIMIT 1)
+                    WHERE s.verified = :verified AND s.id > :last
+                    ORDER BY s.id LIMIT :n''', verified=Boolean()),
+                    {'last': last, 'n': chunk_size, 'verified': False}).fetchall()
+                if not rows:
+                    break
+                last = rows[-1][0]
+
+                good = [r[0] for r in rows if int(r[3]) == int(r[4])]
+                report['snapshot_mismatches'].extend(
+                    {'snapshot_id': r[0], 'account_id': r[1], 'created_at': str(r[2]),
+                     'balance': int(r[3]), 'ledger': int(r[4])}
+                    for r in rows if int(r[3]) != int(r[4]))
+                if good:
+                    connection.execute(
+                        update(BalanceSnapshot.__table__)
+                        .where(BalanceSnapshot.__table__.c.id.in_(good))
+                        .values(verified=True))
+                report['snapshots_verified'] += len(good)
+
+        for first, last_account in _account_ranges(connection, chunk_size):
+            rows = connection.execute(
+                text(f'''
+                SELECT a.id, a.balance, COALESCE(l.balance, 0) + COALESCE((
+                    SELECT SUM(e.amount) FROM ledger_entry e
+                    WHERE e.account_id = a.id
+                      AND (l.created_at IS NULL OR e.created_at > l.created_at)), 0)
+                FROM account a
+                LEFT JOIN ({LATEST_SNAPSHOTS}) l ON l.account_id = a.id
+                WHERE a.id BETWEEN :first AND :last'''),
+                {'first': first, 'last': last_account}).fetchall()
+            report['balance_mismatches'].extend(
+                {'account_id': r[0], 'balance': int(r[1]), 'ledger': int(r[2])}
+                for r in rows if int(r[1]) != int(r[2]))
+
+    return report
+
+
+def backfill(chunk_size=CHUNK_SIZE):
+    """Write ledger entries for transactions and balances older than the ledger.
+
+    Transactions without entries get their debit and credit, then each
+    account whose entries do not add up to its balance gets an opening entry
+    for the difference, dated with its first entry. Snapshots of the accounts
+    changed are dropped, as they may no longer cover all of their past
+    entries. Safe to run again. Return number of entries written.
+    """
+    written = 0
+    with db.engine.connect() as connection:
+        while True:
+            with connection.begin():
+                rows = connection.execute(text('''
+                    SELECT t.uuid, t.account_id_from, t.account_id_to, t.amount,
+                           t.transaction_timestamp
+                    FROM "transaction" t
+                    WHERE NOT EXISTS (SELECT 1 FROM ledger_entry e
+                                      WHERE e.transaction_uuid = t.uuid)
+                    LIMIT :n'''), {'n': chunk_size}).fetchall()
+                if not rows:
+                    break
+                entries = transfer_entries([
+                    {'uuid': r[0], 'account_id_from': r[1], 'account_id_to': r[2],
+                     'amount': int(r[3]), 'transaction_timestamp': _datetime(r[4])}
+                    for r in rows])
+                _append_entries(connection, entries)
+                written += len(entries)
+
+        for first, last in _account_ranges(connection, chunk_size):
+            with connection.begin():
+                rows = connection.execute(
+                    text('''
+                    SELECT a.id, a.balance - COALESCE(SUM(e.amount), 0),
+                           MIN(e.created_at)
+                    FROM account a LEFT JOIN ledger_entry e ON e.account_id = a.id
+                    WHERE a.id BETWEEN :first AND :last
+                    GROUP BY a.id, a.balance
+                    HAVING a.balance != COALESCE(SUM(e.amount), 0)'''),
+                    {'first': first, 'last': last}).fetchall()
+                entries = [{'account_id': account_id, 'transaction_uuid': None,
+                            'amount': int(amount),
+                            'created_at': _datetime(first_entry) or utc_now()}
+                           for account_id, amount, first_entry in rows]
+                _append_entries(connection, entries)
+                written += len(entries)
+    return written
+
+
+def _append_entries(connection, entries):
+    """Insert backfilled entries and drop the snapshots of their accounts."""
+    if not entries:
+        return
+    connection.execute(insert(LedgerEntry.__table__), entries)
+    account_ids = sorted({entry['account_id'] for entry in entries})
+    connection.execute(
+        delete(BalanceSnapshot.__table__)
+        .where(BalanceSnapshot.__table__.c.account_id.in_(account_ids)))
+
+
+def _datetime(value):
+    """Return a datetime read back from a raw SQL query, which may be a string."""
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value))
+
+
+def main(argv=None):
+    """Run a ledger maintenance job from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('job', choices=['backfill', 'snapshot', 'verify'])
+    parser.add_argument('--config', default='config.py')
+    parser.add_argument('--every', type=int, default=SNAPSHOT_EVERY,
+                        help='entries since the last snapshot before taking another')
+    parser.add_argument('--lag', type=int, default=SNAPSHOT_LAG,
+                        help='seconds an entry must be old to be snapshotted')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    from banking_api import create_app
+
+    app = create_app(args.config)
+    with app.app_context():
+        if args.job == 'backfill':
+            print(f'{backfill(args.chunk_size)} ledger entries written')
+        elif args.job == 'snapshot':
+            taken = take_snapshots(args.every, args.lag, args.chunk_size)
+            print(f'{taken} snapshots taken')
+        else:
+            report = verify(args.chunk_size)
+            print(f"{report['snapshots_verified']} snapshots verified")
+            for mismatch in report['snapshot_mismatches']:
+                print(f'SNAPSHOT MISMATCH {mismatch}')
+            for mismatch in report['balance_mismatches']:
+                print(f'BALANCE MISMATCH {mismatch}')
+            if report['snapshot_mismatches'] or report['balance_mismatches']:
+                raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
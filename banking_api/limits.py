@@ -0,0 +1,259 @@
+"""Per-account transfer limits, checked against in-memory sliding windows.
+
+Rules are read from the config, amounts in currency units, and all are off
+by default:
+
+- LIMIT_BALANCE_FLOOR: lowest balance a transfer may leave the paying account
+  with, 0 forbids overdrafts
+- LIMIT_MAX_AMOUNT: largest single transfer
+- LIMIT_MINUTE_COUNT, LIMIT_HOUR_COUNT, LIMIT_DAY_COUNT: most transfers an
+  account may pay out in any rolling minute, hour or day
+- LIMIT_MINUTE_AMOUNT, LIMIT_HOUR_AMOUNT, LIMIT_DAY_AMOUNT: largest total it
+  may pay out in any rolling minute, hour or day
+
+The payments of each account are counted in memory, per window in
+WINDOW_BUCKETS buckets, so a check adds up a few numbers instead of querying
+the history. A bucket leaves its window once the whole bucket is older than
+the window, so a payment may count up to 1/WINDOW_BUCKETS of the window
+longer than its exact time, never shorter.
+
+The windows follow the debits appended to the ledger. Checks run under the
+write lock of the transfer, and first add the entries appended since the
+previous check, by this process or any other, then seed an account seen for
+the first time from its debits of the last day, through the (account_id,
+created_at) index. Both are indexed reads of a handful of rows. Ledger ids
+follow commit order under the single writer of SQLite, server databases may
+commit them out of order and let a check miss a concurrent payment. Accounts
+idle for longer than the longest window are dropped and seeded again when
+they pay next.
+"""
+import collections
+import threading
+import time
+from datetime import datetime, timezone
+
+from flask import current_app
+from sqlalchemy import DateTime, bindparam, text
+
+from banking_api.model import from_cents, parse_cents
+
+# defaults used when a setting is missing from the config file
+DEFAULTS = {
+    'LIMIT_BALANCE_FLOOR': None,
+    'LIMIT_MAX_AMOUNT': None,
+    'LIMIT_MINUTE_COUNT': None,
+    'LIMIT_MINUTE_AMOUNT': None,
+    'LIMIT_HOUR_COUNT': None,
+    'LIMIT_HOUR_AMOUNT': None,
+    'LIMIT_DAY_COUNT': None,
+    'LIMIT_DAY_AMOUNT': None,
+    'LIMIT_TRACKED_ACCOUNTS': 1000000,
+}
+
+WINDOWS = (('minute', 60), ('hour', 3600), ('day', 24 * 3600))
+WINDOW_BUCKETS = 60
+
+# plain statements built once, building them per check costs more than running them
+LAST_ENTRY = text('SELECT MAX(id) FROM ledger_entry')
+NEW_ENTRIES = text('''
+    SELECT id, account_id, amount, created_at, transaction_uuid FROM ledger_entry
+    WHERE id > :position ORDER BY id''').columns(created_at=DateTime)
+RECENT_DEBITS = text('''
+    SELECT amount, created_at FROM ledger_entry
+    WHERE account_id = :account_id AND created_at >= :since AND amount < 0
+      AND transaction_uuid IS NOT NULL AND id <= :position''').bindparams(
+    bindparam('since', type_=DateTime)).columns(created_at=DateTime)
+
+
+def setting(config, name):
+    """Return a transfer limit setting from config, or its default."""
+    return config.get(name, DEFAULTS[name])
+
+
+class Window():
+    """Payments of one account in a rolling window, counted in buckets."""
+
+    __slots__ = ('buckets', 'count', 'amount')
+
+    def __init__(self):
+        """Create window without payments."""
+        # [bucket number, count, amount], oldest first
+        self.buckets = collections.deque()
+        self.count = 0
+        self.amount = 0
+
+    def add(self, bucket, amount):
+        """Count a payment of amount in a bucket."""
+        self.count += 1
+        self.amount += amount
+        buckets = self.buckets
+        if buckets and buckets[-1][0] == bucket:
+            buckets[-1][1] += 1
+            buckets[-1][2] += amount
+        elif not buckets or buckets[-1][0] < bucket:
+            buckets.append([bucket, 1, amount])
+        else:
+            # a payment committed by another process before the latest one seen
+            for index, entry in enumerate(buckets):
+                if entry[0] == bucket:
+                    entry[1] += 1
+                    entry[2] += amount
+                    return
+                if entry[0] > bucket:
+                    buckets.insert(index, [bucket, 1, amount])
+                    return
+
+    def expire(self, oldest):
+        """Drop the buckets before bucket number oldest."""
+        buckets = self.buckets
+        while buckets and buckets[0][0] < oldest:
+            _, count, amount = buckets.popleft()
+            self.count -= count
+            self.amount -= amount
+
+
+class Limits():
+    """Transfer rules and the recent payments of accounts, in one process."""
+
+    def __init__(self, floor=None, max_amount=None, windows=(),
+                 max_accounts=DEFAULTS['LIMIT_TRACKED_ACCOUNTS']):
+        """Create limits, amounts in cents.
+
+        ``windows`` holds (name, seconds, max count, max amount) of each
+        rolling window with a rule, None where a window has no such limit.
+        """
+        self.floor = floor
+        self.max_amount = max_amount
+        self.windows = tuple(windows)
+        self.max_accounts = max_accounts
+        self.longest = max((seconds for _, seconds, _, _ in self.windows), default=0)
+        # payments of the accounts of each database, and the last ledger id read
+        self.accounts = {}
+        self.positions = {}
+        self._lock = threading.Lock()
+
+    def check(self, session, account_id, amount, balance=None, pending=(0, 0)):
+        """Return why paying amount from an account breaks a rule, None if it does not.
+
+        Must run in the write transaction of the transfer. ``balance`` is the
+        balance of the account before paying, the floor is not checked when
+        None. ``pending`` is (count, amount) of payments earlier in the same
+        batch.
+        """
+        if self.max_amount is not None and amount > self.max_amount:
+            return f'amount is above the limit of {from_cents(self.max_amount)}'
+
+        if (self.floor is not None and balance is not None
+                and balance - amount < self.floor):
+            return f'balance cannot go below {from_cents(self.floor)}'
+
+        if not self.windows:
+            return None
+        pending_count, pending_amount = pending
+        with self._lock:
+            windows = self._windows(session, account_id, time.time())
+            for (name, _, max_count, max_total), window in zip(self.windows, windows):
+                if max_count is not None and window.count + pending_count >= max_count:
+                    return f'more than {max_count} transfers per {name}'
+                if (max_total is not None
+                        and window.amount + pending_amount + amount > max_total):
+                    return f'more than {from_cents(max_total)} transferred per {name}'
+        return None
+
+    def _windows(self, session, account_id, now):
+        """Return the up to date windows of an account, caught up with the ledger."""
+        connection = session.connection()
+        accounts = self.accounts.setdefault(connection.engine, collections.OrderedDict())
+        position = self._catch_up(connection, accounts)
+
+        windows = accounts.get(account_id)
+        if windows is None:
+            windows = accounts[account_id] = self._seed(connection, account_id,
+                                                        position, now)
+        else:
+            accounts.move_to_end(account_id)
+        self._expire(windows, now)
+
+        # the least recently checked accounts go once they hold no payments
+        while len(accounts) > 1:
+            oldest_id, oldest = next(iter(accounts.items()))
+            if len(accounts) <= self.max_accounts:
+                self._expire(oldest, now)
+                if any(window.count for window in oldest):
+                    break
+            del accounts[oldest_id]
+        return windows
+
+    def _catch_up(self, connection, accounts):
+        """Add debits appended to the ledger since the last check, return last id."""
+        position = self.positions.get(connection.engine)
+        if position is None:
+            position = connection.execute(LAST_ENTRY).scalar() or 0
+            self.positions[connection.engine] = position
+            return position
+
+        rows = connection.execute(NEW_ENTRIES, {'position': position}).fetchall()
+        for entry_id, account_id, amount, created_at, transaction_uuid in rows:
+            position = entry_id
+            windows = accounts.get(account_id)
+            if windows is not None and amount < 0 and transaction_uuid is not None:
+                self._add(windows, _seconds(created_at), -amount)
+        self.positions[connection.engine] = position
+        return position
+
+    def _seed(self, connection, account_id, position, now):
+        """Return new windows of an account holding its recent debits up to position."""
+        windows = tuple(Window() for _ in self.windows)
+        since = datetime.fromtimestamp(now - self.longest * (1 + 1 / WINDOW_BUCKETS),
+                                       timezone.utc).replace(tzinfo=None)
+        rows = connection.execute(RECENT_DEBITS, {
+            'account_id': account_id, 'since': since, 'position': position})
+        for amount, created_at in rows:
+            self._add(windows, _seconds(created_at), -amount)
+        return windows
+
+    def _add(self, windows, timestamp, amount):
+        """Count a payment made at timestamp in every window."""
+        for (_, seconds, _, _), window in zip(self.windows, windows):
+            window.add(_bucket(timestamp, seconds), amount)
+
+    def _expire(self, windows, now):
+        """Drop the payments that left every window by now."""
+        for (_, seconds, _, _), window in zip(self.windows, windows):
+            window.expire(_bucket(now, seconds) - WINDOW_BUCKETS)
+
+
+def _seconds(created_at):
+    """Return seconds since the epoch of a naive UTC datetime read from the ledger."""
+    return created_at.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _bucket(timestamp, seconds):
+    """Return number of the bucket of a window of seconds holding timestamp."""
+    return int(timestamp * WINDOW_BUCKETS // seconds)
+
+
+def init_limits(app):
+    """Create the transfer limits of app, unless no rule is set."""
+    def amount(name):
+        value = setting(app.config, name)
+        return None if value is None else parse_cents(value)
+
+    windows = []
+    for name, seconds in WINDOWS:
+        max_count = setting(app.config, f'LIMIT_{name.upper()}_COUNT')
+        max_amount = amount(f'LIMIT_{name.upper()}_AMOUNT')
+        if max_count is not None or max_amount is not None:
+            windows.append((name, seconds, max_count, max_amount))
+
+    floor = amount('LIMIT_BALANCE_FLOOR')
+    max_amount = amount('LIMIT_MAX_AMOUNT')
+    if floor is None and max_amount is None and not windows:
+        return
+    app.extensions['transfer_limits'] = Limits(
+        floor, max_amount, windows, setting(app.config, 'LIMIT_TRACKED_ACCOUNTS'))
+
+
+def transfer_limits():
+    """Return transfer limits of current app, None when no rule is set."""
+    return current_app.extensions.get('transfer_limits')
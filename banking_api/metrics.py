@@ -0,0 +1,372 @@
+"""Request timers, SQL instrumentation and sampling profiler, served at /metrics.
+
+With METRICS on (the default) every request is timed per route, and every SQL
+statement it runs is counted and timed through SQLAlchemy cursor events, so
+the time of a slow route splits into SQLite time and Python time (Flask,
+Flask-RESTful and ORM). A request running the same statement at least
+N_PLUS_ONE_THRESHOLD times, the pattern of loading rows one by one in a loop,
+is counted and logged. ``GET /metrics`` returns everything in the Prometheus
+text format. Metrics are kept per process, so each gunicorn worker reports
+its own.
+
+PROFILE_SAMPLE_RATE is the fraction of requests sampled by a profiler
+thread every PROFILE_INTERVAL_MS. The stacks it sees are written per endpoint
+to ``PROFILE_DIR/<endpoint>.folded``, one ``frame;frame;frame count`` line per
+stack, the input of flamegraph.pl and speedscope. At 0, the default, the
+profiler thread is never started and a request only pays for one comparison.
+"""
+import bisect
+import collections
+import itertools
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+from flask import Response, request
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+# defaults used when a setting is missing from the config file
+DEFAULTS = {
+    'METRICS': True,
+    'N_PLUS_ONE_THRESHOLD': 10,
+    'PROFILE_SAMPLE_RATE': 0,
+    'PROFILE_INTERVAL_MS': 5,
+    'PROFILE_DIR': 'profiles',
+}
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+
+def setting(config, name):
+    """Return an instrumentation setting from config, or its default."""
+    return config.get(name, DEFAULTS[name])
+
+
+class Counter():
+    """Prometheus counter with labels."""
+
+    kind = 'counter'
+
+    def __init__(self, name, description):
+        """Create counter without any value."""
+        self.name = name
+        self.description = description
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        """Add amount to the counter of labels, a tuple of (name, value) pairs."""
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        """Yield (name, labels, value) of every sample."""
+        with self._lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            yield self.name, labels, value
+
+
+class Histogram():
+    """Prometheus histogram with labels."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets):
+        """Create histogram with the given bucket upper bounds."""
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        """Record a value for labels, a tuple of (name, value) pairs."""
+        # only the first bucket holding the value is counted, render adds them up
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 3)
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self):
+        """Yield (name, labels, value) of every sample, buckets are cumulative."""
+        with self._lock:
+            values = [(labels, list(counts)) for labels, counts in self.values.items()]
+        for labels, counts in values:
+            for bound, count in zip(self.buckets, itertools.accumulate(counts)):
+                yield f'{self.name}_bucket', labels + (('le', str(bound)),), count
+            yield f'{self.name}_bucket', labels + (('le', '+Inf'),), counts[-1]
+            yield f'{self.name}_sum', labels, counts[-2]
+            yield f'{self.name}_count', labels, counts[-1]
+
+
+class Gauge():
+    """Prometheus gauge without labels, read when the metrics are rendered."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, description, read):
+        """Create gauge whose value is returned by read(), None when unknown."""
+        self.name = name
+        self.description = description
+        self.read = read
+
+    def samples(self):
+        """Yield (name, labels, value) of the current value, if known."""
+        value = self.read()
+        if value is not None:
+            yield self.name, (), value
+
+
+class Registry():
+    """Metrics of one app."""
+
+    def __init__(self):
+        """Create the metrics reported at /metrics."""
+        self.requests = Counter('banking_http_requests_total',
+                                'Requests by route, method and status.')
+        self.latency = Histogram('banking_http_request_seconds',
+                                 'Request time by route.', LATENCY_BUCKETS)
+        self.sql_time = Histogram('banking_http_request_sql_seconds',
+                                  'Time in SQL statements per request, by route.',
+                                  LATENCY_BUCKETS)
+        self.sql_per_request = Histogram('banking_http_request_sql_statements',
+                                         'SQL statements per request, by route.',
+                                         STATEMENT_BUCKETS)
+        self.statements = Counter('banking_sql_statements_total',
+                                  'SQL statements by route, background outside requests.')
+        self.statement_seconds = Counter('banking_sql_seconds_total',
+                                         'Time in SQL statements by route.')
+        self.n_plus_one = Counter('banking_n_plus_one_total',
+                                  'Requests repeating one statement N_PLUS_ONE_THRESHOLD '
+                                  'times or more, by route.')
+        self.metrics = [self.requests, self.latency, self.sql_time, self.sql_per_request,
+                        self.statements, self.statement_seconds, self.n_plus_one]
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+                lines.append(f'{name}{{{label_text}}} {value:g}' if labels
+                             else f'{name} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    """Escape a label value for the Prometheus text format."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# labels of SQL statements run outside requests, by the queue writer or jobs
+BACKGROUND = (('route', 'background'),)
+
+# stats of the request served by each thread, SQL events run in the same thread
+current = threading.local()
+
+# placeholders of expanded IN lists, so one statement is one pattern whatever its size
+IN_LIST = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)')
+
+
+class RequestStats():
+    """Start time and SQL statements of one request."""
+
+    def __init__(self, route):
+        """Start timing a request for route."""
+        self.route = route
+        self.start = time.perf_counter()
+        self.profiled = False
+        self.count = 0
+        self.seconds = 0
+        self.patterns = collections.Counter()
+
+    def add(self, statement, seconds):
+        """Record one statement and its time."""
+        self.count += 1
+        self.seconds += seconds
+        self.patterns[IN_LIST.sub('(?)', statement)] += 1
+
+    def repeated(self, threshold):
+        """Return (statement, count) of statements run at least threshold times."""
+        return [(s, n) for s, n in self.patterns.most_common() if n >= threshold]
+
+
+class Profiler():
+    """Sampling profiler of the threads serving selected requests.
+
+    One daemon thread wakes up every interval and records the stack of each
+    thread registered with start(), counted per endpoint.
+    """
+
+    def __init__(self, interval):
+        """Create profiler sampling every interval seconds, started on first use."""
+        self.interval = interval
+        self.active = {}
+        self.stacks = {}
+        self._lock = threading.Lock()
+        self._sampling = threading.Event()
+        self._dumped = {}
+        self._thread = None
+
+    def start(self, thread_id, endpoint):
+        """Sample thread until stop(), counting its stacks under endpoint."""
+        with self._lock:
+            self.active[thread_id] = (endpoint, collections.Counter())
+            self._sampling.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profiler',
+                                                daemon=True)
+                self._thread.start()
+
+    def stop(self, thread_id):
+        """Stop sampling thread, return (endpoint, stack counts) of its request."""
+        with self._lock:
+            endpoint, stacks = self.active.pop(thread_id)
+            self.stacks.setdefault(endpoint, collections.Counter()).update(stacks)
+            if not self.active:
+                self._sampling.clear()
+        return endpoint, stacks
+
+    def _run(self):
+        """Record the stacks of active threads every interval, sleep while none."""
+        while True:
+            self._sampling.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                frames = sys._current_frames()
+                for thread_id, (_, stacks) in self.active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[_fold(frame)] += 1
+
+    def dump(self, directory, endpoint, every=1):
+        """Write all stacks counted for endpoint to its folded file.
+
+        The file is rewritten at most once per ``every`` seconds.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now - self._dumped.get(endpoint, -every) < every:
+                return
+            self._dumped[endpoint] = now
+            stacks = list(self.stacks.get(endpoint, {}).items())
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f'{endpoint}.folded'), 'w') as folded_file:
+            for stack, count in sorted(stacks):
+                folded_file.write(f'{stack} {count}\n')
+
+
+def _fold(frame):
+    """Return a stack as ``outermost;...;innermost`` function names."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def init_metrics(app, engine):
+    """Register request hooks, SQL events and /metrics, unless METRICS is off."""
+    if not setting(app.config, 'METRICS'):
+        return
+
+    registry = Registry()
+    profiler = Profiler(setting(app.config, 'PROFILE_INTERVAL_MS') / 1000)
+    app.extensions['metrics'] = registry
+    app.extensions['profiler'] = profiler
+
+    @app.before_request
+    def start_request():
+        stats = current.stats = RequestStats(_route())
+        rate = app.config.get('PROFILE_SAMPLE_RATE', 0)
+        if rate and random.random() < rate:
+            stats.profiled = True
+            profiler.start(threading.get_ident(), request.endpoint or 'unknown')
+
+    @app.after_request
+    def finish_request(response):
+        stats = getattr(current, 'stats', None)
+        if stats is None:
+            return response
+        current.stats = None
+        elapsed = time.perf_counter() - stats.start
+        route = (('route', stats.route),)
+
+        registry.requests.inc(route + (('method', request.method),
+                                       ('status', str(response.status_code))))
+        registry.latency.observe(route, elapsed)
+        registry.sql_time.observe(route, stats.seconds)
+        registry.sql_per_request.observe(route, stats.count)
+        if stats.count:
+            registry.statements.inc(route, stats.count)
+            registry.statement_seconds.inc(route, stats.seconds)
+
+        repeated = stats.repeated(setting(app.config, 'N_PLUS_ONE_THRESHOLD'))
+        if repeated:
+            registry.n_plus_one.inc(route)
+            statement, count = repeated[0]
+            log.warning('possible N+1 queries in %s %s: %d x %s',
+                        request.method, request.path, count, statement)
+
+        if stats.profiled:
+            endpoint, _ = profiler.stop(threading.get_ident())
+            profiler.dump(setting(app.config, 'PROFILE_DIR'), endpoint)
+        return response
+
+    @app.teardown_request
+    def clear_request(error):
+        # after_request is skipped when an earlier after_request function fails
+        stats = getattr(current, 'stats', None)
+        if stats is not None:
+            current.stats = None
+            if stats.profiled:
+                profiler.stop(threading.get_ident())
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('statement_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def finish_statement(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['statement_start'].pop()
+        stats = getattr(current, 'stats', None)
+        if stats is not None:
+            stats.add(statement, elapsed)
+        else:
+            registry.statements.inc(BACKGROUND)
+            registry.statement_seconds.inc(BACKGROUND, elapsed)
+
+    @event.listens_for(engine, 'handle_error')
+    def fail_statement(context):
+        # a failed statement never reaches after_cursor_execute
+        if context.connection is not None and context.cursor is not None:
+            starts = context.connection.info.get('statement_start')
+            if starts:
+                starts.pop()
+
+    @app.route('/metrics')
+    def metrics():
+        """Show metrics in the Prometheus text format."""
+        return Response(registry.render(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def _route():
+    """Return the URL rule of the current request, which keeps label values few."""
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
@@ -0,0 +1,307 @@
+"""Bring existing banking API databases up to date with the data models.
+
+``db.create_all()`` only creates missing tables, so changes to existing tables
+(new indexes, new column types, times moved from local time to UTC) are applied
+here. Run with::
+
+    python -m banking_api.migrations [config.py]
+"""
+import sys
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateTable
+
+from banking_api.model import (db, Account, AccountStats, BalanceSnapshot, Customer,
+                               LedgerEntry, ShardRange, Transaction, TransferJournal)
+
+CHUNK_SIZE = 50000
+
+
+class MigrationError(Exception):
+    """Raised when a migration cannot complete or fails its checks."""
+
+
+def create_indexes(connection):
+    """Create every non-unique index declared on the models that is missing.
+
+    Unique indexes are created by the migrations that first check the rows
+    satisfy them, such as unique_customers.
+    """
+    with connection.begin():
+        for table in db.metadata.sorted_tables:
+            if not inspect(connection).has_table(table.name):
+                continue
+            for index in table.indexes:
+                if not index.unique:
+                    index.create(connection, checkfirst=True)
+
+
+def money_to_cents(connection, chunk_size=CHUNK_SIZE):
+    """Rewrite float balances and amounts as integer cents.
+
+    SQLite cannot change a column type in place, so each table is renamed,
+    recreated from the model and copied back in chunks of ``chunk_size`` rows,
+    each chunk in its own transaction. Rows keep their rowid, so an interrupted
+    run continues after the last copied chunk. Before the old table is dropped
+    the row count and the exact SUM() of cents are reconciled in SQL.
+    """
+    if connection.dialect.name != 'sqlite':
+        raise MigrationError('money_to_cents only supports SQLite databases, '
+                             'create other databases from the models')
+
+    for table, column in ((Account.__table__, 'balance'),
+                          (Transaction.__table__, 'amount')):
+        old = f'_{table.name}_float'
+        with connection.begin():
+            if old not in inspect(connection).get_table_names():
+                declared = {c['name']: c['type'] for c in
+                            inspect(connection).get_columns(table.name)}
+                if 'INT' in str(declared[column]).upper():
+                    continue
+                _rename(connection, table, old)
+            if not inspect(connection).has_table(table.name):
+                connection.execute(CreateTable(table))
+
+        _copy_rows(connection, table, old,
+                   {column: f'CAST(ROUND({column} * 100) AS INTEGER)'}, chunk_size)
+
+        with connection.begin():
+            problems = reconcile_copy(connection, old, table.name, column)
+            if problems:
+                raise MigrationError(f'{table.name} not migrated, {old} kept: '
+                                     + '; '.join(problems))
+            _drop(connection, table, old)
+
+
+def _rename(connection, table, old):
+    """Rename table to old, to copy it back once recreated from its model."""
+    connection.execute(text(f'ALTER TABLE "{table.name}" RENAME TO "{old}"'))
+    # indexes follow the renamed table, free their names
+    for index in table.indexes:
+        connection.execute(text(f'DROP INDEX IF EXISTS "{index.name}"'))
+
+
+def _copy_rows(connection, table, old, converted, chunk_size):
+    """Copy rows of old into table in chunks, columns of converted through SQL.
+
+    Rows keep their rowid, so copying again continues after the last chunk.
+    """
+    columns = [c.name for c in table.columns]
+    names = ', '.join(f'"{c}"' for c in ['rowid'] + columns)
+    values = ', '.join(['rowid'] + [converted.get(c, c) for c in columns])
+    while True:
+        with connection.begin():
+            last = connection.execute(text(
+                f'SELECT COALESCE(MAX(rowid), 0) FROM "{table.name}"')).scalar()
+            copied = connection.execute(text(
+                f'INSERT INTO "{table.name}" ({names}) SELECT {values} '
+                f'FROM "{old}" WHERE rowid > :last ORDER BY rowid LIMIT :n'),
+                {'last': last, 'n': chunk_size}).rowcount
+        if copied < chunk_size:
+            return
+
+
+def _drop(connection, table, old):
+    """Drop the old copy of a table and index the new one."""
+    connection.execute(text(f'DROP TABLE "{old}"'))
+    for index in table.indexes:
+        index.create(connection)
+
+
+def reconcile_copy(connection, old, new, column):
+    """Compare row count and exact SUM() of a float column and its cents copy."""
+    old_count, old_sum = connection.execute(text(
+        f'SELECT COUNT(*), COALESCE(SUM(CAST(ROUND({column} * 100) AS INTEGER)), 0) '
+        f'FROM "{old}"')).one()
+    new_count, new_sum = connection.execute(text(
+        f'SELECT COUNT(*), COALESCE(SUM({column}), 0) FROM "{new}"')).one()
+
+    problems = []
+    if old_count != new_count:
+        problems.append(f'{old_count} rows before, {new_count} after')
+    if old_sum != new_sum:
+        problems.append(f'total {column} {old_sum} cents before, {new_sum} after')
+    return problems
+
+
+def reconcile(connection):
+    """Check money columns hold whole cents and return their exact totals.
+
+    Everything is computed with integer SUM() in SQL, returns a dict of
+    totals and a list of problems (empty when the data reconciles).
+    """
+    checks = {
+        'total_balance': 'SELECT COALESCE(SUM(balance), 0) FROM account',
+        'total_transferred': 'SELECT COALESCE(SUM(amount), 0) FROM "transaction"',
+        'fractional_balances': 'SELECT COUNT(*) FROM account '
+                               'WHERE balance != CAST(balance AS INTEGER)',
+        'fractional_amounts': 'SELECT COUNT(*) FROM "transaction" '
+                              'WHERE amount != CAST(amount AS INTEGER)',
+        'non_positive_amounts': 'SELECT COUNT(*) FROM "transaction" '
+                                'WHERE amount <= 0',
+    }
+    totals = {name: connection.execute(text(sql)).scalar()
+              for name, sql in checks.items()}
+
+    problems = [f'{totals[name]} {name.replace("_", " ")}'
+                for name in ('fractional_balances', 'fractional_amounts',
+                             'non_positive_amounts') if totals[name]]
+    return totals, problems
+
+
+def unique_customers(connection):
+    """Add unique (identification, name) index on customers.
+
+    Duplicate customers cannot be merged automatically since accounts refer to
+    them, so the migration stops and lists them if there are any.
+    """
+    duplicates = connection.execute(text(
+        'SELECT identification, name, COUNT(*) FROM customer '
+        'GROUP BY identification, name HAVING COUNT(*) > 1')).fetchall()
+    if duplicates:
+        raise MigrationError('merge duplicate customers before upgrading: ' + ', '.join(
+            f'{name} ({identification}) x{count}'
+            for identification, name, count in duplicates))
+
+    with connection.begin():
+        for index in Customer.__table__.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def _local_to_utc(column):
+    """Return SQL converting local time text of str(datetime.now()) to UTC text.
+
+    The text is rewritten as written for DateTime columns, with microseconds,
+    and is NULL when it is not a time.
+    """
+    return (f"strftime('%Y-%m-%d %H:%M:%S', {column}, 'utc') "
+            f"|| substr({column} || '.000000', 20, 7)")
+
+
+def utc_timestamps(connection, chunk_size=CHUNK_SIZE):
+    """Rewrite times of transfers, written in local time as text, as UTC datetimes.
+
+    Transaction and journal timestamps, the last activity of statistics, the
+    times of ledger entries and snapshots and the creation times of journal
+    entries and shard ranges are converted with the time zone of the machine
+    running the migration, which must be the one the API ran in. Each table
+    is rebuilt and copied in chunks as by money_to_cents, and recorded as done
+    in migration_step once its copy is checked, so an interrupted run neither
+    stops half way through a table nor converts a table twice.
+    """
+    if connection.dialect.name != 'sqlite':
+        raise MigrationError('utc_timestamps only supports SQLite databases, '
+                             'create other databases from the models')
+
+    for table, columns in ((Transaction.__table__, ('transaction_timestamp',)),
+                           (TransferJournal.__table__,
+                            ('transaction_timestamp', 'created_at')),
+                           (AccountStats.__table__, ('last_activity',)),
+                           (LedgerEntry.__table__, ('created_at',)),
+                           (BalanceSnapshot.__table__, ('created_at',)),
+                           (ShardRange.__table__, ('created_at',))):
+        old = f'_{table.name}_local'
+        step = f'utc_timestamps {table.name}'
+        converted = {column: _local_to_utc(column) for column in columns}
+        with connection.begin():
+            if old not in inspect(connection).get_table_names():
+                if (not inspect(connection).has_table(table.name)
+                        or _step_done(connection, step)):
+                    continue
+                bad = connection.execute(text(
+                    f'SELECT COUNT(*) FROM "{table.name}" WHERE ' + ' OR '.join(
+                        f'({c} IS NOT NULL AND ({converted[c]} IS NULL '
+                        f'OR length({c}) NOT IN (19, 26)))' for c in columns)
+                )).scalar()
+                if bad:
+                    raise MigrationError(f'{table.name} not migrated, {bad} rows '
+                                         f'without a local time in {", ".join(columns)}')
+                _rename(connection, table, old)
+            if not inspect(connection).has_table(table.name):
+                connection.execute(CreateTable(table))
+
+        _copy_rows(connection, table, old, converted, chunk_size)
+
+        with connection.begin():
+            old_count, new_count = (connection.execute(text(
+                f'SELECT COUNT(*) FROM "{name}"')).scalar() for name in (old, table.name))
+            if old_count != new_count:
+                raise MigrationError(f'{table.name} not migrated, {old} kept: '
+                                     f'{old_count} rows before, {new_count} after')
+            _drop(connection, table, old)
+            connection.execute(text('INSERT INTO migration_step (name) VALUES (:name)'),
+                               {'name': step})
+
+
+def _step_done(connection, step):
+    """Return True if a step of a migration is recorded as done."""
+    connection.execute(text('CREATE TABLE IF NOT EXISTS migration_step '
+                            '(name VARCHAR(100) NOT NULL PRIMARY KEY)'))
+    return connection.execute(text('SELECT 1 FROM migration_step WHERE name = :name'),
+                              {'name': step}).first() is not None
+
+
+# applied in order, the position in this list is the schema version
+MIGRATIONS = [
+    create_indexes,
+    money_to_cents,
+    unique_customers,
+    utc_timestamps,
+]
+
+
+def current_version(connection):
+    """Return schema version recorded in database, None if never recorded."""
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'))
+    return connection.execute(text('SELECT version FROM schema_version')).scalar()
+
+
+def set_version(connection, version):
+    """Record schema version in database."""
+    connection.execute(text('DELETE FROM schema_version'))
+    connection.execute(text('INSERT INTO schema_version (version) VALUES (:v)'),
+                       {'v': version})
+
+
+def upgrade(engine):
+    """Apply pending migrations and create missing tables, return applied names."""
+    with engine.begin() as connection:
+        version = current_version(connection)
+        if version is None:
+            # a database without tables is created from the models directly
+            fresh = not inspect(connection).has_table('account')
+            version = len(MIGRATIONS) if fresh else 0
+            set_version(connection, version)
+
+    applied = []
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        # each migration manages its own transactions so large ones can commit
+        # in chunks, the version is only bumped once it has completed
+        with engine.connect() as connection:
+            migration(connection)
+        with engine.begin() as connection:
+            set_version(connection, number)
+        applied.append(migration.__name__)
+
+    db.metadata.create_all(engine)
+    return applied
+
+
+if __name__ == '__main__':
+    from banking_api import create_app
+    from banking_api.sharding import upgrade_shards
+
+    app = create_app(sys.argv[1] if len(sys.argv) > 1 else 'config.py')
+    with app.app_context():
+        for name in upgrade(db.engine):
+            print(f'applied {name}')
+        upgrade_shards(app)
+        print('database up to date')
+
+        with db.engine.connect() as connection:
+            totals, problems = reconcile(connection)
+        print(', '.join(f'{name}: {value}' for name, value in totals.items()))
+        for problem in problems:
+            print(f'RECONCILIATION FAILED: {problem}')
+        sys.exit(1 if problems else 0)
@@ -1,12 +1,104 @@
 """Script contains data models used in API database."""
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
 from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
 
+# largest amount in cents, balances and sums of amounts stay within 64 bits
+MAX_CENTS = 10 ** 15
+
+
+def to_cents(amount):
+    """Convert an amount in currency units (e.g. 10.5) to integer cents (1050).
+
+    Only JSON numbers are accepted, as sent to the API. Use parse_cents for
+    amounts read from text.
+    """
+    if isinstance(amount, bool) or not isinstance(amount, (int, float)):
+        raise ValueError('amount must be a number')
+    return _decimal_cents(str(amount))
+
+
+def parse_cents(amount):
+    """Convert an amount in currency units read from a file or setting to cents."""
+    if isinstance(amount, bool) or not isinstance(amount, (int, float, str, Decimal)):
+        raise ValueError('amount must be a number')
+    return _decimal_cents(str(amount).strip())
+
+
+def _decimal_cents(text):
+    """Convert the text of an amount in currency units to integer cents."""
+    try:
+        cents = Decimal(text) * 100
+    except InvalidOperation:
+        raise ValueError('amount must be a number')
+    if not cents.is_finite():
+        raise ValueError('amount must be a number')
+    if cents != cents.to_integral_value():
+        raise ValueError('amount must not have more than 2 decimal places')
+    if abs(cents) > MAX_CENTS:
+        raise ValueError(f'amount must not exceed {MAX_CENTS // 100}')
+    return int(cents)
+
+
+def from_cents(cents):
+    """Convert integer cents (1050) to an amount in currency units (10.5)."""
+    return cents / 100
+
+
+def utc_now():
+    """Return the current time in UTC, as the naive datetime stored in the database."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def to_utc(value):
+    """Parse an ISO 8601 time to a naive UTC datetime, naive times are taken as UTC."""
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{value!r} is not an ISO 8601 date and time')
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def from_utc(timestamp):
+    """Format a naive UTC datetime as returned by the API (2021-01-31 09:30:00.000000)."""
+    return timestamp.isoformat(sep=' ', timespec='microseconds')
+
+
+class Cents(db.TypeDecorator):
+    """Money column stored as an integer number of cents.
+
+    Values are plain ints on the Python side, use to_cents and from_cents to
+    convert at the API boundary.
+    """
+
+    impl = db.BigInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        """Refuse floats so amounts are never silently rounded."""
+        if value is not None and (isinstance(value, (bool, float))
+                                  or not isinstance(value, (int, Decimal))):
+            raise TypeError(f'expected integer cents, got {value!r}')
+        return None if value is None else int(value)
+
+    def process_result_value(self, value, dialect):
+        """Return integer cents."""
+        return None if value is None else int(value)
+
 
 class Customer(db.Model):
     """Create Customer class data model."""
 
+    # customers are looked up, and must be unique, by identification and name
+    __table_args__ = (
+        db.Index('ix_customer_identification_name',
+                 'identification', 'name', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True, nullable=False)
     name = db.Column(db.String(50), nullable=False)
     identification = db.Column(db.String(20), nullable=False)
@@ -17,7 +109,7 @@ class Account(db.Model):
     """Create Account class data model."""
 
     id = db.Column(db.Integer, primary_key=True, nullable=False)
-    balance = db.Column(db.Float, nullable=False)
+    balance = db.Column(Cents, nullable=False)
     customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'),
                             nullable=False)
 
@@ -25,8 +117,217 @@ class Account(db.Model):
 class Transaction(db.Model):
     """Create Transaction class data model."""
 
+    # history lookups filter on either account and page through by timestamp,
+    # time range lookups over all accounts on the timestamp alone
+    __table_args__ = (
+        db.Index('ix_transaction_from_timestamp',
+                 'account_id_from', 'transaction_timestamp'),
+        db.Index('ix_transaction_to_timestamp',
+                 'account_id_to', 'transaction_timestamp'),
+        db.Index('ix_transaction_timestamp', 'transaction_timestamp', 'uuid'),
+    )
+
+    uuid = db.Column(db.String(80), primary_key=True, nullable=False)
+    account_id_from = db.Column(db.Integer, nullable=False)
+    account_id_to = db.Column(db.Integer, nullable=False)
+    amount = db.Column(Cents, nullable=False)
+    # UTC
+    transaction_timestamp = db.Column(db.DateTime, nullable=False)
+
+
+class ImportCheckpoint(db.Model):
+    """Create ImportCheckpoint class data model recording progress of bulk imports."""
+
+    source = db.Column(db.String(500), primary_key=True, nullable=False)
+    kind = db.Column(db.String(20), primary_key=True, nullable=False)
+    records_done = db.Column(db.Integer, nullable=False)
+    imported = db.Column(db.Integer, nullable=False)
+    rejected = db.Column(db.Integer, nullable=False)
+
+
+class LedgerEntry(db.Model):
+    """Create LedgerEntry class data model, one debit or credit of an account.
+
+    Entries are only ever appended. A transfer writes a debit (negative
+    amount) and a credit, an account opening writes its deposit as a credit
+    without a transaction, so the entries of an account add up to its balance.
+    """
+
+    __table_args__ = (
+        db.Index('ix_ledger_entry_account_id', 'account_id', 'created_at'),
+        db.Index('ix_ledger_entry_transaction_uuid', 'transaction_uuid'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+    account_id = db.Column(db.Integer, nullable=False)
+    transaction_uuid = db.Column(db.String(80), nullable=True)
+    amount = db.Column(Cents, nullable=False)
+    # UTC, the time of the transaction for transfers
+    created_at = db.Column(db.DateTime, nullable=False)
+
+
+class BalanceSnapshot(db.Model):
+    """Create BalanceSnapshot class data model, balance of an account at a time.
+
+    ``balance`` is the sum of the ledger entries of the account created up to
+    and including ``created_at``.
+    """
+
+    __table_args__ = (
+        db.Index('ix_balance_snapshot_account_id', 'account_id', 'created_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+    account_id = db.Column(db.Integer, nullable=False)
+    balance = db.Column(Cents, nullable=False)
+    # UTC
+    created_at = db.Column(db.DateTime, nullable=False)
+    verified = db.Column(db.Boolean, nullable=False, default=False)
+
+
+class AccountSequence(db.Model):
+    """Create AccountSequence class data model, ids handed out to sharded accounts.
+
+    With sharding the accounts live in several databases, so their ids are
+    taken from this table in the main database to be unique across shards.
+    """
+
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+
+
+class ShardRange(db.Model):
+    """Create ShardRange class data model, a range of account ids moved to a shard.
+
+    Ranges are written by the rebalancing tool in the main database and
+    override the default placement of accounts, the latest range holding an
+    account id wins. While a range is being copied (state ``copying``) its
+    accounts are still served by their previous shard and refuse writes, from
+    ``copied`` on they are served by ``shard``.
+    """
+
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+    first_id = db.Column(db.Integer, nullable=False)
+    last_id = db.Column(db.Integer, nullable=False)
+    shard = db.Column(db.Integer, nullable=False)
+    # copying, copied (served by shard, old copies not deleted yet) or done
+    state = db.Column(db.String(20), nullable=False)
+    # UTC
+    created_at = db.Column(db.DateTime, nullable=False)
+
+
+class TransferJournal(db.Model):
+    """Create TransferJournal class data model, one side of a cross-shard transfer.
+
+    The shard of the paying account (the coordinator) and the shard of the
+    receiving account (the participant) each keep a row per transfer, the
+    participant's written when it prepares, the coordinator's in the same
+    commit as the debit, which is the commit point of the transfer.
+    """
+
+    __table_args__ = (
+        db.Index('ix_transfer_journal_state', 'state', 'created_at'),
+    )
+
     uuid = db.Column(db.String(80), primary_key=True, nullable=False)
+    # coordinator or participant
+    role = db.Column(db.String(20), nullable=False)
+    peer_shard = db.Column(db.Integer, nullable=False)
+    account_id_from = db.Column(db.Integer, nullable=False)
+    account_id_to = db.Column(db.Integer, nullable=False)
+    amount = db.Column(Cents, nullable=False)
+    transaction_timestamp = db.Column(db.DateTime, nullable=False)
+    # prepared, committed or aborted
+    state = db.Column(db.String(20), nullable=False)
+    # UTC
+    created_at = db.Column(db.DateTime, nullable=False)
+
+
+class AccountStats(db.Model):
+    """Create AccountStats class data model, transfer totals of an account.
+
+    Kept up to date in the commit of every transfer, so a summary is read
+    from one row instead of the whole history. Opening deposits are not
+    transfers and are not counted.
+    """
+
+    account_id = db.Column(db.Integer, primary_key=True, nullable=False)
+    total_in = db.Column(Cents, nullable=False, default=0)
+    total_out = db.Column(Cents, nullable=False, default=0)
+    transfer_count = db.Column(db.Integer, nullable=False, default=0)
+    last_activity = db.Column(db.DateTime, nullable=True)
+
+
+class TransferEvent(db.Model):
+    """Create TransferEvent class data model, the outbox of committed transfers.
+
+    An event is appended in the commit of every transfer, ``seq`` numbers the
+    events in commit order and is never handed out twice, not even once the
+    latest events are compacted.
+    """
+
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    seq = db.Column(db.Integer, primary_key=True, nullable=False)
+    transaction_uuid = db.Column(db.String(80), nullable=False)
     account_id_from = db.Column(db.Integer, nullable=False)
     account_id_to = db.Column(db.Integer, nullable=False)
-    amount = db.Column(db.Float, nullable=False)
-    transaction_timestamp = db.Column(db.String(50), nullable=False)
+    amount = db.Column(Cents, nullable=False)
+    # UTC
+    transaction_timestamp = db.Column(db.DateTime, nullable=False)
+
+
+class EventConsumer(db.Model):
+    """Create EventConsumer class data model, how far a consumer read the events.
+
+    ``position`` is the seq of the last event the consumer has handled, the
+    outbox keeps every event after the lowest position.
+    """
+
+    name = db.Column(db.String(100), primary_key=True, nullable=False)
+    position = db.Column(db.Integer, nullable=False)
+    # UTC
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+
+class ArchiveSegment(db.Model):
+    """Create ArchiveSegment class data model, a file of archived transactions.
+
+    A segment holds transactions of one month moved out of the transaction
+    table. It is recorded before its rows are deleted from the table (state
+    ``deleting``), and is ``done`` once they all are.
+    """
+
+    __table_args__ = (
+        db.Index('ix_archive_segment_timestamps', 'last_timestamp', 'first_timestamp'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+    month = db.Column(db.String(7), nullable=False)
+    # relative to ARCHIVE_DIR
+    path = db.Column(db.String(500), nullable=False, unique=True)
+    # UTC
+    first_timestamp = db.Column(db.DateTime, nullable=False)
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+    transactions = db.Column(db.Integer, nullable=False)
+    # deleting or done
+    state = db.Column(db.String(20), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+
+class ArchivedStats(db.Model):
+    """Create ArchivedStats class data model, totals carried forward from the archive.
+
+    The same totals as AccountStats, of the transfers of an account moved to
+    archive segments. ``last_activity`` tells whether a history request
+    reaches into the archive.
+    """
+
+    account_id = db.Column(db.Integer, primary_key=True, nullable=False)
+    total_in = db.Column(Cents, nullable=False, default=0)
+    total_out = db.Column(Cents, nullable=False, default=0)
+    transfer_count = db.Column(db.Integer, nullable=False, default=0)
+    last_activity = db.Column(db.DateTime, nullable=True)
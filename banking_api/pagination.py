@@ -0,0 +1,57 @@
+"""Helpers for keyset pagination and streamed JSON responses."""
+import base64
+import json
+
+from flask import Response, stream_with_context
+
+from banking_api.serializers import encode_chunks
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(values):
+    """Encode the sort key of the last row of a page as an opaque cursor."""
+    raw = json.dumps(list(values), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, types):
+    """Decode a cursor created by encode_cursor, raise ValueError if invalid.
+
+    ``types`` are the types of the values of the sort key, in order.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError) as error:
+        raise ValueError(f'invalid cursor {cursor!r}') from error
+
+    if not isinstance(values, list) or len(values) != len(types) or not all(
+            isinstance(value, kind) and not isinstance(value, bool)
+            for value, kind in zip(values, types)):
+        raise ValueError(f'invalid cursor {cursor!r}')
+    return values
+
+
+def parse_limit(value):
+    """Parse page size from a query argument, raise ValueError if invalid."""
+    if value is None:
+        return DEFAULT_PAGE_SIZE
+    try:
+        limit = int(value)
+    except ValueError:
+        limit = 0
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError(f'limit must be an integer between 1 and {MAX_PAGE_SIZE}')
+    return limit
+
+
+def stream_json(key, items):
+    """Stream an iterable of dicts as {key: [...]} without building the list."""
+    def generate():
+        yield b'{"%s":[' % key.encode()
+        yield from encode_chunks(items)
+        yield b']}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
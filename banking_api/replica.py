@@ -0,0 +1,240 @@
+"""Reads of account data served by a read replica of the main database.
+
+With READ_REPLICA_URI set, the GET routes of balances, histories, customers
+and summaries read from a second engine, so they no longer share connections
+and locks with transfers. Writes always go to the main database. The replica
+is either a copy kept up to date by replication, or the main SQLite file
+itself: in WAL mode its readers never wait for the writer. Replica
+connections are opened with ``PRAGMA query_only`` on SQLite, so nothing can
+be written through them.
+
+A replica lags behind the main database, so:
+
+- a client that wrote (any successful POST, PUT or DELETE) gets a cookie
+  sending its reads to the main database for READ_AFTER_WRITE_SECONDS, and
+  sees its own writes,
+- the lag is measured at most every READ_REPLICA_LAG_CHECK seconds from the
+  transfer events, as the age of the oldest event missing on the replica,
+  and reads go to the main database while it is above READ_REPLICA_MAX_LAG.
+  Writes other than transfers are not measured.
+
+The lag is reported at ``GET /replica/stats`` and in ``/metrics``. For local
+testing ``python -m banking_api.replica sync`` stands in for replication
+between two SQLite files, copying the main database over the replica every
+``--interval`` seconds.
+"""
+import argparse
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+from flask import current_app, request
+from sqlalchemy import DateTime, create_engine, event, text
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from banking_api.database import absolute_uri, engine_options, configure_engine
+from banking_api.metrics import Gauge
+from banking_api.model import db, utc_now
+
+log = logging.getLogger(__name__)
+
+# defaults used when a setting is missing from the config file
+DEFAULTS = {
+    'READ_REPLICA_URI': None,
+    'READ_AFTER_WRITE_SECONDS': 5,
+    'READ_REPLICA_MAX_LAG': 5,
+    'READ_REPLICA_LAG_CHECK': 1,
+}
+
+# cookie holding the time until which a client reads from the main database
+STICKY_COOKIE = 'read_primary_until'
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+# key of the WSGI environ remembering where a request reads
+READ_TARGET = 'banking_api.read_target'
+
+LAST_EVENT = text('SELECT MAX(seq) FROM transfer_event')
+FIRST_EVENT_AFTER = text('''
+    SELECT transaction_timestamp FROM transfer_event
+    WHERE seq > :seq ORDER BY seq LIMIT 1''').columns(transaction_timestamp=DateTime)
+
+
+def setting(config, name):
+    """Return a read replica setting from config, or its default."""
+    return config.get(name, DEFAULTS[name])
+
+
+class ReadReplica():
+    """Session of the read replica, and its lag behind the main database."""
+
+    def __init__(self, uri, config, root_path):
+        """Open the replica engine, SQLite paths relative to root_path."""
+        uri = absolute_uri(uri, root_path)
+        self.engine = create_engine(
+            uri, **engine_options(dict(config, SQLALCHEMY_DATABASE_URI=uri)))
+        configure_engine(self.engine, config)
+        if self.engine.dialect.name == 'sqlite':
+            event.listen(self.engine, 'connect', _query_only)
+        self.session = scoped_session(sessionmaker(bind=self.engine))
+        self.max_lag = setting(config, 'READ_REPLICA_MAX_LAG')
+        self.check_every = setting(config, 'READ_REPLICA_LAG_CHECK')
+        # reads served by the replica, by the main database after a write of
+        # the client and while the replica lags
+        self.reads = {'replica': 0, 'sticky': 0, 'lagging': 0}
+        self._lag = (0, 0)
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def lag(self):
+        """Return (seconds, events) the replica is behind, None when it cannot be read.
+
+        The lag is measured at most every READ_REPLICA_LAG_CHECK seconds.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._checked is not None and now - self._checked < self.check_every:
+                return self._lag
+            self._checked = now
+        try:
+            lag = self._measure()
+        except Exception:
+            log.exception('measuring the read replica lag failed')
+            lag = (None, None)
+        with self._lock:
+            self._lag = lag
+        return lag
+
+    def _measure(self):
+        """Return (seconds, events) the replica is behind the main database now."""
+        with self.engine.connect() as replica:
+            seen = replica.execute(LAST_EVENT).scalar() or 0
+        with db.engine.connect() as primary:
+            last = primary.execute(LAST_EVENT).scalar() or 0
+            missing = primary.execute(FIRST_EVENT_AFTER, {'seq': seen}).scalar()
+        if missing is None:
+            return 0, 0
+        return max(0, (utc_now() - missing).total_seconds()), last - seen
+
+    def route(self):
+        """Return where the current request reads: replica, sticky or lagging."""
+        try:
+            sticky = float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+        except ValueError:
+            sticky = False
+        seconds = None if sticky else self.lag()[0]
+        if sticky:
+            target = 'sticky'
+        elif seconds is None or seconds > self.max_lag:
+            target = 'lagging'
+        else:
+            target = 'replica'
+        with self._lock:
+            self.reads[target] += 1
+        return target
+
+    def stats(self):
+        """Return lag and read counters."""
+        seconds, events = self.lag()
+        with self._lock:
+            reads = dict(self.reads)
+        return dict(reads, lag_seconds=seconds, lag_events=events)
+
+
+def _query_only(dbapi_connection, connection_record):
+    """Refuse writes on a replica connection."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA query_only = 1')
+    cursor.close()
+
+
+def init_replica(app):
+    """Open the read replica when READ_REPLICA_URI is set."""
+    uri = setting(app.config, 'READ_REPLICA_URI')
+    if not uri:
+        return
+    if app.config.get('SHARD_URIS'):
+        raise ValueError('READ_REPLICA_URI is not supported with SHARD_URIS')
+
+    replica = ReadReplica(uri, app.config, app.root_path)
+    app.extensions['read_replica'] = replica
+    window = setting(app.config, 'READ_AFTER_WRITE_SECONDS')
+
+    @app.after_request
+    def stick_to_primary(response):
+        if request.method in WRITE_METHODS and response.status_code < 400:
+            response.set_cookie(STICKY_COOKIE, f'{time.time() + window:.3f}',
+                                max_age=window, httponly=True)
+        return response
+
+    @app.teardown_appcontext
+    def remove_replica_session(error):
+        replica.session.remove()
+
+    registry = app.extensions.get('metrics')
+    if registry is not None:
+        registry.metrics.append(Gauge('banking_replica_lag_seconds',
+                                      'Age of the oldest transfer missing on the '
+                                      'read replica.', lambda: replica.lag()[0]))
+        registry.metrics.append(Gauge('banking_replica_lag_events',
+                                      'Transfers missing on the read replica.',
+                                      lambda: replica.lag()[1]))
+
+
+def read_replica():
+    """Return read replica of current app, None without one."""
+    return current_app.extensions.get('read_replica')
+
+
+def read_session():
+    """Return session the current GET request reads from, the replica's if it may.
+
+    The choice is made once per request, so all of its reads see one database.
+    """
+    replica = read_replica()
+    if replica is None:
+        return db.session
+    target = request.environ.get(READ_TARGET)
+    if target is None:
+        target = request.environ[READ_TARGET] = replica.route()
+    return replica.session if target == 'replica' else db.session
+
+
+def copy_database(source, target):
+    """Copy SQLite file source over target, as one consistent snapshot."""
+    with closing(sqlite3.connect(source)) as primary, \
+            closing(sqlite3.connect(target, timeout=30)) as replica:
+        primary.backup(replica)
+
+
+def main(argv=None):
+    """Copy the main SQLite database over the read replica, a replication stand-in."""
+    from banking_api import create_app
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('command', choices=['sync'])
+    parser.add_argument('--config', default='config.py')
+    parser.add_argument('--interval', type=float, default=1,
+                        help='seconds between copies')
+    parser.add_argument('--once', action='store_true', help='copy once and exit')
+    args = parser.parse_args(argv)
+
+    app = create_app(args.config)
+    replica = app.extensions.get('read_replica')
+    if replica is None:
+        raise SystemExit('READ_REPLICA_URI is not set, nothing to do')
+    with app.app_context():
+        source = db.engine.url.database
+    target = replica.engine.url.database
+    if source == target:
+        raise SystemExit('the read replica is the main database, nothing to do')
+
+    while True:
+        copy_database(source, target)
+        if args.once:
+            return
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,63 @@
 """Script contains all the routes of banking API."""
-from flask import Blueprint, request
-from banking_api.model import db, Customer, Account, Transaction
+import heapq
+import itertools
+
+from flask import abort, current_app, request
+from banking_api.model import (db, Customer, Account, Transaction, to_cents,
+                               from_cents, to_utc, from_utc, utc_now)
+from banking_api import archive, events, ledger, stats, transfers
+from banking_api.account_index import account_index
+from banking_api.cache import balance_cache
+from banking_api.transfer_queue import transfer_queue
+from banking_api.pagination import (decode_cursor, encode_cursor, parse_limit,
+                                    stream_json)
+from banking_api.replica import read_replica, read_session
+from banking_api.serializers import records
+from banking_api.sharding import account_session, shard_router
 from flask_restful import Resource
-import uuid
-from datetime import datetime
-
-api_bp = Blueprint('routes', __name__)
+from sqlalchemy import func, or_, select, union_all
+from sqlalchemy.exc import IntegrityError
 
 
 class Customers(Resource):
     """Create Customers class."""
 
     def get(self):
-        """Retreive customers from customers database and display all."""
-        customers = Customer.query.all()
-
-        output = []
-        for c in customers:
-            customer_data = {
-                'id': c.id,
-                'name': c.name,
-                'identification': c.identification}
+        """Retreive customers from customers database and display all.
 
-            output.append(customer_data)
-
-        return {'customers': output}, 200
+        Without a ``limit`` every customer is streamed in id order. With
+        ``limit`` one page is returned together with a ``next`` cursor, which
+        is passed back as ``after`` to get the following page.
+        """
+        try:
+            after = request.args.get('after')
+            after = decode_cursor(after, (int,)) if after else None
+            limit = request.args.get('limit')
+            limit = parse_limit(limit) if limit is not None else None
+        except ValueError as error:
+            return {'message': str(error)}, 400
+
+        # select only the columns returned, no ORM objects are built
+        query = select(Customer.id, Customer.name,
+                       Customer.identification).order_by(Customer.id)
+        if after:
+            query = query.where(Customer.id > after[0])
+        if limit:
+            # fetch one extra row to know whether there is a next page
+            query = query.limit(limit + 1)
+        # core execution streams rows, ORM execution would fetch them all first
+        rows = read_session().connection().execute(query)
+
+        if limit is None:
+            return stream_json('customers', records(rows))
+
+        output = list(records(rows))
+        next_cursor = None
+        if len(output) > limit:
+            output = output[:limit]
+            next_cursor = encode_cursor((output[-1]['id'],))
+
+        return {'customers': output, 'next': next_cursor}, 200
 
     def post(self):
         """Register new customer to database by name."""
@@ -37,26 +70,20 @@ class Customers(Resource):
                 name=name.title(),
                 identification=request.json['identification'])
 
-            # check if customer already exists
-            customer_exist = db.session.query(Customer).\
-                filter(Customer.name == new_customer.name).\
-                filter(Customer.identification == new_customer.identification).\
-                first()
-
-            # add to database if doesn't exists
-            if not customer_exist:
+            # add to database, the unique (identification, name) index
+            # rejects customers that already exist
+            try:
                 db.session.add(new_customer)
                 db.session.commit()
 
-                return {
-                    'SUCCESS': {
-                        'message': 'customer added',
-                        'id': new_customer.id,
-                        'name': new_customer.name,
-                        'identification': new_customer.identification
-                    }
-                }, 201
-            else:
+            except IntegrityError:
+                db.session.rollback()
+
+                customer_exist = db.session.query(Customer).\
+                    filter(Customer.identification == new_customer.identification).\
+                    filter(Customer.name == new_customer.name).\
+                    first()
+
                 return {
                     'FAILED': {
                         'message': 'customer already exists',
@@ -66,6 +93,15 @@ class Customers(Resource):
                     }
                 }, 400
 
+            return {
+                'SUCCESS': {
+                    'message': 'customer added',
+                    'id': new_customer.id,
+                    'name': new_customer.name,
+                    'identification': new_customer.identification
+                }
+            }, 201
+
         except Exception:
             # create custom error messages
             content = request.get_json()
@@ -92,12 +128,12 @@ class Accounts(Resource):
                    f"{request.json['surname'].strip()}"
 
             iden = f"{request.json['identification'].strip()}"
-            deposit = request.json['deposit']
+            deposit = to_cents(request.json['deposit'])
 
             # check if customer already exists
             customer_exist = db.session.query(Customer).\
-                filter(Customer.name == name.title()).\
                 filter(Customer.identification == iden).\
+                filter(Customer.name == name.title()).\
                 first()
 
             # create new account if customer exists
@@ -108,13 +144,23 @@ class Accounts(Resource):
                     customer_id=customer_exist.id
                 )
 
-                db.session.add(new_account)
-                db.session.commit()
+                router = shard_router()
+                if router is not None:
+                    new_account.id = router.create_account(customer_exist.id, deposit)
+                else:
+                    db.session.add(new_account)
+                    db.session.flush()
+                    ledger.record_opening(new_account.id, deposit)
+                    db.session.commit()
+
+                cache = balance_cache()
+                if cache is not None:
+                    cache.set_balance(new_account.id, new_account.balance)
 
                 return {'SUCCESS': {
                     'message': 'New account added',
                     'id': new_account.id,
-                    'balance': new_account.balance,
+                    'balance': from_cents(new_account.balance),
                     'customer_id': new_account.customer_id,
                     'name': customer_exist.name
                 }}, 201
@@ -123,6 +169,9 @@ class Accounts(Resource):
                 return {'message': 'customer does not exist in database, '
                         'add customer first'}, 400
 
+        except ValueError as error:
+            return {'message': str(error)}, 400
+
         except Exception:
             # create custom error messages
             content = request.get_json()
@@ -143,62 +192,255 @@ class Account_id(Resource):
 
     def get(self, account_id):
         """Retreive single account balance by its id."""
-        account = Account.query.get_or_404(account_id)
+        balance = _indexed_balance(account_id)
+        cache = balance_cache()
+        if balance is None and cache is not None:
+            # filled from the main database, a lagging replica could cache a
+            # balance older than the last invalidation
+            balance = cache.get_balance(account_id, _load_balance)
+        elif balance is None:
+            balance = _load_balance(account_id, _read_session(account_id))
+
+        if balance is None:
+            abort(404)
+
+        return {'SUCCESS': {
+                'message': f'account {account_id} retreived',
+                'balance': from_cents(balance)}}
+
+
+def _load_balance(account_id, session=None):
+    """Return balance of an account in cents, None if it does not exist."""
+    return (session or account_session(account_id)).execute(
+        select(Account.balance).where(Account.id == account_id)).scalar()
+
+
+def _indexed_balance(account_id):
+    """Return balance of an account in cents from the account index, None if not in it."""
+    index = account_index()
+    return index.balance(account_id) if index is not None else None
+
+
+def _account_exists(account_id, session):
+    """Return True if an account exists, looked up in the account index first."""
+    return (_indexed_balance(account_id) is not None
+            or _load_balance(account_id, session) is not None)
+
+
+def _read_session(account_id):
+    """Return session reading an account, of its shard or else of the read replica."""
+    return account_session(account_id) if shard_router() is not None else read_session()
+
+
+class AccountBalance(Resource):
+    """Create AccountBalance class for getting the balance of an account at a time."""
+
+    def get(self, account_id):
+        """Retreive account balance as of an ISO 8601 time given as ``as_of``.
+
+        Without ``as_of`` the current balance is returned, times without a
+        UTC offset are taken as UTC.
+        """
+        session = _read_session(account_id)
+        if not _account_exists(account_id, session):
+            abort(404)
+
+        as_of = request.args.get('as_of')
+        if as_of is None:
+            as_of = utc_now()
+        else:
+            try:
+                as_of = to_utc(as_of)
+            except ValueError:
+                return {'message': 'as_of must be an ISO 8601 date and time'}, 400
 
         return {'SUCCESS': {
-                'message': f'account {account.id} retreived',
-                'balance': account.balance}}
+                'message': f'account {account_id} balance retreived',
+                'balance': from_cents(ledger.balance_as_of(account_id, as_of, session)),
+                'as_of': from_utc(as_of)}}
+
+
+class AccountSummary(Resource):
+    """Create AccountSummary class for getting the transfer totals of an account."""
+
+    def get(self, account_id):
+        """Retreive balance, totals in and out, transfer count and last activity."""
+        summary = stats.summaries(_read_session(account_id), Account.id == account_id)
+        if not summary:
+            abort(404)
+
+        return {'SUCCESS': dict(_summary_output(summary[0]),
+                                message=f'account {account_id} summary retreived')}
+
+
+class CustomerSummary(Resource):
+    """Create CustomerSummary class for getting the transfer totals of a customer."""
+
+    def get(self, customer_id):
+        """Retreive totals of all accounts of a customer, and of each account."""
+        customer = read_session().get(Customer, customer_id)
+        if customer is None:
+            abort(404)
+
+        # with sharding the accounts of a customer may be on any shard
+        router = shard_router()
+        sessions = router.sessions if router is not None else [read_session()]
+        accounts = sorted((summary for session in sessions for summary in
+                           stats.summaries(session, Account.customer_id == customer_id)),
+                          key=lambda summary: summary['account_id'])
+
+        activity = [a['last_activity'] for a in accounts if a['last_activity']]
+        return {'SUCCESS': {
+                'message': f'customer {customer_id} summary retreived',
+                'customer_id': customer.id,
+                'name': customer.name,
+                'balance': from_cents(sum(a['balance'] for a in accounts)),
+                'total_in': from_cents(sum(a['total_in'] for a in accounts)),
+                'total_out': from_cents(sum(a['total_out'] for a in accounts)),
+                'transfer_count': sum(a['transfer_count'] for a in accounts),
+                'last_activity': _utc_output(max(activity, default=None)),
+                'accounts': [_summary_output(a) for a in accounts]}}
+
+
+def _summary_output(summary):
+    """Convert the summary of an account to its response dict."""
+    return dict(summary, balance=from_cents(summary['balance']),
+                total_in=from_cents(summary['total_in']),
+                total_out=from_cents(summary['total_out']),
+                last_activity=_utc_output(summary['last_activity']))
+
+
+def _utc_output(timestamp):
+    """Format a UTC datetime for a response, None stays None."""
+    return from_utc(timestamp) if timestamp is not None else None
+
+
+class CacheStats(Resource):
+    """Create CacheStats class for monitoring the balance cache."""
+
+    def get(self):
+        """Retreive hit and miss counters of the balance cache."""
+        cache = balance_cache()
+        return {'balance_cache': cache.stats() if cache is not None else None}
+
+
+class ReplicaStats(Resource):
+    """Create ReplicaStats class for monitoring the read replica."""
+
+    def get(self):
+        """Retreive lag of the read replica and where reads were served."""
+        replica = read_replica()
+        return {'read_replica': replica.stats() if replica is not None else None}
+
+
+class AccountIndexStats(Resource):
+    """Create AccountIndexStats class for monitoring the account index."""
+
+    def get(self):
+        """Retreive size, memory and hit counters of the account index."""
+        index = account_index()
+        return {'account_index': index.stats() if index is not None else None}
+
+
+class AccountIndexVerify(Resource):
+    """Create AccountIndexVerify class for checking the account index."""
+
+    def get(self):
+        """Retreive the accounts whose balance in the account index is not the stored one.
+
+        Only the index of the process answering is checked.
+        """
+        index = account_index()
+        if index is None:
+            return {'account_index': None}
+        if not index.ready:
+            return {'message': 'account index is loading'}, 503
+
+        report = index.verify()
+        report['different'] = [
+            dict(entry, index=from_cents(entry['index']),
+                 database=from_cents(entry['database']))
+            for entry in report['different']]
+        return {'account_index': report}
 
 
 class Transactions(Resource):
     """Create Transaction class for transferring between accounts."""
 
+    def get(self):
+        """Retreive transactions of all accounts between the times ``from`` and ``to``.
+
+        Both are ISO 8601 times, taken as UTC without an offset, ``from``
+        included and ``to`` excluded. Transactions are ordered by timestamp
+        and streamed, or paged with ``limit`` and ``after`` as the history of
+        an account.
+        """
+        try:
+            start, end = _time_range()
+            after, limit = _page_args()
+        except ValueError as error:
+            return {'message': str(error)}, 400
+        if start is None or end is None:
+            return {'message': 'must provide from and to parameters'}, 400
+
+        query = _range_query(start, end, after, limit + 1 if limit else None)
+        router = shard_router()
+        if router is None:
+            rows = records(read_session().connection().execute(query), money=('amount',))
+        else:
+            rows = _merge_histories([records(session.connection().execute(query),
+                                             money=('amount',))
+                                     for session in router.sessions])
+        return _transactions_page(rows, limit)
+
     def post(self):
         """Create new transaction."""
         try:
             # get request inputs
             account_id_from = request.json['account_id_from']
             account_id_to = request.json['account_id_to']
-            amount = request.json['amount']
-            transaction_uuid = str(uuid.uuid4())
-            transaction_timestamp = str(datetime.now())
+            transfers.check_account_ids(account_id_from, account_id_to)
+            amount = to_cents(request.json['amount'])
 
             # process transaction if amount is not zero or negative
             if amount <= 0:
                 return {'message': 'amount must be positive and not zero'}, 400
-            else:
-                account_from_exist = Account.query.get(account_id_from)
-                account_to_exist = Account.query.get(account_id_to)
 
-                # update account records if both accounts exists,
-                # and add transaction to database
-                if account_from_exist and account_to_exist:
+            queue = transfer_queue()
+            if queue is not None:
+                # accounts are never deleted, so checking them now is enough
+                unknown = {account_id for account_id in (account_id_from, account_id_to)
+                           if _indexed_balance(account_id) is None}
+                if unknown and len(unknown) != db.session.execute(
+                        select(func.count()).select_from(Account)
+                        .where(Account.id.in_(unknown))).scalar():
+                    return {'message': 'Check account id'}, 400
 
-                    account_from_exist.balance = account_from_exist.balance - amount
-                    account_to_exist.balance = account_to_exist.balance + amount
-                    db.session.commit()
+                transaction_uuid = queue.put(account_id_from, account_id_to, amount)
+                return {'SUCCESS': {'message': 'Transaction queued',
+                                    'uuid': transaction_uuid,
+                                    'status': 'queued'}}, 202
 
-                    new_transaction = Transaction(
-                        uuid=transaction_uuid,
-                        account_id_from=account_id_from,
-                        account_id_to=account_id_to,
-                        amount=amount,
-                        transaction_timestamp=transaction_timestamp
-                    )
+            router = shard_router()
+            if router is not None:
+                # one commit within a shard, two phases across shards
+                new_transaction = router.transfer(account_id_from, account_id_to,
+                                                  amount)
+            else:
+                # update both balances and add transaction to database in one
+                # commit, fails if either account does not exist
+                new_transaction = transfers.transfer(account_id_from,
+                                                     account_id_to, amount)
 
-                    db.session.add(new_transaction)
-                    db.session.commit()
+            return {'SUCCESS': dict(
+                    _transaction_output(new_transaction),
+                    message='Transaction processed')}, 201
 
-                    return {'SUCCESS': {
-                            'message': 'Transaction processed',
-                            'uuid': new_transaction.uuid,
-                            'account_id_from': new_transaction.account_id_from,
-                            'account_id_to': new_transaction.account_id_to,
-                            'amount': new_transaction.amount,
-                            'transaction_timestamp': new_transaction.transaction_timestamp
-                            }}, 201
-                else:
-                    return {'message': 'Check account id'}, 400
+        except transfers.TransferError as error:
+            return {'message': error.message}, 400
+
+        except ValueError as error:
+            return {'message': str(error)}, 400
 
         except Exception:
             # create custom error messages
@@ -215,32 +457,395 @@ class Transactions(Resource):
                 return {'message': 'Uknown error'}, 400
 
 
+class TransactionStatus(Resource):
+    """Create TransactionStatus class for following a transaction by its uuid."""
+
+    def get(self, transaction_uuid):
+        """Retreive status of a transaction: queued, committed or failed.
+
+        Archived transactions are looked up in the archive.
+        """
+        queue = transfer_queue()
+        queued = queue.get(transaction_uuid) if queue is not None else None
+        if queued is not None and queued['status'] != 'committed':
+            return {'uuid': transaction_uuid, 'status': queued['status'],
+                    'message': queued['message']}
+
+        router = shard_router()
+        if router is not None:
+            row = router.find_transaction(transaction_uuid)
+        else:
+            row = db.session.execute(
+                select(Transaction.__table__)
+                .where(Transaction.uuid == transaction_uuid)).first()
+            if row is None:
+                archived = archive.find_transaction(transaction_uuid, db.session)
+                if archived is not None:
+                    return dict(next(_formatted([archived])), status='committed',
+                                archived=True)
+        if row is None:
+            return {'message': 'transaction does not exist'}, 404
+
+        return dict(_transaction_output(row), status='committed')
+
+
+class TransactionsBatch(Resource):
+    """Create TransactionsBatch class for transferring many amounts in one request."""
+
+    def post(self):
+        """Create many new transactions in a single database commit."""
+        content = request.get_json(silent=True) or {}
+        if not isinstance(content, dict):
+            return {'message': 'request body must be an object'}, 400
+        items = content.get('transactions')
+        atomic = content.get('atomic', True)
+
+        if not isinstance(items, list) or not items:
+            return {'message': 'must provide a non-empty list of transactions'}, 400
+        if not isinstance(atomic, bool):
+            return {'message': 'atomic must be true or false'}, 400
+
+        if shard_router() is not None:
+            return {'message': 'batch transfers are not supported with sharding'}, 501
+
+        # validate requests before touching the database
+        results = [{'index': index, 'status': 'failed', 'message': message}
+                   if message else None
+                   for index, message in enumerate(map(_check_transfer, items))]
+        valid = [index for index, result in enumerate(results) if result is None]
+
+        if atomic and len(valid) != len(items):
+            return _batch_rejected(results)
+
+        # apply the valid transfers in one commit, in request order
+        outcomes = transfers.transfer_batch([
+            (items[i]['account_id_from'], items[i]['account_id_to'],
+             to_cents(items[i]['amount'])) for i in valid], atomic=atomic)
+
+        for index, outcome in zip(valid, outcomes):
+            if isinstance(outcome, transfers.TransferError):
+                results[index] = {'index': index, 'status': 'failed',
+                                  'message': outcome.message}
+            else:
+                results[index] = dict(_transaction_output(outcome), index=index,
+                                      status='processed')
+
+        processed = sum(r['status'] == 'processed' for r in results)
+        failed = len(results) - processed
+
+        # all-or-nothing batches are rejected as a whole on any failure
+        if atomic and failed:
+            return _batch_rejected(results)
+
+        if not processed:
+            return {'message': 'no transactions processed', 'results': results}, 400
+
+        return {'SUCCESS': {
+                'message': f'{processed} transactions processed',
+                'failed': failed,
+                'results': results}}, 201
+
+
+class Events(Resource):
+    """Create Events class for following committed transfers in order."""
+
+    def get(self):
+        """Retreive events of committed transfers after the seq ``after``, oldest first.
+
+        Without ``after`` a ``consumer`` goes on after the position it stored,
+        others start at the oldest event kept. ``wait`` holds the request for
+        up to that many seconds until an event is committed. ``next`` is the
+        seq to pass as ``after`` for the following events.
+        """
+        try:
+            session = _event_session()
+            after = _event_number('after', request.args.get('after'))
+            limit = parse_limit(request.args.get('limit'))
+            wait = _event_number('wait', request.args.get('wait', '0'), float)
+            max_wait = events.setting(current_app.config, 'EVENTS_MAX_WAIT')
+            if wait > max_wait:
+                raise ValueError(f'wait must be at most {max_wait} seconds')
+        except ValueError as error:
+            return {'message': str(error)}, 400
+
+        if after is None:
+            consumer = request.args.get('consumer')
+            after = (events.position(consumer, session) if consumer else None) or 0
+
+        rows = events.read(after, limit, wait, session)
+        return {'events': [_transaction_output(row) for row in rows],
+                'next': rows[-1].seq if rows else after}, 200
+
+
+class EventConsumers(Resource):
+    """Create EventConsumers class for the positions of event consumers."""
+
+    def get(self, name):
+        """Retreive seq of the last event handled by a consumer."""
+        try:
+            session = _event_session()
+        except ValueError as error:
+            return {'message': str(error)}, 400
+        position = events.position(name, session)
+        if position is None:
+            return {'message': 'consumer does not exist'}, 404
+        return {'name': name, 'position': position}, 200
+
+    def put(self, name):
+        """Store seq of the last event handled by a consumer, given as ``position``."""
+        content = request.get_json(silent=True) or {}
+        try:
+            session = _event_session()
+            position = content.get('position')
+            if isinstance(position, bool) or not isinstance(position, int):
+                raise ValueError('must provide position as an integer')
+            position = _event_number('position', position)
+            events.store_position(name, position, session)
+        except ValueError as error:
+            return {'message': str(error)}, 400
+
+        return {'SUCCESS': {'message': f'consumer {name} at {position}',
+                            'name': name, 'position': position}}, 200
+
+    def delete(self, name):
+        """Delete a consumer, its position no longer holds events back."""
+        try:
+            session = _event_session()
+        except ValueError as error:
+            return {'message': str(error)}, 400
+        if not events.delete_consumer(name, session):
+            return {'message': 'consumer does not exist'}, 404
+        return {'SUCCESS': {'message': f'consumer {name} deleted'}}, 200
+
+
+def _event_session():
+    """Return session of the database whose events are read, chosen by ``shard``."""
+    router = shard_router()
+    sessions = router.sessions if router is not None else [db.session]
+    shard = request.args.get('shard', '0')
+    if not shard.isdigit() or int(shard) >= len(sessions):
+        raise ValueError(f'no shard {shard}')
+    return sessions[int(shard)]
+
+
+def _event_number(name, value, convert=int):
+    """Parse a non-negative number argument, None stays None."""
+    if value is None:
+        return None
+    try:
+        number = convert(value)
+    except ValueError:
+        number = -1
+    # NaN is not a valid number either
+    if not number >= 0:
+        raise ValueError(f'{name} must be a non-negative number')
+    return number
+
+
+def _batch_rejected(results):
+    """Return response of an atomic batch in which some transactions failed."""
+    failed = 0
+    for index, result in enumerate(results):
+        if result is None or result['status'] != 'failed':
+            results[index] = {'index': index, 'status': 'not processed'}
+        else:
+            failed += 1
+    return {'message': f'{failed} transactions failed, '
+            'no transactions processed', 'results': results}, 400
+
+
+def _check_transfer(item):
+    """Return an error message if a batch item cannot be processed."""
+    if not isinstance(item, dict):
+        return 'transaction must be an object'
+
+    required_args = ['account_id_from', 'account_id_to', 'amount']
+    missing_args = [x for x in required_args if item.get(x) is None]
+    if missing_args:
+        return f'must provide {missing_args} parameters to process transaction'
+
+    try:
+        transfers.check_account_ids(item['account_id_from'], item['account_id_to'])
+        amount = to_cents(item['amount'])
+    except transfers.TransferError as error:
+        return error.message
+    except ValueError as error:
+        return str(error)
+    if amount <= 0:
+        return 'amount must be positive and not zero'
+
+    return None
+
+
 class AccountTransactions(Resource):
     """Create AccountTransactions class for getting transaction history for an account."""
 
     def get(self, account_id):
-        """Retreive transaction history for a given account."""
-        account_exist = Account.query.get(account_id)
+        """Retreive transaction history for a given account.
+
+        Without a ``limit`` the whole history is streamed, oldest first. With
+        ``limit`` one page is returned together with a ``next`` cursor, which
+        is passed back as ``after`` to get the following page. ``from`` and
+        ``to`` limit the history to a time range, as for all transactions.
+        Archived transactions are merged in when the request reaches them.
+        """
+        session = _read_session(account_id)
+        account_exist = _account_exists(account_id, session)
 
         # if account exists, filter transaction database by the account id
         if account_exist:
+            try:
+                start, end = _time_range()
+                after, limit = _page_args()
+            except ValueError as error:
+                return {'message': str(error)}, 400
+
+            # fetch one extra row to know whether there is a next page
+            query = _history_query(account_id, after, limit + 1 if limit else None,
+                                   start, end)
+            rows = records(session.connection().execute(query), money=('amount',))
+            archived = archive.account_history(account_id, session, after, start, end)
+            if archived:
+                rows = _merge_histories([rows] + archived)
+            return _transactions_page(rows, limit)
+        else:
+            return {'message': 'Check account id'}, 404
 
-            transaction_history = Transaction.query.filter(
-                (Transaction.account_id_from == account_id)
-                | (Transaction.account_id_to == account_id))
-
-            output = []
-            for t in transaction_history:
-                transaction_data = {
-                    'uuid': t.uuid,
-                    'account_id_from': t.account_id_from,
-                    'account_id_to': t.account_id_to,
-                    'amount': t.amount,
-                    'transaction_timestamp': t.transaction_timestamp
-                }
 
-                output.append(transaction_data)
+def _time_range():
+    """Return UTC datetimes of the ``from`` and ``to`` arguments, None if not given."""
+    times = []
+    for name in ('from', 'to'):
+        value = request.args.get(name)
+        try:
+            times.append(to_utc(value) if value else None)
+        except ValueError:
+            raise ValueError(f'{name} must be an ISO 8601 date and time')
+    return times
 
-            return {'transactions': output}, 200
-        else:
-            return {'message': 'Check account id'}, 404
+
+def _page_args():
+    """Return position of the ``after`` cursor and the ``limit`` of a transaction page."""
+    after = request.args.get('after')
+    if after:
+        try:
+            timestamp, last_uuid = decode_cursor(after, (str, str))
+            after = (to_utc(timestamp), last_uuid)
+        except ValueError:
+            raise ValueError(f'invalid cursor {after!r}')
+    limit = request.args.get('limit')
+    return after or None, parse_limit(limit) if limit is not None else None
+
+
+def _transactions_page(rows, limit):
+    """Return transaction records streamed, or one page of limit with a next cursor.
+
+    Records are ordered by their UTC datetimes, formatted only for the response.
+    """
+    if limit is None:
+        return stream_json('transactions', _formatted(rows))
+
+    output = list(_formatted(itertools.islice(rows, limit + 1)))
+    next_cursor = None
+    if len(output) > limit:
+        output = output[:limit]
+        next_cursor = encode_cursor((output[-1]['transaction_timestamp'],
+                                     output[-1]['uuid']))
+    return {'transactions': output, 'next': next_cursor}, 200
+
+
+def _formatted(rows):
+    """Yield transaction records with their timestamps formatted by from_utc."""
+    for row in rows:
+        row['transaction_timestamp'] = from_utc(row['transaction_timestamp'])
+        yield row
+
+
+def _merge_histories(results):
+    """Merge transaction records ordered by timestamp, each transaction once.
+
+    A transfer between two shards is stored on both of them, and a
+    transaction being archived is both in the table and in its segment.
+    """
+    previous = None
+    for row in heapq.merge(*results, key=lambda row: (row['transaction_timestamp'],
+                                                      row['uuid'])):
+        if row['uuid'] != previous:
+            yield row
+        previous = row['uuid']
+
+
+def _transaction_output(row):
+    """Convert a transaction row or dict to its response dict."""
+    transaction = dict(getattr(row, '_mapping', row))
+    transaction['amount'] = from_cents(transaction['amount'])
+    transaction['transaction_timestamp'] = from_utc(transaction['transaction_timestamp'])
+    return transaction
+
+
+def _after(query, after):
+    """Return query restricted to transactions after a (timestamp, uuid) position."""
+    timestamp, last_uuid = after
+    return query.where(Transaction.transaction_timestamp >= timestamp,
+                       or_(Transaction.transaction_timestamp > timestamp,
+                           Transaction.uuid > last_uuid))
+
+
+def _within(query, start, end):
+    """Return query restricted to transactions from start and before end, if given."""
+    if start is not None:
+        query = query.where(Transaction.transaction_timestamp >= start)
+    if end is not None:
+        query = query.where(Transaction.transaction_timestamp < end)
+    return query
+
+
+def _history_query(account_id, after=None, limit=None, start=None, end=None):
+    """Build query for transactions of an account ordered by timestamp and uuid.
+
+    Outgoing and incoming transactions are selected separately so each half
+    walks its own (account, timestamp) index from the cursor position, or
+    from the start of the time range, and only the requested page is read
+    from each.
+    """
+    columns = (Transaction.uuid, Transaction.account_id_from,
+               Transaction.account_id_to, Transaction.amount,
+               Transaction.transaction_timestamp)
+    order = (Transaction.transaction_timestamp, Transaction.uuid)
+
+    def side(condition):
+        query = _within(select(*columns).where(condition), start, end)
+        if after:
+            query = _after(query, after)
+        if limit:
+            query = query.order_by(*order).limit(limit)
+        return select(query.subquery())
+
+    # self transfers are only counted once, as outgoing
+    history = union_all(
+        side(Transaction.account_id_from == account_id),
+        side((Transaction.account_id_to == account_id)
+             & (Transaction.account_id_from != account_id))).subquery()
+
+    query = select(history.c.uuid, history.c.account_id_from, history.c.account_id_to,
+                   history.c.amount, history.c.transaction_timestamp).order_by(
+        history.c.transaction_timestamp, history.c.uuid)
+    if limit:
+        query = query.limit(limit)
+    return query
+
+
+def _range_query(start, end, after=None, limit=None):
+    """Build query for transactions of all accounts from start to before end.
+
+    Walks the timestamp index from the cursor position or from start.
+    """
+    query = _within(select(
+        Transaction.uuid, Transaction.account_id_from, Transaction.account_id_to,
+        Transaction.amount, Transaction.transaction_timestamp), start, end)
+    if after:
+        query = _after(query, after)
+    query = query.order_by(Transaction.transaction_timestamp, Transaction.uuid)
+    if limit:
+        query = query.limit(limit)
+    return query
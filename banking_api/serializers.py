@@ -0,0 +1,73 @@
+"""JSON encoding of API responses, with orjson when it is installed.
+
+Responses are encoded by orjson, several times faster than the standard
+library json module, which is used when orjson is not installed. Both give the
+same JSON, compact and UTF-8 encoded. Rows of column-only queries are turned
+into response dicts by records(), and encode_chunks() encodes them a chunk at
+a time, so a streamed history costs one encoder call and one response chunk
+per CHUNK_SIZE rows instead of per row.
+"""
+import itertools
+import json
+
+from flask import make_response
+
+from banking_api.model import from_cents
+
+try:
+    import orjson
+except ImportError:
+    # optional, the standard library json module is used without it
+    orjson = None
+
+# rows encoded per call when streaming
+CHUNK_SIZE = 1000
+
+
+def dumps(obj):
+    """Encode obj as compact UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def output_json(data, code, headers=None):
+    """Make a JSON response, registered as Flask-RESTful's JSON representation."""
+    response = make_response(dumps(data), code)
+    response.headers.extend(headers or {})
+    response.mimetype = 'application/json'
+    return response
+
+
+def records(result, money=()):
+    """Yield rows of a query result as dicts, money columns from cents to units.
+
+    Rows are fetched as plain tuples in batches, no mapping is built per row.
+    """
+    # column names can be str subclasses, which orjson does not take as keys
+    keys = [str(key) for key in result.keys()]
+    money_indexes = [keys.index(name) for name in money]
+    while True:
+        rows = result.fetchmany(CHUNK_SIZE)
+        if not rows:
+            return
+        for row in rows:
+            if money_indexes:
+                row = list(row)
+                for index in money_indexes:
+                    row[index] = from_cents(row[index])
+            yield dict(zip(keys, row))
+
+
+def encode_chunks(items, chunk_size=CHUNK_SIZE):
+    """Yield JSON of items, comma separated, one bytes chunk per chunk_size items."""
+    items = iter(items)
+    first = True
+    while True:
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            return
+        # strip the brackets of the encoded list, the caller writes its own
+        encoded = dumps(chunk)[1:-1]
+        yield encoded if first else b',' + encoded
+        first = False
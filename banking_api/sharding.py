@@ -0,0 +1,504 @@
+"""Accounts and their history partitioned by account id across databases.
+
+With SHARD_URIS set, accounts, their transactions, ledger entries and balance
+snapshots are stored in several databases (shards) instead of the main
+database, which keeps the customers, the account id sequence and the shard
+map. Account ids are dealt out to the shards in blocks of SHARD_BLOCK_SIZE
+ids, and ranges moved by the rebalancing tool override that. Every shard has
+its own write lock, so transfers on different shards commit in parallel.
+
+A transfer between two accounts of one shard is one local transaction, as
+without sharding. A transfer between shards is committed in two phases:
+
+1. the shard of the receiving account (participant) checks the account and
+   journals the transfer as prepared,
+2. the shard of the paying account (coordinator) debits it, stores the
+   transaction and journals it as committed, all in one local transaction:
+   this is the commit point,
+3. the participant credits its account, stores the transaction and marks its
+   journal row committed, or aborted when step 2 failed.
+
+A process dying between the steps leaves a prepared participant row, which
+``python -m banking_api.sharding recover`` resolves from the coordinator's
+journal: a committed row there means commit, no row means abort. The abort is
+journaled at the coordinator first, so a late coordinator cannot commit
+after it. A cross-shard transaction is stored on both shards, so the history
+of an account is always read from its own shard.
+
+Account ranges are moved between shards with ``python -m banking_api.sharding
+move FIRST LAST SHARD``, see move_range.
+"""
+import argparse
+import time
+from datetime import timedelta
+
+from flask import current_app
+from sqlalchemy import create_engine, delete, func, insert, or_, select, update
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from banking_api import events, ledger, stats, transfers
+from banking_api.cache import invalidate_balances
+from banking_api.database import absolute_uri, engine_options, configure_engine
+from banking_api.migrations import upgrade
+from banking_api.model import (db, Account, AccountSequence, AccountStats,
+                               BalanceSnapshot, LedgerEntry, ShardRange, Transaction,
+                               TransferJournal, utc_now)
+
+# defaults used when a setting is missing from the config file
+DEFAULTS = {
+    'SHARD_URIS': [],
+    'SHARD_BLOCK_SIZE': 1000,
+    'SHARD_MAP_TTL': 1,
+    'SHARD_RECOVERY_AGE': 60,
+}
+
+# accounts moved per transaction by move_range
+CHUNK_SIZE = 500
+
+# seconds between checks of a move waiting for prepared transfers
+SETTLE_POLL = 0.1
+
+
+def setting(config, name):
+    """Return a sharding setting from config, or its default."""
+    return config.get(name, DEFAULTS[name])
+
+
+class ShardRouter():
+    """Sessions of the shards, and the shard of each account id."""
+
+    def __init__(self, uris, config, root_path):
+        """Open an engine per shard URI, SQLite paths relative to root_path."""
+        self.block_size = setting(config, 'SHARD_BLOCK_SIZE')
+        self.ttl = setting(config, 'SHARD_MAP_TTL')
+        self.engines = []
+        self.sessions = []
+        for uri in uris:
+            uri = absolute_uri(uri, root_path)
+            engine = create_engine(
+                uri, **engine_options(dict(config, SQLALCHEMY_DATABASE_URI=uri)))
+            configure_engine(engine, config)
+            self.engines.append(engine)
+            self.sessions.append(scoped_session(sessionmaker(bind=engine)))
+        self._ranges = None
+        self._loaded = 0
+
+    def ranges(self):
+        """Return moved ranges as (first_id, last_id, shard, state), newest first.
+
+        The shard map is read from the main database at most every
+        SHARD_MAP_TTL seconds.
+        """
+        now = time.monotonic()
+        if self._ranges is None or now - self._loaded >= self.ttl:
+            self._ranges = [tuple(r) for r in db.session.execute(
+                select(ShardRange.first_id, ShardRange.last_id, ShardRange.shard,
+                       ShardRange.state).order_by(ShardRange.id.desc()))]
+            self._loaded = now
+        return self._ranges
+
+    def locate(self, account_id):
+        """Return (shard, target) of an account, target is where it moves to or None."""
+        target = None
+        for first_id, last_id, shard, state in self.ranges():
+            if first_id <= account_id <= last_id:
+                if state == 'done':
+                    return shard, target
+                # a range being copied is served by its previous shard
+                if target is None:
+                    target = shard
+        return (account_id - 1) // self.block_size % len(self.sessions), target
+
+    def shard_for(self, account_id):
+        """Return index of the shard holding an account."""
+        shard, target = self.locate(account_id)
+        # accounts of a range being moved are on the old shard until copied
+        if target is not None and not _exists(self.sessions[shard], account_id):
+            return target
+        return shard
+
+    def session_for(self, account_id):
+        """Return session of the shard holding an account."""
+        return self.sessions[self.shard_for(account_id)]
+
+    def remove(self):
+        """Close the sessions of the current thread."""
+        for session in self.sessions:
+            session.remove()
+
+    def create_account(self, customer_id, balance):
+        """Create account with an opening balance in cents on its shard, return its id."""
+        sequence = AccountSequence()
+        db.session.add(sequence)
+        db.session.commit()
+        account_id = sequence.id
+        session = self.session_for(account_id)
+
+        def work():
+            session.add(Account(id=account_id, balance=balance, customer_id=customer_id))
+            ledger.record_opening(account_id, balance, session)
+
+        transfers.run_write_transaction(work, session)
+        return account_id
+
+    def find_transaction(self, transaction_uuid):
+        """Return a transaction by uuid from whichever shard has it, None if none has."""
+        for session in self.sessions:
+            row = session.execute(select(Transaction.__table__).where(
+                Transaction.uuid == transaction_uuid)).first()
+            if row is not None:
+                return dict(row._mapping)
+        return None
+
+    def transfer(self, account_id_from, account_id_to, amount):
+        """Transfer amount in cents between two accounts and return the transaction.
+
+        Raise AccountNotFound when either account does not exist and
+        LimitExceeded when the transfer breaks a limit, in which case nothing
+        is written.
+        """
+        shard_from = self.shard_for(account_id_from)
+        shard_to = self.shard_for(account_id_to)
+        if shard_from == shard_to:
+            return transfers.transfer(account_id_from, account_id_to, amount,
+                                      self.sessions[shard_from])
+
+        coordinator = self.sessions[shard_from]
+        participant = self.sessions[shard_to]
+        transaction = transfers.new_transaction(account_id_from, account_id_to, amount)
+
+        def prepare():
+            if not _exists(participant, account_id_to):
+                raise transfers.AccountNotFound()
+            participant.add(_journal(transaction, 'participant', shard_from, 'prepared'))
+
+        def commit():
+            balance = coordinator.execute(select(Account.balance).where(
+                Account.id == account_id_from)).scalar()
+            if balance is None:
+                raise transfers.AccountNotFound()
+            transfers.check_limits(account_id_from, account_id_to, amount, balance,
+                                   session=coordinator)
+            _add_to_balance(coordinator, account_id_from, -amount)
+            _store(coordinator, transaction, account_id_from)
+            coordinator.add(_journal(transaction, 'coordinator', shard_to, 'committed'))
+
+        transfers.run_write_transaction(prepare, participant)
+        try:
+            transfers.run_write_transaction(commit, coordinator)
+        except Exception:
+            self.resolve(shard_to, transaction['uuid'])
+            raise
+        self.resolve(shard_to, transaction['uuid'], committed=True)
+
+        invalidate_balances((account_id_from, account_id_to))
+        return transaction
+
+    def resolve(self, shard, transfer_uuid, committed=None):
+        """Commit or abort a transfer prepared on a participant shard, return its state.
+
+        Unless ``committed`` is given, the outcome is read from the journal of
+        the coordinator, where a transfer without outcome is recorded aborted.
+        """
+        session = self.sessions[shard]
+        entry = session.execute(select(TransferJournal.__table__).where(
+            TransferJournal.uuid == transfer_uuid)).first()
+        session.commit()
+        if entry is None or entry.state != 'prepared':
+            return entry.state if entry is not None else None
+        if committed is None:
+            committed = self._decide(entry, shard)
+
+        def finish():
+            entry = session.execute(select(TransferJournal).where(
+                TransferJournal.uuid == transfer_uuid)).scalar()
+            if entry.state != 'prepared':
+                return entry.state
+            if committed:
+                _add_to_balance(session, entry.account_id_to, entry.amount)
+                _store(session, _transaction(entry), entry.account_id_to)
+            entry.state = 'committed' if committed else 'aborted'
+            return entry.state
+
+        state = transfers.run_write_transaction(finish, session)
+        if committed:
+            invalidate_balances((entry.account_id_to,))
+        return state
+
+    def _decide(self, entry, shard):
+        """Return whether the coordinator of a transfer prepared on shard committed it.
+
+        A transfer the coordinator has no row for is recorded aborted there,
+        under its write lock, so the coordinator can no longer commit it.
+        """
+        session = self.sessions[entry.peer_shard]
+
+        def decide():
+            state = session.execute(select(TransferJournal.state).where(
+                TransferJournal.uuid == entry.uuid)).scalar()
+            if state is None:
+                session.add(_journal(_transaction(entry), 'coordinator', shard,
+                                     'aborted'))
+                state = 'aborted'
+            return state == 'committed'
+
+        return transfers.run_write_transaction(decide, session)
+
+    def recover(self, age):
+        """Resolve transfers prepared more than age seconds ago, return count by state."""
+        before = utc_now() - timedelta(seconds=age)
+        counts = {'committed': 0, 'aborted': 0}
+        for shard, session in enumerate(self.sessions):
+            uuids = session.execute(select(TransferJournal.uuid).where(
+                TransferJournal.state == 'prepared',
+                TransferJournal.role == 'participant',
+                TransferJournal.created_at < before)).scalars().all()
+            session.commit()
+            for transfer_uuid in uuids:
+                state = self.resolve(shard, transfer_uuid)
+                if state in counts:
+                    counts[state] += 1
+        return counts
+
+
+def _exists(session, account_id):
+    """Return True if the account is in the database of session."""
+    return session.execute(
+        select(Account.id).where(Account.id == account_id)).first() is not None
+
+
+def _add_to_balance(session, account_id, delta):
+    """Add a signed amount in cents to the balance of an account."""
+    session.execute(update(Account.__table__)
+                    .where(Account.__table__.c.id == account_id)
+                    .values(balance=Account.__table__.c.balance + delta))
+
+
+def _store(session, transaction, account_id):
+    """Insert a transaction with the ledger entry and statistics of one account.
+
+    The event of the transfer is stored with the paying account, at the
+    commit point.
+    """
+    session.execute(insert(Transaction.__table__), [transaction])
+    entries = ledger.transfer_entries([transaction])
+    session.execute(insert(LedgerEntry.__table__),
+                    [e for e in entries if e['account_id'] == account_id])
+    stats.record_transfers([transaction], session, {account_id})
+    if account_id == transaction['account_id_from']:
+        events.record_transfers([transaction], session)
+
+
+def _journal(transaction, role, peer_shard, state):
+    """Return journal row of one side of a transfer."""
+    return TransferJournal(role=role, peer_shard=peer_shard, state=state,
+                           created_at=utc_now(), **transaction)
+
+
+def _transaction(entry):
+    """Return the transaction row of a journal entry."""
+    return {'uuid': entry.uuid, 'account_id_from': entry.account_id_from,
+            'account_id_to': entry.account_id_to, 'amount': entry.amount,
+            'transaction_timestamp': entry.transaction_timestamp}
+
+
+def move_range(router, first_id, last_id, shard, recovery_age, chunk_size=CHUNK_SIZE):
+    """Move accounts first_id to last_id with their history to shard, return how many.
+
+    The range is first recorded as being copied, after which routers look an
+    account of it up on its old shard and, once it is gone from there, on
+    the new one. The move then waits two SHARD_MAP_TTL for every router to
+    see that, and copies accounts in chunks, each in one transaction on the
+    new shard and one on the old shard, which deletes them and holds its write
+    lock from reading the chunk to the end: a write still sent to the old
+    shard finds no account and fails, none is lost. Running it again after a
+    crash resumes the move.
+    """
+    move = db.session.execute(select(ShardRange).where(
+        ShardRange.first_id == first_id, ShardRange.last_id == last_id,
+        ShardRange.shard == shard, ShardRange.state == 'copying')).scalar()
+    if move is None:
+        move = ShardRange(first_id=first_id, last_id=last_id, shard=shard,
+                          state='copying', created_at=utc_now())
+        db.session.add(move)
+        db.session.commit()
+    time.sleep(2 * router.ttl)
+
+    moved = 0
+    for source in range(len(router.sessions)):
+        if source == shard:
+            continue
+        while True:
+            count, prepared = _move_chunk(router, source, shard, first_id, last_id,
+                                          chunk_size)
+            if prepared:
+                _settle(router, source, prepared, recovery_age)
+            elif not count:
+                break
+            moved += count
+
+    move.state = 'done'
+    db.session.commit()
+    return moved
+
+
+# account columns of the tables moved with their accounts
+ACCOUNT_TABLES = ((Account.__table__, Account.__table__.c.id),
+                  (AccountStats.__table__, AccountStats.__table__.c.account_id),
+                  (LedgerEntry.__table__, LedgerEntry.__table__.c.account_id),
+                  (BalanceSnapshot.__table__, BalanceSnapshot.__table__.c.account_id))
+
+
+def _move_chunk(router, source, target, first_id, last_id, chunk_size):
+    """Move the first chunk of accounts of a range still on source.
+
+    Return (accounts moved, uuids of transfers prepared on them). Nothing is
+    moved while transfers to the chunk are prepared.
+    """
+    old = router.sessions[source]
+    new = router.sessions[target]
+    table = Transaction.__table__
+
+    def work():
+        ids = old.execute(
+            select(Account.id).where(Account.id.between(first_id, last_id))
+            .order_by(Account.id).limit(chunk_size)).scalars().all()
+        if not ids:
+            return 0, []
+        prepared = old.execute(select(TransferJournal.uuid).where(
+            TransferJournal.state == 'prepared',
+            TransferJournal.account_id_to.in_(ids))).scalars().all()
+        if prepared:
+            return 0, prepared
+
+        touching = or_(table.c.account_id_from.in_(ids), table.c.account_id_to.in_(ids))
+        rows = []
+        for account_table, column in ACCOUNT_TABLES:
+            values = old.execute(select(account_table).where(column.in_(ids))).mappings()
+            rows.append((account_table, column,
+                         [_without_id(account_table, v) for v in values]))
+        transactions = old.execute(select(table).where(touching)).mappings().all()
+
+        def copy():
+            # a copy left by an earlier attempt is replaced
+            for account_table, column, values in rows:
+                new.execute(delete(account_table).where(column.in_(ids)))
+                if values:
+                    new.execute(insert(account_table), values)
+            present = set(new.execute(select(table.c.uuid).where(touching)).scalars())
+            missing = [dict(r) for r in transactions if r['uuid'] not in present]
+            if missing:
+                new.execute(insert(table), missing)
+
+        transfers.run_write_transaction(copy, new)
+
+        for account_table, column, _ in rows:
+            old.execute(delete(account_table).where(column.in_(ids)))
+        # transactions stay while the other account is still on the old shard
+        remaining = select(Account.id)
+        old.execute(delete(table).where(touching,
+                                        table.c.account_id_from.not_in(remaining),
+                                        table.c.account_id_to.not_in(remaining)))
+        return len(ids), []
+
+    return transfers.run_write_transaction(work, old)
+
+
+def _without_id(table, row):
+    """Return row as a dict, without the generated id of ledger tables."""
+    row = dict(row)
+    if table is not Account.__table__:
+        row.pop('id', None)
+    return row
+
+
+def _settle(router, shard, uuids, age):
+    """Wait up to age seconds for prepared transfers to finish, then resolve them."""
+    session = router.sessions[shard]
+    deadline = time.monotonic() + age
+    while time.monotonic() < deadline:
+        pending = session.execute(
+            select(func.count()).select_from(TransferJournal)
+            .where(TransferJournal.uuid.in_(uuids),
+                   TransferJournal.state == 'prepared')).scalar()
+        session.commit()
+        if not pending:
+            return
+        time.sleep(SETTLE_POLL)
+    for transfer_uuid in uuids:
+        router.resolve(shard, transfer_uuid)
+
+
+def init_sharding(app):
+    """Open the shards when SHARD_URIS is set."""
+    uris = setting(app.config, 'SHARD_URIS')
+    if not uris:
+        return
+    if app.config.get('TRANSFER_MODE', 'sync') != 'sync':
+        raise ValueError('TRANSFER_MODE async is not supported with SHARD_URIS')
+
+    router = ShardRouter(uris, app.config, app.root_path)
+    app.extensions['shard_router'] = router
+
+    @app.teardown_appcontext
+    def remove_shard_sessions(error):
+        router.remove()
+
+
+def shard_router():
+    """Return shard router of current app, None without sharding."""
+    return current_app.extensions.get('shard_router')
+
+
+def account_session(account_id):
+    """Return session of the database holding an account."""
+    router = shard_router()
+    return db.session if router is None else router.session_for(account_id)
+
+
+def upgrade_shards(app):
+    """Create or upgrade the tables of every shard of app."""
+    router = app.extensions.get('shard_router')
+    for engine in router.engines if router is not None else ():
+        upgrade(engine)
+
+
+def main(argv=None):
+    """Recover cross-shard transfers or move account ranges between shards."""
+    from banking_api import create_app
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--config', default='config.py')
+    commands = parser.add_subparsers(dest='command', required=True)
+    recover = commands.add_parser('recover', help='resolve interrupted transfers')
+    recover.add_argument('--age', type=float,
+                         help='only transfers prepared this many seconds ago '
+                              '(default SHARD_RECOVERY_AGE)')
+    move = commands.add_parser('move', help='move accounts FIRST to LAST to SHARD')
+    move.add_argument('first', type=int)
+    move.add_argument('last', type=int)
+    move.add_argument('shard', type=int)
+    move.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    app = create_app(args.config)
+    router = app.extensions.get('shard_router')
+    if router is None:
+        raise SystemExit('SHARD_URIS is not set, nothing to do')
+
+    with app.app_context():
+        age = setting(app.config, 'SHARD_RECOVERY_AGE')
+        if args.command == 'recover':
+            counts = router.recover(age if args.age is None else args.age)
+            print(f"{counts['committed']} transfers committed, "
+                  f"{counts['aborted']} aborted")
+        else:
+            if not 0 <= args.shard < len(router.sessions):
+                raise SystemExit(f'no shard {args.shard}')
+            moved = move_range(router, args.first, args.last, args.shard, age,
+                               args.chunk_size)
+            print(f'{moved} accounts moved to shard {args.shard}')
+
+
+if __name__ == '__main__':
+    main()
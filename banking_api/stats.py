@@ -0,0 +1,206 @@
+"""Per-account transfer statistics, maintained with every transfer.
+
+For each account AccountStats holds the amounts received and sent, the number
+of transfers and the time of the last one. The transfer engine updates the
+rows of the accounts it touches in the same commit as the balances, so
+``GET /account/<id>/summary`` and ``GET /customers/<id>/summary`` read a row
+per account instead of a whole history. A self transfer counts once, as both
+received and sent. Statistics of data loaded or written before this table
+existed are built with::
+
+    python -m banking_api.stats backfill
+"""
+import argparse
+
+from sqlalchemy import case, delete, func, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from banking_api.model import db, Account, AccountStats, ArchivedStats, Transaction
+
+CHUNK_SIZE = 10000
+
+# insert statements with ON CONFLICT DO UPDATE, other databases update then insert
+UPSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def transfer_deltas(transactions, account_ids=None):
+    """Return rows of statistics added by new transactions, per account.
+
+    Only accounts in ``account_ids`` are included when it is given.
+    """
+    deltas = {}
+    for transaction in transactions:
+        amount = transaction['amount']
+        timestamp = transaction['transaction_timestamp']
+        account_id_from = transaction['account_id_from']
+        account_id_to = transaction['account_id_to']
+        if account_id_from == account_id_to:
+            sides = [(account_id_from, amount, amount)]
+        else:
+            sides = [(account_id_from, 0, amount), (account_id_to, amount, 0)]
+
+        for account_id, received, sent in sides:
+            if account_ids is not None and account_id not in account_ids:
+                continue
+            row = deltas.setdefault(account_id, {
+                'account_id': account_id, 'total_in': 0, 'total_out': 0,
+                'transfer_count': 0, 'last_activity': timestamp})
+            row['total_in'] += received
+            row['total_out'] += sent
+            row['transfer_count'] += 1
+            row['last_activity'] = max(row['last_activity'], timestamp)
+    return [deltas[account_id] for account_id in sorted(deltas)]
+
+
+def record_transfers(transactions, session=None, account_ids=None, table=None):
+    """Add new transactions to the statistics, in the current session transaction.
+
+    ``table`` is AccountStats by default, the archive adds the transactions it
+    moves to ArchivedStats.
+    """
+    session = session or db.session
+    rows = transfer_deltas(transactions, account_ids)
+    if not rows:
+        return
+
+    table = AccountStats.__table__ if table is None else table
+    upsert = UPSERTS.get(session.connection().dialect.name)
+    if upsert is not None:
+        statement = upsert(table)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.account_id],
+            set_={'total_in': table.c.total_in + statement.excluded.total_in,
+                  'total_out': table.c.total_out + statement.excluded.total_out,
+                  'transfer_count': (table.c.transfer_count
+                                     + statement.excluded.transfer_count),
+                  'last_activity': _latest(table.c.last_activity,
+                                           statement.excluded.last_activity)}),
+            rows)
+        return
+
+    # the accounts are locked by the transfer, nobody else writes their rows
+    for row in rows:
+        updated = session.execute(
+            update(table).where(table.c.account_id == row['account_id'])
+            .values(total_in=table.c.total_in + row['total_in'],
+                    total_out=table.c.total_out + row['total_out'],
+                    transfer_count=table.c.transfer_count + row['transfer_count'],
+                    last_activity=_latest(table.c.last_activity,
+                                          row['last_activity']))).rowcount
+        if not updated:
+            session.execute(insert(table), [row])
+
+
+def _latest(current, new):
+    """Return SQL expression of the later of two timestamps, current may be NULL."""
+    return case((current.is_(None), new), (new > current, new), else_=current)
+
+
+def summaries(session, condition):
+    """Return balance and statistics of the accounts matching condition, by id."""
+    rows = session.execute(
+        select(Account.id, Account.balance, AccountStats.total_in,
+               AccountStats.total_out, AccountStats.transfer_count,
+               AccountStats.last_activity)
+        .outerjoin(AccountStats, AccountStats.account_id == Account.id)
+        .where(condition).order_by(Account.id))
+    return [{'account_id': account_id, 'balance': balance,
+             'total_in': total_in or 0, 'total_out': total_out or 0,
+             'transfer_count': transfer_count or 0, 'last_activity': last_activity}
+            for account_id, balance, total_in, total_out, transfer_count,
+            last_activity in rows]
+
+
+def backfill(chunk_size=CHUNK_SIZE, session=None):
+    """Rebuild statistics of every account from the transactions, return accounts done.
+
+    Accounts are processed in chunks of ``chunk_size``, each replaced in one
+    write transaction, so transfers committed meanwhile are not lost. The
+    totals carried forward from archived transactions are added, so it must
+    not run while the archive job deletes rows. With sharding it runs once
+    per shard, on the session of the shard.
+    """
+    from banking_api.transfers import run_write_transaction
+
+    session = session or db.session
+    table = Transaction.__table__
+    done = 0
+    last = 0
+    while True:
+        ids = session.execute(
+            select(Account.id).where(Account.id > last)
+            .order_by(Account.id).limit(chunk_size)).scalars().all()
+        session.commit()
+        if not ids:
+            return done
+        first, last = ids[0], ids[-1]
+
+        def work():
+            rows = {}
+            sent = session.execute(
+                select(table.c.account_id_from, func.sum(table.c.amount),
+                       func.count(), func.max(table.c.transaction_timestamp),
+                       func.sum(case((table.c.account_id_to == table.c.account_id_from,
+                                      table.c.amount), else_=0)))
+                .where(table.c.account_id_from.in_(ids))
+                .group_by(table.c.account_id_from))
+            for account_id, total, count, latest, to_self in sent:
+                rows[account_id] = {'account_id': account_id, 'total_in': int(to_self),
+                                    'total_out': int(total), 'transfer_count': count,
+                                    'last_activity': latest}
+            received = session.execute(
+                select(table.c.account_id_to, func.sum(table.c.amount), func.count(),
+                       func.max(table.c.transaction_timestamp))
+                .where(table.c.account_id_to.in_(ids),
+                       table.c.account_id_from != table.c.account_id_to)
+                .group_by(table.c.account_id_to))
+            for account_id, total, count, latest in received:
+                row = rows.setdefault(account_id, {
+                    'account_id': account_id, 'total_in': 0, 'total_out': 0,
+                    'transfer_count': 0, 'last_activity': latest})
+                row['total_in'] += int(total)
+                row['transfer_count'] += count
+                row['last_activity'] = max(row['last_activity'], latest)
+            archived = session.execute(
+                select(ArchivedStats.account_id, ArchivedStats.total_in,
+                       ArchivedStats.total_out, ArchivedStats.transfer_count,
+                       ArchivedStats.last_activity)
+                .where(ArchivedStats.account_id.in_(ids)))
+            for account_id, total_in, total_out, count, latest in archived:
+                row = rows.setdefault(account_id, {
+                    'account_id': account_id, 'total_in': 0, 'total_out': 0,
+                    'transfer_count': 0, 'last_activity': latest})
+                row['total_in'] += total_in
+                row['total_out'] += total_out
+                row['transfer_count'] += count
+                row['last_activity'] = max(row['last_activity'], latest)
+
+            stats = AccountStats.__table__
+            session.execute(delete(stats).where(stats.c.account_id.between(first, last)))
+            if rows:
+                session.execute(insert(stats), list(rows.values()))
+
+        run_write_transaction(work, session)
+        done += len(ids)
+
+
+def main(argv=None):
+    """Run a statistics maintenance job from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('job', choices=['backfill'])
+    parser.add_argument('--config', default='config.py')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    from banking_api import create_app
+
+    app = create_app(args.config)
+    with app.app_context():
+        router = app.extensions.get('shard_router')
+        sessions = router.sessions if router is not None else [db.session]
+        done = sum(backfill(args.chunk_size, session) for session in sessions)
+        print(f'statistics of {done} accounts rebuilt')
+
+
+if __name__ == '__main__':
+    main()
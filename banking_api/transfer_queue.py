@@ -0,0 +1,309 @@
+"""Durable queue of transfers applied asynchronously by a group-commit writer.
+
+With TRANSFER_MODE = 'async', POST /transactions checks a transfer, stores it
+in the queue and answers 202 with its uuid straight away. A single writer
+thread takes up to TRANSFER_QUEUE_BATCH queued transfers at a time and applies
+them with transfers.transfer_batch in one database transaction, so hundreds
+of requests share one commit instead of each request thread waiting its turn
+for the SQLite write lock. Transfers queued while a batch commits make up the
+next batch, so batches grow with load and latency stays low when idle.
+
+The queue is a table in its own SQLite file, TRANSFER_QUEUE_PATH, so
+enqueueing never waits for the main database lock, and queued transfers
+survive a restart. The writer runs either as a thread in every process serving
+the app (TRANSFER_QUEUE_WRITER = 'thread'), where an exclusive lock on
+``<queue file>.lock`` lets only one of them drain the queue and another takes
+over when it exits, or as a dedicated process started with
+``python -m banking_api.transfer_queue`` (TRANSFER_QUEUE_WRITER = 'process').
+A transfer keeps its queue uuid as transaction uuid, so one found already
+committed after a crash between the two commits is only marked committed,
+never applied twice.
+"""
+import argparse
+import fcntl
+import logging
+import os
+import threading
+import uuid
+from datetime import timedelta
+
+from flask import current_app
+from sqlalchemy import (Column, DateTime, Index, Integer, MetaData, String, Table,
+                        bindparam, create_engine, delete, event, func, insert, select,
+                        update)
+from sqlalchemy.pool import QueuePool
+
+from banking_api import transfers
+from banking_api.model import db, Cents, Transaction, utc_now
+
+log = logging.getLogger(__name__)
+
+# defaults used when a setting is missing from the config file
+DEFAULTS = {
+    'TRANSFER_MODE': 'sync',
+    'TRANSFER_QUEUE_PATH': 'transfer_queue.db',
+    'TRANSFER_QUEUE_WRITER': 'thread',
+    'TRANSFER_QUEUE_BATCH': 500,
+    'TRANSFER_QUEUE_POLL_MS': 50,
+    'TRANSFER_QUEUE_RETENTION': 7 * 24 * 3600,
+}
+
+# seconds between attempts of a standby writer to take over the queue
+LOCK_RETRY = 1
+
+metadata = MetaData()
+
+queued_transfer = Table(
+    'transfer_queue', metadata,
+    Column('seq', Integer, primary_key=True),
+    Column('uuid', String(80), nullable=False, unique=True),
+    Column('account_id_from', Integer, nullable=False),
+    Column('account_id_to', Integer, nullable=False),
+    Column('amount', Cents, nullable=False),
+    # queued, then committed or failed
+    Column('status', String(20), nullable=False),
+    Column('message', String(200)),
+    # UTC
+    Column('transaction_timestamp', DateTime),
+    Column('enqueued_at', DateTime, nullable=False),
+    Column('done_at', DateTime),
+    Index('ix_transfer_queue_status', 'status', 'seq'),
+    sqlite_autoincrement=True)
+
+
+def setting(config, name):
+    """Return a transfer queue setting from config, or its default."""
+    return config.get(name, DEFAULTS[name])
+
+
+class TransferQueue():
+    """Transfers waiting to be applied, in a SQLite file of their own."""
+
+    def __init__(self, path):
+        """Open queue file, creating it if needed."""
+        self.path = path
+        self.engine = create_engine(
+            f'sqlite:///{path}', poolclass=QueuePool, pool_size=5, max_overflow=20,
+            connect_args={'check_same_thread': False, 'timeout': 30})
+        event.listen(self.engine, 'connect', _set_pragmas)
+        metadata.create_all(self.engine)
+        # set by put() to wake up a writer in the same process
+        self.wakeup = threading.Event()
+
+    def put(self, account_id_from, account_id_to, amount):
+        """Store a transfer of amount in cents and return its uuid."""
+        transfer_uuid = str(uuid.uuid4())
+        with self.engine.begin() as connection:
+            connection.execute(insert(queued_transfer).values(
+                uuid=transfer_uuid, account_id_from=account_id_from,
+                account_id_to=account_id_to, amount=amount, status='queued',
+                enqueued_at=utc_now()))
+        self.wakeup.set()
+        return transfer_uuid
+
+    def get(self, transfer_uuid):
+        """Return queue row of a transfer as a dict, None if unknown."""
+        with self.engine.connect() as connection:
+            row = connection.execute(select(queued_transfer).where(
+                queued_transfer.c.uuid == transfer_uuid)).first()
+        return dict(row._mapping) if row is not None else None
+
+    def take(self, limit):
+        """Return the oldest queued transfers, at most limit."""
+        with self.engine.connect() as connection:
+            return connection.execute(
+                select(queued_transfer).where(queued_transfer.c.status == 'queued')
+                .order_by(queued_transfer.c.seq).limit(limit)).fetchall()
+
+    def finish(self, outcomes):
+        """Record outcomes, dicts with uuid, status, message and transaction_timestamp."""
+        if not outcomes:
+            return
+        statement = (update(queued_transfer)
+                     .where(queued_transfer.c.uuid == bindparam('transfer_uuid'))
+                     .values(status=bindparam('status'), message=bindparam('message'),
+                             transaction_timestamp=bindparam('timestamp'),
+                             done_at=utc_now()))
+        with self.engine.begin() as connection:
+            connection.execute(statement, [
+                {'transfer_uuid': o['uuid'], 'status': o['status'],
+                 'message': o.get('message'), 'timestamp': o.get('transaction_timestamp')}
+                for o in outcomes])
+
+    def depth(self):
+        """Return number of transfers waiting to be applied."""
+        with self.engine.connect() as connection:
+            return connection.execute(
+                select(func.count()).select_from(queued_transfer)
+                .where(queued_transfer.c.status == 'queued')).scalar()
+
+    def purge(self, before):
+        """Delete transfers applied or failed before a time, return how many."""
+        with self.engine.begin() as connection:
+            return connection.execute(
+                delete(queued_transfer).where(queued_transfer.c.status != 'queued',
+                                              queued_transfer.c.done_at < before)
+            ).rowcount
+
+
+def _set_pragmas(dbapi_connection, connection_record):
+    """Make every commit to the queue durable before a request is answered."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=FULL')
+    cursor.close()
+
+
+def process_batch(queue, limit):
+    """Apply up to limit queued transfers in one transaction, return how many.
+
+    Must run in an app context, and only in the writer holding the queue lock.
+    """
+    rows = queue.take(limit)
+    if not rows:
+        return 0
+
+    # transfers committed before a crash, but not yet marked in the queue
+    done = {r.uuid: r for r in db.session.execute(
+        select(Transaction.uuid, Transaction.transaction_timestamp)
+        .where(Transaction.uuid.in_([r.uuid for r in rows])))}
+    outcomes = [{'uuid': r.uuid, 'status': 'committed',
+                 'transaction_timestamp': done[r.uuid].transaction_timestamp}
+                for r in rows if r.uuid in done]
+
+    pending = [r for r in rows if r.uuid not in done]
+    if pending:
+        results = transfers.transfer_batch(
+            [(r.account_id_from, r.account_id_to, r.amount) for r in pending],
+            atomic=False, uuids=[r.uuid for r in pending])
+        for row, result in zip(pending, results):
+            if isinstance(result, transfers.TransferError):
+                outcomes.append({'uuid': row.uuid, 'status': 'failed',
+                                 'message': result.message})
+            else:
+                outcomes.append({'uuid': row.uuid, 'status': 'committed',
+                                 'transaction_timestamp':
+                                     result['transaction_timestamp']})
+
+    queue.finish(outcomes)
+    return len(rows)
+
+
+def drain(queue, limit=DEFAULTS['TRANSFER_QUEUE_BATCH']):
+    """Apply queued transfers in batches until the queue is empty, return how many."""
+    processed = 0
+    while True:
+        count = process_batch(queue, limit)
+        if not count:
+            return processed
+        processed += count
+
+
+class QueueWriter(threading.Thread):
+    """Thread applying queued transfers while it holds the queue lock."""
+
+    def __init__(self, app, queue):
+        """Create writer for the queue of app, call start() to run it."""
+        super().__init__(name='transfer-queue-writer', daemon=True)
+        self.app = app
+        self.queue = queue
+        self.batch = setting(app.config, 'TRANSFER_QUEUE_BATCH')
+        self.poll = setting(app.config, 'TRANSFER_QUEUE_POLL_MS') / 1000
+        self.retention = setting(app.config, 'TRANSFER_QUEUE_RETENTION')
+        self.stopping = threading.Event()
+
+    def run(self):
+        """Wait for the queue lock, then apply transfers until stopped."""
+        with open(self.queue.path + '.lock', 'a') as lock_file:
+            while not self.stopping.is_set():
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    self.stopping.wait(LOCK_RETRY)
+            else:
+                return
+
+            with self.app.app_context():
+                self._drain_until_stopped()
+
+    def _drain_until_stopped(self):
+        """Apply batches as transfers arrive, purging old ones now and then."""
+        next_purge = utc_now()
+        while not self.stopping.is_set():
+            self.queue.wakeup.clear()
+            try:
+                count = process_batch(self.queue, self.batch)
+                if next_purge <= utc_now():
+                    self.queue.purge(utc_now() - timedelta(seconds=self.retention))
+                    next_purge = utc_now() + timedelta(minutes=1)
+            except Exception:
+                log.exception('applying queued transfers failed, retrying')
+                count = 0
+            finally:
+                db.session.remove()
+
+            # transfers queued by other processes are found by polling
+            if not count:
+                self.queue.wakeup.wait(self.poll)
+
+    def stop(self):
+        """Stop writer after the batch in progress and wait for it."""
+        self.stopping.set()
+        self.queue.wakeup.set()
+        self.join()
+
+
+def init_queue(app):
+    """Open transfer queue when app runs in async transfer mode."""
+    mode = setting(app.config, 'TRANSFER_MODE')
+    if mode == 'sync':
+        return
+    elif mode != 'async':
+        raise ValueError(f"unknown TRANSFER_MODE {mode!r}, use 'sync' or 'async'")
+
+    # relative paths are relative to the app, like relative SQLite databases
+    path = os.path.join(app.root_path, setting(app.config, 'TRANSFER_QUEUE_PATH'))
+    app.extensions['transfer_queue'] = TransferQueue(path)
+
+
+def start_writer(app):
+    """Start the queue writer thread of app, return it or None if it has none."""
+    queue = app.extensions.get('transfer_queue')
+    if queue is None or setting(app.config, 'TRANSFER_QUEUE_WRITER') != 'thread':
+        return None
+    writer = QueueWriter(app, queue)
+    writer.start()
+    app.extensions['transfer_queue_writer'] = writer
+    return writer
+
+
+def transfer_queue():
+    """Return transfer queue of current app, None in sync mode."""
+    return current_app.extensions.get('transfer_queue')
+
+
+def main(argv=None):
+    """Run the queue writer in the foreground, as a dedicated writer process."""
+    from banking_api import create_app
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--config', default='config.py')
+    args = parser.parse_args(argv)
+
+    app = create_app(args.config)
+    queue = app.extensions.get('transfer_queue')
+    if queue is None:
+        raise SystemExit('TRANSFER_MODE is not async, nothing to do')
+
+    writer = QueueWriter(app, queue)
+    writer.start()
+    try:
+        while writer.is_alive():
+            writer.join(1)
+    except KeyboardInterrupt:
+        writer.stop()
+
+
+if __name__ == '__main__':
+    main()
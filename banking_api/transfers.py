@@ -0,0 +1,258 @@
+"""Transfer engine moving amounts between accounts safely under concurrency.
+
+Balances are never read, changed in Python and written back. Each transfer
+applies ``UPDATE account SET balance = balance + :delta`` statements inside a
+write transaction that is locked up front:
+
+- on SQLite with ``BEGIN IMMEDIATE``, so concurrent writers queue on the
+  database lock instead of failing half way through a transaction,
+- on server databases with ``SELECT ... FOR UPDATE`` on the accounts involved,
+  always in ascending id order so two transfers cannot deadlock.
+
+Lock timeouts, deadlocks and serialization failures are retried a bounded
+number of times with exponential backoff and jitter. Transfer limits, when
+configured, are checked under the same locks, so concurrent transfers of an
+account cannot pass them together. The ledger entries, statistics and outbox
+event of a transfer are written in its commit.
+"""
+import random
+import time
+import uuid
+
+from flask import current_app
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.exc import OperationalError, DBAPIError
+
+from banking_api.account_index import mark_changed
+from banking_api.cache import invalidate_balances
+from banking_api import events, stats
+from banking_api.ledger import record_transfers
+from banking_api.limits import transfer_limits
+from banking_api.model import db, Account, Transaction, utc_now
+
+MAX_RETRIES = 5
+RETRY_BACKOFF = 0.01
+
+# fragments of driver error messages worth retrying the transaction for
+RETRYABLE_ERRORS = ('database is locked', 'database table is locked', 'deadlock',
+                    'could not serialize', 'lock wait timeout')
+
+
+class TransferError(Exception):
+    """Raised when a transfer cannot be processed."""
+
+    def __init__(self, message):
+        """Create error with message returned to the client."""
+        super().__init__(message)
+        self.message = message
+
+
+class AccountNotFound(TransferError):
+    """Raised when an account of a transfer does not exist."""
+
+    def __init__(self):
+        """Create error with the message used by the routes."""
+        super().__init__('Check account id')
+
+
+class LimitExceeded(TransferError):
+    """Raised when a transfer breaks a transfer limit."""
+
+
+def transfer(account_id_from, account_id_to, amount, session=None):
+    """Transfer amount in cents between two accounts and return the transaction.
+
+    Raise TransferError when an account id is not an integer, AccountNotFound
+    when either account does not exist and LimitExceeded when the transfer
+    breaks a limit, in which case nothing is written. ``session`` is the
+    session of the database holding both accounts, db.session by default.
+    """
+    session = session or db.session
+    check_account_ids(account_id_from, account_id_to)
+
+    def work():
+        account_ids = {account_id_from, account_id_to}
+        balances = _lock_accounts(account_ids, session)
+        if len(balances) != len(account_ids):
+            raise AccountNotFound()
+        check_limits(account_id_from, account_id_to, amount,
+                     balances[account_id_from], session=session)
+
+        # a transfer of an account to itself leaves its balance unchanged
+        deltas = {account_id_from: -amount}
+        deltas[account_id_to] = deltas.get(account_id_to, 0) + amount
+        _apply_deltas(deltas, session)
+        transaction = new_transaction(account_id_from, account_id_to, amount)
+        session.execute(insert(Transaction.__table__), [transaction])
+        record_transfers([transaction], session)
+        stats.record_transfers([transaction], session)
+        events.record_transfers([transaction], session)
+        return transaction
+
+    transaction = run_write_transaction(work, session)
+    invalidate_balances((account_id_from, account_id_to))
+    mark_changed()
+    return transaction
+
+
+def check_account_ids(*account_ids):
+    """Raise TransferError unless every account id is an integer."""
+    for account_id in account_ids:
+        if isinstance(account_id, bool) or not isinstance(account_id, int):
+            raise TransferError('account ids must be integers')
+
+
+def transfer_batch(transfers, atomic=True, uuids=None):
+    """Apply many transfers in a single database transaction.
+
+    ``transfers`` is a list of (account_id_from, account_id_to, amount) with
+    amounts in cents, ``uuids`` optionally the uuids their transactions get.
+    Return a list holding the new transaction dict or the TransferError of
+    each transfer, in order. In an atomic batch nothing is written when any
+    transfer fails.
+    """
+    def work():
+        account_ids = set()
+        for account_id_from, account_id_to, _ in transfers:
+            account_ids.update((account_id_from, account_id_to))
+        balances = _lock_accounts(account_ids)
+
+        results = []
+        deltas = {}
+        # (count, amount) paid by each account in the batch so far
+        paid = {}
+        for index, (account_id_from, account_id_to, amount) in enumerate(transfers):
+            if account_id_from not in balances or account_id_to not in balances:
+                results.append(AccountNotFound())
+                continue
+            try:
+                check_limits(account_id_from, account_id_to, amount,
+                             balances[account_id_from] + deltas.get(account_id_from, 0),
+                             paid.get(account_id_from, (0, 0)))
+            except LimitExceeded as error:
+                results.append(error)
+                continue
+
+            count, total = paid.get(account_id_from, (0, 0))
+            paid[account_id_from] = (count + 1, total + amount)
+
+            deltas[account_id_from] = deltas.get(account_id_from, 0) - amount
+            deltas[account_id_to] = deltas.get(account_id_to, 0) + amount
+            results.append(new_transaction(account_id_from, account_id_to, amount,
+                                           uuids[index] if uuids else None))
+
+        new_transactions = [r for r in results if isinstance(r, dict)]
+        if (atomic and len(new_transactions) != len(results)) or not new_transactions:
+            db.session.rollback()
+            return results
+
+        _apply_deltas(deltas)
+        db.session.execute(insert(Transaction.__table__), new_transactions)
+        record_transfers(new_transactions)
+        stats.record_transfers(new_transactions)
+        events.record_transfers(new_transactions)
+        return results
+
+    results = run_write_transaction(work)
+    changed = {account_id for r in results if isinstance(r, dict)
+               for account_id in (r['account_id_from'], r['account_id_to'])}
+    if changed:
+        invalidate_balances(changed)
+        mark_changed()
+    return results
+
+
+def run_write_transaction(work, session=None):
+    """Run work() in a locked write transaction, commit it and return its result.
+
+    The transaction is retried with backoff when the database reports lock
+    contention, any other error rolls back and is raised.
+    """
+    session = session or db.session
+    max_retries = current_app.config.get('TRANSFER_MAX_RETRIES', MAX_RETRIES)
+    backoff = current_app.config.get('TRANSFER_RETRY_BACKOFF', RETRY_BACKOFF)
+
+    for attempt in range(max_retries + 1):
+        try:
+            _begin_write(session)
+            result = work()
+            session.commit()
+            return result
+
+        except (OperationalError, DBAPIError) as error:
+            session.rollback()
+            if attempt == max_retries or not _is_retryable(error):
+                raise
+            time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+        except Exception:
+            session.rollback()
+            raise
+
+
+def _is_retryable(error):
+    """Return True if a database error is caused by lock contention."""
+    message = str(error.orig if getattr(error, 'orig', None) else error).lower()
+    return any(fragment in message for fragment in RETRYABLE_ERRORS)
+
+
+def _begin_write(session):
+    """Start the session transaction holding the SQLite write lock."""
+    connection = session.connection()
+    if connection.dialect.name == 'sqlite':
+        # pysqlite only opens a transaction before the first write statement,
+        # take the write lock now so the whole transfer runs under it
+        if not connection.connection.in_transaction:
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+
+def check_limits(account_id_from, account_id_to, amount, balance, pending=(0, 0),
+                 session=None):
+    """Raise LimitExceeded if a transfer breaks a transfer limit of the app.
+
+    Must run in the locked write transaction of the transfer. ``balance`` is
+    the balance in cents of the paying account before the transfer, and
+    ``pending`` the (count, amount) it paid earlier in the same batch.
+    """
+    limits = transfer_limits()
+    if limits is None:
+        return
+    # moving money within one account cannot take it below the floor
+    if account_id_from == account_id_to:
+        balance = None
+    message = limits.check(session or db.session, account_id_from, amount, balance,
+                           pending)
+    if message is not None:
+        raise LimitExceeded(message)
+
+
+def _lock_accounts(account_ids, session=None):
+    """Return {id: balance} of the account ids that exist, row locked where supported."""
+    session = session or db.session
+    query = (select(Account.id, Account.balance)
+             .where(Account.id.in_(sorted(account_ids))).order_by(Account.id))
+    if session.connection().dialect.name != 'sqlite':
+        query = query.with_for_update()
+    return dict(session.execute(query).all())
+
+
+def _apply_deltas(deltas, session=None):
+    """Add signed amounts in cents to account balances, in ascending id order."""
+    statement = (update(Account.__table__)
+                 .where(Account.__table__.c.id == bindparam('account_id'))
+                 .values(balance=Account.__table__.c.balance + bindparam('delta')))
+    params = [{'account_id': account_id, 'delta': delta}
+              for account_id, delta in sorted(deltas.items()) if delta]
+    if params:
+        (session or db.session).execute(statement, params)
+
+
+def new_transaction(account_id_from, account_id_to, amount, transaction_uuid=None):
+    """Create the row of a new transaction."""
+    return {
+        'uuid': transaction_uuid or str(uuid.uuid4()),
+        'account_id_from': account_id_from,
+        'account_id_to': account_id_to,
+        'amount': amount,
+        'transaction_timestamp': utc_now()
+    }
@@ -0,0 +1 @@
+"""Benchmark scripts for banking API, run with ``python -m benchmarks.<name>``."""
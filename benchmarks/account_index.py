@@ -0,0 +1,122 @@
+"""Measure memory and read latency of the account index, with many accounts.
+
+``--accounts`` accounts are seeded and loaded into the index, tracing the
+memory it holds. The same is traced for ``--orm`` Account objects held by a
+session, as identity maps do, and for a dict of balances, and scaled to all
+accounts. Then ``--reads`` balances of random accounts are read from the
+index, with ``session.get`` as the routes checked accounts, with a select of
+the balance alone, and through GET /account/<id> with the index off and on.
+Account ids are ``--id-step`` apart, above 2 the index holds them sorted.
+"""
+import argparse
+import random
+import time
+import tracemalloc
+
+from sqlalchemy import insert
+
+from banking_api.account_index import AccountIndex
+from banking_api.model import db, Account, Customer
+from banking_api.routes import _load_balance
+from benchmarks.common import make_app, percentiles, Timer
+
+
+def seed(n_accounts, n_customers=1000, chunk_size=100000, id_step=1):
+    """Insert customers and n_accounts accounts id_step apart, in chunks."""
+    db.session.execute(insert(Customer.__table__), [
+        {'id': i, 'name': f'Customer {i}', 'identification': f'id{i}'}
+        for i in range(1, n_customers + 1)])
+    rng = random.Random(0)
+    for first in range(1, n_accounts + 1, chunk_size):
+        db.session.execute(insert(Account.__table__), [
+            {'id': i * id_step, 'balance': rng.randint(0, 10 ** 8),
+             'customer_id': i % n_customers + 1}
+            for i in range(first, min(first + chunk_size, n_accounts + 1))])
+        db.session.commit()
+
+
+def traced(build):
+    """Return (result of build(), bytes it still holds, peak bytes while building)."""
+    tracemalloc.start()
+    result = build()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, peak
+
+
+def timed(read, account_ids, after=None):
+    """Return latency percentiles of read(account_id) over account_ids."""
+    samples = []
+    for account_id in account_ids:
+        begin = time.perf_counter()
+        read(account_id)
+        samples.append(time.perf_counter() - begin)
+        if after is not None:
+            after()
+    return percentiles(samples)
+
+
+def main():
+    """Run benchmark and print memory per account and read latency."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--accounts', type=int, default=10 ** 7)
+    parser.add_argument('--orm', type=int, default=100000)
+    parser.add_argument('--reads', type=int, default=20000)
+    parser.add_argument('--id-step', type=int, default=1)
+    args = parser.parse_args()
+
+    app = make_app()
+    with Timer() as seeding:
+        seed(args.accounts, id_step=args.id_step)
+    print(f'{args.accounts} accounts seeded in {seeding.elapsed:.0f} s')
+
+    index = AccountIndex(refresh=3600)
+    with Timer() as loading:
+        index.load(db.engine)
+    # loaded again to trace it, tracing slows loading down
+    _, held, peak = traced(lambda: index.load(db.engine))
+    layout = 'sorted ids' if index.ids is not None else 'array indexed by id'
+    print(f'index ({layout}) loaded in {loading.elapsed:.1f} s, '
+          f'holds {held / 2 ** 20:.0f} MiB, peak {peak / 2 ** 20:.0f} MiB')
+
+    _, orm, _ = traced(lambda: db.session.query(Account).limit(args.orm).all())
+    db.session.remove()
+    balances, plain, _ = traced(lambda: dict(db.session.query(Account.id, Account.balance)
+                                             .limit(args.orm).all()))
+    del balances
+    print(f'{"held as":<20} {"bytes/account":>13} {"MiB for all":>12}')
+    for name, size, count in (('index array', held, args.accounts),
+                              ('ORM identity map', orm, args.orm),
+                              ('dict of balances', plain, args.orm)):
+        print(f'{name:<20} {size / count:>13.1f} '
+              f'{size / count * args.accounts / 2 ** 20:>12.0f}')
+
+    with Timer() as verifying:
+        report = index.verify()
+    print(f'verify of {report["accounts"]} accounts: {report["mismatches"]} '
+          f'mismatches in {verifying.elapsed:.1f} s')
+
+    rng = random.Random(1)
+    account_ids = [rng.randint(1, args.accounts) * args.id_step
+                   for _ in range(args.reads)]
+    client = app.test_client()
+    print(f'{"read":<28} {"p50 ms":>8} {"p99 ms":>8}')
+    reads = (
+        ('index', index.balance, None),
+        ('session.get(Account)', lambda a: db.session.get(Account, a),
+         db.session.expunge_all),
+        ('select balance', _load_balance, None),
+        ('GET /account index off', lambda a: client.get(f'/account/{a}'), None))
+    for name, read, after in reads:
+        stats = timed(read, account_ids, after)
+        print(f'{name:<28} {stats["p50"]:>8.4f} {stats["p99"]:>8.4f}')
+    app.extensions['account_index'] = index
+    stats = timed(lambda a: client.get(f'/account/{a}'), account_ids)
+    print(f'{"GET /account index on":<28} {stats["p50"]:>8.4f} {stats["p99"]:>8.4f}')
+    index.refresh = index._next_refresh = 0
+    stats = timed(index.balance, account_ids)
+    print(f'{"index, catch up every read":<28} {stats["p50"]:>8.4f} {stats["p99"]:>8.4f}')
+
+
+if __name__ == '__main__':
+    main()
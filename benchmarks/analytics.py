@@ -0,0 +1,117 @@
+"""Compare the analytics export with aggregating per-account API histories.
+
+A database is seeded with ``--rows`` transactions between ``--accounts``
+accounts over ``--days`` days. The analytics export then computes all reports
+from the transaction table, and the API loop fetches the history of every
+account from ``GET /account/<id>/transactions``, as finance scripts do, and
+adds up its daily volume. ``--api-accounts`` limits the loop to a sample of
+accounts, and its time is then scaled up to all of them. ``--database``
+keeps the seeded file for later runs::
+
+    python -m benchmarks.analytics --rows 10000000 --api-accounts 500
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import shutil
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+
+from banking_api import analytics
+from banking_api.model import db, Transaction
+from benchmarks.common import make_app, seed_accounts, Timer
+
+SEED_START = datetime(2021, 1, 1)
+
+
+def seed_transactions(n_rows, n_accounts, n_days, chunk_size=100000):
+    """Insert n_rows random transactions in bulk, spread over n_days."""
+    rng = random.Random(n_rows)
+    seconds = n_days * 24 * 3600
+    for first in range(0, n_rows, chunk_size):
+        with db.engine.begin() as connection:
+            connection.execute(Transaction.__table__.insert(), [
+                {'uuid': f'bench-{i:010d}',
+                 'account_id_from': rng.randint(1, n_accounts),
+                 'account_id_to': rng.randint(1, n_accounts),
+                 'amount': rng.randint(1, 100000),
+                 'transaction_timestamp': SEED_START + timedelta(
+                     seconds=seconds * i // n_rows)}
+                for i in range(first, min(first + chunk_size, n_rows))])
+
+
+def api_daily_volume(client, account_id):
+    """Return {day: [amount in, amount out]} of an account from its API history."""
+    response = client.get(f'/account/{account_id}/transactions', buffered=False)
+    history = json.loads(b''.join(response.response))
+    days = collections.defaultdict(lambda: [0, 0])
+    for transaction in history['transactions']:
+        day = transaction['transaction_timestamp'][:10]
+        if transaction['account_id_to'] == account_id:
+            days[day][0] += transaction['amount']
+        if transaction['account_id_from'] == account_id:
+            days[day][1] += transaction['amount']
+    return days
+
+
+def main():
+    """Seed transactions, run both exports and print time and memory."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--accounts', type=int, default=10000)
+    parser.add_argument('--customers', type=int, default=2500)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--chunk-size', type=int, default=analytics.CHUNK_SIZE)
+    parser.add_argument('--rows-per-pass', type=int, default=analytics.ROWS_PER_PASS)
+    parser.add_argument('--api-accounts', type=int,
+                        help='accounts fetched through the API, default all')
+    parser.add_argument('--database', help='SQLite file, seeded unless it exists')
+    args = parser.parse_args()
+
+    seeded = args.database is not None and os.path.exists(args.database)
+    app = make_app(args.database, fresh=False)
+    client = app.test_client()
+    if not seeded:
+        seed_accounts(args.accounts, n_customers=args.customers)
+        with Timer() as seeding:
+            seed_transactions(args.rows, args.accounts, args.days)
+        print(f'{args.rows} transactions between {args.accounts} accounts seeded in '
+              f'{seeding.elapsed:.0f} s')
+
+    output_dir = tempfile.mkdtemp(prefix='banking_analytics_')
+    try:
+        with Timer() as export:
+            written = analytics.export(output_dir, chunk_size=args.chunk_size,
+                                       rows_per_pass=args.rows_per_pass)
+        size = sum(os.path.getsize(path) for path, _ in written.values())
+        rows = ', '.join(f'{report} {n}' for report, (_, n) in written.items())
+        print(f'analytics export: {export.elapsed:.1f} s, '
+              f'{args.rows / export.elapsed:.0f} transactions/s, {rows} rows, '
+              f'{size / 2 ** 20:.1f} MB written')
+
+        # a second run under tracemalloc, which slows it down, for its peak memory
+        tracemalloc.start()
+        analytics.export(output_dir, chunk_size=args.chunk_size,
+                         rows_per_pass=args.rows_per_pass)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f'analytics export: peak {peak / 2 ** 20:.0f} MB traced')
+    finally:
+        shutil.rmtree(output_dir)
+
+    n_api = min(args.api_accounts or args.accounts, args.accounts)
+    account_ids = random.Random(0).sample(range(1, args.accounts + 1), n_api)
+    with Timer() as loop:
+        for account_id in account_ids:
+            api_daily_volume(client, account_id)
+    estimate = loop.elapsed * args.accounts / n_api
+    print(f'API loop: {n_api} accounts in {loop.elapsed:.1f} s, '
+          f'{"estimated " if n_api < args.accounts else ""}{estimate:.0f} s for all '
+          f'{args.accounts}, {estimate / export.elapsed:.0f}x the analytics export')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Measure table size and history latency before and after archiving old transactions.
+
+``--transactions`` transfers between ``--accounts`` accounts are spread over
+the last ``--months`` months, then the transactions older than
+``--horizon-days`` are moved to archive segments. Before and after, the
+database is vacuumed and its size measured, and ``--reads`` histories of
+random accounts are read: the first page, which starts in the archive, a
+page of the recent transactions, the full history, and a range of all
+transactions, which only reads the table.
+"""
+import argparse
+import os
+import random
+import uuid
+from datetime import timedelta
+
+from sqlalchemy import insert, text
+
+from banking_api import archive
+from banking_api.model import db, Transaction, utc_now
+from benchmarks.common import make_app, seed_accounts, percentiles, Timer
+
+
+def seed_transactions(n_transactions, n_accounts, months, chunk_size=100000):
+    """Insert transfers between random accounts, evenly spread over months to now."""
+    rng = random.Random(0)
+    now = utc_now()
+    step = timedelta(days=30 * months) / n_transactions
+    first = now - step * n_transactions
+    for offset in range(0, n_transactions, chunk_size):
+        db.session.execute(insert(Transaction.__table__), [
+            {'uuid': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+             'account_id_from': rng.randint(1, n_accounts),
+             'account_id_to': rng.randint(1, n_accounts),
+             'amount': rng.randint(1, 10 ** 5),
+             'transaction_timestamp': first + step * i}
+            for i in range(offset, min(offset + chunk_size, n_transactions))])
+        db.session.commit()
+
+
+def database_size():
+    """Return (bytes, transactions) of the database once vacuumed."""
+    db.session.remove()
+    with db.engine.connect() as connection:
+        connection.exec_driver_sql('VACUUM')
+        pages = connection.execute(text('PRAGMA page_count')).scalar()
+        page_size = connection.execute(text('PRAGMA page_size')).scalar()
+        count = connection.execute(text('SELECT COUNT(*) FROM "transaction"')).scalar()
+    return pages * page_size, count
+
+
+def directory_size(directory):
+    """Return (bytes, files) of the segment files under directory."""
+    size, files = 0, 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            size += os.path.getsize(os.path.join(root, name))
+            files += 1
+    return size, files
+
+
+def read_latencies(client, account_ids, horizon):
+    """Return latency percentiles of each kind of history read."""
+    since = horizon.isoformat()
+    until = (horizon + timedelta(hours=1)).isoformat()
+    reads = {
+        'first page': lambda a: f'/account/{a}/transactions?limit=100',
+        'recent page': lambda a: f'/account/{a}/transactions?limit=100&from={since}',
+        'full history': lambda a: f'/account/{a}/transactions',
+        'range of all': lambda a: f'/transactions?from={since}&to={until}&limit=100',
+    }
+    results = {}
+    for name, url in reads.items():
+        samples = []
+        for account_id in account_ids:
+            with Timer() as timer:
+                response = client.get(url(account_id))
+                response.get_data()
+            assert response.status_code == 200, response.json
+            samples.append(timer.elapsed)
+        results[name] = percentiles(samples)
+    return results
+
+
+def main():
+    """Run benchmark and print table size and history latency before and after."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--accounts', type=int, default=10000)
+    parser.add_argument('--transactions', type=int, default=2 * 10 ** 6)
+    parser.add_argument('--months', type=int, default=24)
+    parser.add_argument('--horizon-days', type=float, default=365)
+    parser.add_argument('--reads', type=int, default=500)
+    args = parser.parse_args()
+
+    app = make_app()
+    directory = os.path.join(os.path.dirname(db.engine.url.database), 'archive')
+    app.config['ARCHIVE_DIR'] = directory
+    seed_accounts(args.accounts)
+    with Timer() as seeding:
+        seed_transactions(args.transactions, args.accounts, args.months)
+    print(f'{args.transactions} transactions seeded in {seeding.elapsed:.0f} s')
+
+    client = app.test_client()
+    rng = random.Random(1)
+    account_ids = [rng.randint(1, args.accounts) for _ in range(args.reads)]
+    horizon = utc_now() - timedelta(days=args.horizon_days)
+
+    size, count = database_size()
+    before = read_latencies(client, account_ids, horizon)
+    print(f'before: {count} transactions in the table, database {size / 2 ** 20:.0f} MiB')
+
+    with Timer() as moving:
+        moved, written = archive.move_transactions(directory, horizon)
+    print(f'{moved} transactions moved to {written} segments in {moving.elapsed:.0f} s')
+
+    size, count = database_size()
+    files, segments = directory_size(directory)
+    after = read_latencies(client, account_ids, horizon)
+    print(f'after: {count} transactions in the table, database {size / 2 ** 20:.0f} MiB, '
+          f'{segments} segments of {files / 2 ** 20:.0f} MiB')
+
+    print(f'{"read":<14} {"before p50":>10} {"p99 ms":>8} {"after p50":>10} '
+          f'{"p99 ms":>8}')
+    for name in before:
+        print(f'{name:<14} {before[name]["p50"]:>10.2f} {before[name]["p99"]:>8.2f} '
+              f'{after[name]["p50"]:>10.2f} {after[name]["p99"]:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Measure GET /account/<id> latency with the balance cache off and on."""
+import argparse
+import random
+import time
+
+from banking_api.cache import balance_cache, BalanceCache, LocalSharedStore, SharedCache
+from banking_api.model import db
+from benchmarks.common import make_app, seed_accounts, percentiles
+
+
+def main():
+    """Run benchmark and print latency percentiles per cache mode."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--accounts', type=int, default=100000)
+    parser.add_argument('--hot-accounts', type=int, default=1000,
+                        help='accounts receiving 90%% of lookups')
+    parser.add_argument('--write-every', type=int, default=50,
+                        help='one transfer per this many lookups')
+    args = parser.parse_args()
+
+    print(f'{args.requests} lookups over {args.accounts} accounts, '
+          f'one transfer every {args.write_every} lookups')
+    print(f'{"cache":<7} {"p50 ms":>8} {"p99 ms":>8} {"lookups/s":>10} {"hit ratio":>10}')
+    for mode in ('off', 'local', 'shared'):
+        app = make_app(BALANCE_CACHE='off' if mode == 'shared' else mode,
+                       BALANCE_CACHE_TTL=60)
+        if mode == 'shared':
+            # the in-process stand-in for Redis, without its network round trip
+            app.extensions['balance_cache'] = BalanceCache(
+                SharedCache(LocalSharedStore(), ttl=60))
+        client = app.test_client()
+        seed_accounts(args.accounts, balance=10 ** 6)
+
+        rng = random.Random(0)
+        latencies = []
+        for i in range(args.requests):
+            if rng.random() < 0.9:
+                account_id = rng.randint(1, args.hot_accounts)
+            else:
+                account_id = rng.randint(1, args.accounts)
+            if i % args.write_every == 0:
+                client.post('/transactions', json={
+                    'account_id_from': account_id,
+                    'account_id_to': rng.randint(1, args.hot_accounts),
+                    'amount': 1})
+
+            start = time.perf_counter()
+            response = client.get(f'/account/{account_id}')
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code == 200
+
+        stats = percentiles(latencies)
+        cache = balance_cache()
+        ratio = cache.stats()['hit_ratio'] if cache else 0
+        print(f'{mode:<7} {stats["p50"]:>8.3f} {stats["p99"]:>8.3f} '
+              f'{len(latencies) / sum(latencies):>10.0f} {ratio:>10.2f}')
+        # the next app gets a session bound to its own database
+        db.session.remove()
+
+
+if __name__ == '__main__':
+    main()
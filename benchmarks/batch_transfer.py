@@ -0,0 +1,44 @@
+"""Compare POST /transactions/batch against one POST /transactions per transfer."""
+import argparse
+import random
+
+from benchmarks.common import make_app, seed_accounts, Timer
+
+
+def main():
+    """Run benchmark and print transfers per second for both paths."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--transfers', type=int, default=5000)
+    parser.add_argument('--accounts', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    app = make_app()
+    client = app.test_client()
+    account_ids = seed_accounts(args.accounts, balance=10 ** 6)
+
+    rng = random.Random(0)
+    transfers = [{'account_id_from': rng.choice(account_ids),
+                  'account_id_to': rng.choice(account_ids),
+                  'amount': rng.randint(1, 100)} for _ in range(args.transfers)]
+
+    with Timer() as single:
+        for transfer in transfers:
+            assert client.post('/transactions', json=transfer).status_code == 201
+
+    with Timer() as batch:
+        for i in range(0, len(transfers), args.batch_size):
+            response = client.post('/transactions/batch', json={
+                'transactions': transfers[i:i + args.batch_size]})
+            assert response.status_code == 201
+
+    print(f'{args.transfers} transfers across {args.accounts} accounts')
+    print(f'single  : {single.elapsed:8.2f} s  '
+          f'{args.transfers / single.elapsed:10.0f} transfers/s')
+    print(f'batch {args.batch_size:<4}: {batch.elapsed:6.2f} s  '
+          f'{args.transfers / batch.elapsed:10.0f} transfers/s')
+    print(f'speedup : {single.elapsed / batch.elapsed:8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
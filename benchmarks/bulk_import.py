@@ -0,0 +1,84 @@
+"""Compare bulk import rows per second with initdb.py's row-by-row inserts."""
+import argparse
+import csv
+import os
+import sqlite3
+import tempfile
+
+from banking_api.importer import import_file
+from banking_api.model import db
+from benchmarks.common import make_app, Timer
+
+
+def write_files(directory, n_customers, n_transactions):
+    """Write synthetic customers, accounts and transactions CSV files."""
+    with open(os.path.join(directory, 'customers.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['id', 'name', 'identification'])
+        writer.writerows((i, f'customer {i}', f'id{i}')
+                         for i in range(1, n_customers + 1))
+    with open(os.path.join(directory, 'accounts.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['account_id', 'id', 'balance'])
+        writer.writerows((i, i, '1000.00') for i in range(1, n_customers + 1))
+    with open(os.path.join(directory, 'transactions.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['transctions_id', 'account_id_from', 'account_id_to',
+                         'amount', 'timestamp'])
+        writer.writerows((f'tx{i}', i % n_customers + 1, (i * 7) % n_customers + 1,
+                          '1.25', f'2021-01-01 00:{i // 60 % 60:02d}:{i % 60:02d}')
+                         for i in range(n_transactions))
+
+
+def row_by_row(db_path, directory, limit):
+    """Insert customers one at a time with a commit each, like the old initdb.py."""
+    connection = sqlite3.connect(db_path)
+    cursor = connection.cursor()
+    cursor.execute('CREATE TABLE customer (id INTEGER PRIMARY KEY, '
+                   'name VARCHAR(50), identification VARCHAR(20))')
+    rows = 0
+    with open(os.path.join(directory, 'customers.csv'), newline='') as f:
+        for row in csv.DictReader(f):
+            if rows == limit:
+                break
+            rows += 1
+            cursor.execute('INSERT INTO customer (name, identification) VALUES (?, ?)',
+                           (row['name'], row['identification']))
+            connection.commit()
+    connection.close()
+    return rows
+
+
+def main():
+    """Run benchmark and print rows per second per method."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--customers', type=int, default=100000)
+    parser.add_argument('--transactions', type=int, default=1000000)
+    parser.add_argument('--row-by-row', type=int, default=2000,
+                        help='customers to insert with the old method')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='banking_import_')
+    write_files(directory, args.customers, args.transactions)
+
+    for defer in (False, True):
+        db_path = os.path.join(directory, 'bulk.db')
+        make_app(db_path)
+        print(f'bulk import, {"deferred" if defer else "live"} indexes:')
+        for kind in ('customers', 'accounts', 'transactions'):
+            stats = import_file(kind, os.path.join(directory, f'{kind}.csv'),
+                                defer_indexes=defer)
+            print(f'  {kind:<13} {stats["imported"]:>9} rows '
+                  f'{stats["rows_per_second"]:>9.0f} rows/s')
+        db.session.remove()
+        db.engine.dispose()
+
+    with Timer() as timer:
+        rows = row_by_row(os.path.join(directory, 'row_by_row.db'), directory,
+                          args.row_by_row)
+    print(f'row by row with commit per row:\n  customers     {rows:>9} rows '
+          f'{rows / timer.elapsed:>9.0f} rows/s')
+
+
+if __name__ == '__main__':
+    main()
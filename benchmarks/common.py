@@ -0,0 +1,66 @@
+"""Shared helpers for benchmark scripts."""
+import os
+import tempfile
+import time
+
+from banking_api import create_app
+from banking_api.model import db, Customer, Account, to_cents
+
+
+def make_app(db_path=None, fresh=True, **settings):
+    """Create app backed by a SQLite file, with extra config settings.
+
+    The file is deleted first unless ``fresh`` is False.
+    """
+    if db_path is None:
+        db_path = os.path.join(tempfile.mkdtemp(prefix='banking_bench_'), 'bench.db')
+    if fresh and os.path.exists(db_path):
+        os.remove(db_path)
+
+    settings.setdefault('SQLALCHEMY_DATABASE_URI', f'sqlite:///{db_path}')
+    settings.setdefault('SQLALCHEMY_TRACK_MODIFICATIONS', False)
+
+    fd, config_path = tempfile.mkstemp(suffix='.py', prefix='bench_config_')
+    with os.fdopen(fd, 'w') as config_file:
+        for key, value in settings.items():
+            config_file.write(f'{key} = {value!r}\n')
+
+    app = create_app(config_path)
+    app.app_context().push()
+    db.create_all()
+    return app
+
+
+def seed_accounts(n_accounts, balance=1000, n_customers=None):
+    """Insert customers and accounts in bulk and return the account ids."""
+    n_customers = n_customers or n_accounts
+    db.session.bulk_insert_mappings(Customer, [
+        {'id': i, 'name': f'Customer {i}', 'identification': f'id{i}'}
+        for i in range(1, n_customers + 1)])
+    db.session.bulk_insert_mappings(Account, [
+        {'id': i, 'balance': to_cents(balance), 'customer_id': (i - 1) % n_customers + 1}
+        for i in range(1, n_accounts + 1)])
+    db.session.commit()
+    return list(range(1, n_accounts + 1))
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    """Return the requested percentiles of samples, in milliseconds."""
+    ordered = sorted(samples)
+    if not ordered:
+        return {f'p{p}': None for p in points}
+    return {f'p{p}': ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000
+            for p in points}
+
+
+class Timer():
+    """Context manager measuring wall clock time in seconds."""
+
+    def __enter__(self):
+        """Start timer."""
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        """Stop timer."""
+        self.elapsed = time.perf_counter() - self.start
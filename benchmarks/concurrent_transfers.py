@@ -0,0 +1,63 @@
+"""Stress transfers from many threads and check no update was lost."""
+import argparse
+import random
+import threading
+
+from sqlalchemy import func
+
+from banking_api.model import db, Account, Transaction, to_cents
+from benchmarks.common import make_app, seed_accounts, Timer
+
+
+def main():
+    """Run stress test and print transfers per second per thread count."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--transfers', type=int, default=200,
+                        help='transfers per thread')
+    parser.add_argument('--accounts', type=int, default=10,
+                        help='few accounts means more contention')
+    args = parser.parse_args()
+
+    app = make_app()
+    account_ids = seed_accounts(args.accounts, balance=10 ** 6)
+    initial = {a.id: a.balance for a in Account.query}
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        for _ in range(args.transfers):
+            account_id_from, account_id_to = rng.sample(account_ids, 2)
+            response = client.post('/transactions', json={
+                'account_id_from': account_id_from,
+                'account_id_to': account_id_to,
+                'amount': rng.randint(1, 10000) / 100})
+            assert response.status_code == 201, response.json
+
+    print(f'{"threads":>7} {"transfers/s":>12}')
+    for n_threads in args.threads:
+        threads = [threading.Thread(target=worker, args=(seed,))
+                   for seed in range(n_threads)]
+        with Timer() as timer:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        print(f'{n_threads:>7} {n_threads * args.transfers / timer.elapsed:>12.0f}')
+
+    # every balance must equal its opening balance plus its net transfers
+    db.session.remove()
+    incoming = dict(db.session.query(Transaction.account_id_to, func.sum(
+        Transaction.amount)).group_by(Transaction.account_id_to))
+    outgoing = dict(db.session.query(Transaction.account_id_from, func.sum(
+        Transaction.amount)).group_by(Transaction.account_id_from))
+    lost = [a.id for a in Account.query if a.balance != initial[a.id]
+            + incoming.get(a.id, 0) - outgoing.get(a.id, 0)]
+    total = sum(a.balance for a in Account.query)
+
+    print(f'lost updates: {len(lost)}, total balance preserved: '
+          f'{total == to_cents(10 ** 6) * args.accounts}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Measure customer onboarding and listing cost as the customer table grows."""
+import argparse
+import time
+import tracemalloc
+
+from banking_api.model import db, Customer
+from benchmarks.common import make_app, percentiles, Timer
+
+
+def main():
+    """Run benchmark and print latencies per customer table size."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000])
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    app = make_app()
+    client = app.test_client()
+
+    print(f'{"customers":>9} {"add p50 ms":>11} {"account p50 ms":>15} '
+          f'{"page ms":>8} {"list s":>7} {"list peak MB":>13}')
+    seeded = 0
+    for size in sorted(args.sizes):
+        for offset in range(seeded, size, 50000):
+            db.session.bulk_insert_mappings(Customer, [
+                {'name': f'Customer {i}', 'identification': f'seed{i}'}
+                for i in range(offset, min(offset + 50000, size))])
+            db.session.commit()
+        seeded = size
+
+        add, account = [], []
+        for i in range(args.requests):
+            customer = {'first_name': 'new', 'surname': f'customer{size}x{i}',
+                        'identification': f'new{size}x{i}'}
+            start = time.perf_counter()
+            assert client.post('/customers', json=customer).status_code == 201
+            add.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            assert client.post('/accounts', json=dict(
+                customer, deposit=100)).status_code == 201
+            account.append(time.perf_counter() - start)
+        seeded += args.requests
+
+        middle = client.get('/customers?limit=100').json
+        with Timer() as page:
+            client.get(f'/customers?limit=100&after={middle["next"]}')
+
+        tracemalloc.start()
+        with Timer() as listing:
+            response = client.get('/customers', buffered=False)
+            for _ in response.response:
+                pass
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print(f'{size:>9} {percentiles(add)["p50"]:>11.2f} '
+              f'{percentiles(account)["p50"]:>15.2f} {page.elapsed * 1000:>8.2f} '
+              f'{listing.elapsed:>7.2f} {peak / 2 ** 20:>13.1f}')
+
+
+if __name__ == '__main__':
+    main()
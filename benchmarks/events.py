@@ -0,0 +1,69 @@
+"""Compare following new transfers through /events with polling every account.
+
+``--transfers`` random transfers between ``--accounts`` accounts are made,
+alternating with and without their outbox event to measure its cost per
+transfer. New activity is then collected once by polling the history of
+every account, as downstream systems did, and once by reading the events.
+"""
+import argparse
+import random
+import time
+
+from banking_api import events
+from banking_api.transfers import transfer
+from benchmarks.common import make_app, seed_accounts, percentiles, Timer
+
+
+def main():
+    """Run benchmark and print transfer latency and the cost of a poll cycle."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--accounts', type=int, default=10000)
+    parser.add_argument('--transfers', type=int, default=2000)
+    parser.add_argument('--limit', type=int, default=1000)
+    args = parser.parse_args()
+
+    app = make_app()
+    client = app.test_client()
+    seed_accounts(args.accounts, balance=10 ** 6)
+
+    record_transfers = events.record_transfers
+    rng = random.Random(0)
+    latencies = {'off': [], 'on': []}
+    try:
+        for i in range(args.transfers):
+            state = 'on' if i % 2 else 'off'
+            events.record_transfers = (record_transfers if state == 'on'
+                                       else lambda transactions, session=None: None)
+            begin = time.perf_counter()
+            transfer(rng.randint(1, args.accounts), rng.randint(1, args.accounts), 100)
+            latencies[state].append(time.perf_counter() - begin)
+    finally:
+        events.record_transfers = record_transfers
+    print(f'{"events":<8} {"p50 ms":>8} {"p99 ms":>8}')
+    for state, samples in latencies.items():
+        stats = percentiles(samples)
+        print(f'{state:<8} {stats["p50"]:>8.3f} {stats["p99"]:>8.3f}')
+
+    with Timer() as polling:
+        found = set()
+        for account_id in range(1, args.accounts + 1):
+            page = client.get(f'/account/{account_id}/transactions?limit=100').json
+            found.update(t['uuid'] for t in page['transactions'])
+    with Timer() as reading:
+        after, read, requests = 0, 0, 0
+        while True:
+            page = client.get(f'/events?after={after}&limit={args.limit}').json
+            requests += 1
+            if not page['events']:
+                break
+            read += len(page['events'])
+            after = page['next']
+    print(f'polling histories: {args.accounts} requests, {len(found)} transfers in '
+          f'{polling.elapsed:.2f} s')
+    # only the transfers made with events have one
+    print(f'reading events: {requests} requests, {read} transfers in '
+          f'{reading.elapsed:.3f} s')
+
+
+if __name__ == '__main__':
+    main()
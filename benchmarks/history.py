@@ -0,0 +1,61 @@
+"""Measure transaction history latency and memory as history size grows."""
+import argparse
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+
+from banking_api.model import db, Transaction
+from benchmarks.common import make_app, seed_accounts, Timer
+
+
+def seed_history(n_rows, account_id=1, n_accounts=100, start=0):
+    """Insert n_rows transactions touching account_id, in bulk."""
+    base = datetime(2020, 1, 1)
+    for offset in range(0, n_rows, 50000):
+        db.session.bulk_insert_mappings(Transaction, [
+            {'uuid': str(uuid.uuid4()),
+             'account_id_from': account_id if i % 2 else i % n_accounts + 1,
+             'account_id_to': i % n_accounts + 1 if i % 2 else account_id,
+             'amount': 100,
+             'transaction_timestamp': base + timedelta(seconds=start + i)}
+            for i in range(offset, min(offset + 50000, n_rows))])
+        db.session.commit()
+
+
+def main():
+    """Run benchmark and print page and full export cost per history size."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000])
+    parser.add_argument('--limit', type=int, default=100)
+    args = parser.parse_args()
+
+    app = make_app()
+    client = app.test_client()
+    seed_accounts(100)
+
+    print(f'{"rows":>9} {"page ms":>9} {"export s":>9} {"export peak MB":>15}')
+    seeded = 0
+    for size in sorted(args.sizes):
+        seed_history(size - seeded, start=seeded)
+        seeded = size
+
+        first = client.get(f'/account/1/transactions?limit={args.limit}').json
+        with Timer() as page:
+            client.get(f'/account/1/transactions?limit={args.limit}'
+                       f'&after={first["next"]}')
+
+        tracemalloc.start()
+        with Timer() as export:
+            response = client.get('/account/1/transactions', buffered=False)
+            for _ in response.response:
+                pass
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print(f'{size:>9} {page.elapsed * 1000:>9.2f} {export.elapsed:>9.2f} '
+              f'{peak / 2 ** 20:>15.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Measure balance as of a past time with and without ledger snapshots."""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, insert, select
+
+from banking_api.ledger import balance_as_of, take_snapshots, verify
+from banking_api.model import db, LedgerEntry
+from benchmarks.common import make_app, seed_accounts, percentiles, Timer
+
+
+def full_sum(account_id, as_of):
+    """Return balance as of a time by summing all earlier entries."""
+    return int(db.session.execute(
+        select(func.coalesce(func.sum(LedgerEntry.amount), 0))
+        .where(LedgerEntry.account_id == account_id,
+               LedgerEntry.created_at <= as_of)).scalar())
+
+
+def main():
+    """Run benchmark and print as-of latency and snapshot job timings."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--accounts', type=int, default=100)
+    parser.add_argument('--entries', type=int, default=500000)
+    parser.add_argument('--lookups', type=int, default=500)
+    parser.add_argument('--every', type=int, default=100)
+    parser.add_argument('--chunk', type=int, default=25000,
+                        help='entries appended between snapshot runs')
+    args = parser.parse_args()
+
+    make_app()
+    seed_accounts(args.accounts, balance=0)
+
+    start = datetime(2020, 1, 1)
+    rng = random.Random(0)
+    snapshot_time = taken = 0
+    with Timer() as load:
+        for first in range(0, args.entries, args.chunk):
+            db.session.execute(insert(LedgerEntry.__table__), [
+                {'account_id': rng.randint(1, args.accounts),
+                 'amount': rng.randint(-500, 1000),
+                 'created_at': start + timedelta(seconds=i)}
+                for i in range(first, min(first + args.chunk, args.entries))])
+            db.session.commit()
+
+            with Timer() as snapshot:
+                taken += take_snapshots(every=args.every, lag=0)
+            snapshot_time += snapshot.elapsed
+    print(f'{args.entries} entries over {args.accounts} accounts loaded in '
+          f'{load.elapsed:.1f}s, {taken} snapshots taken in {snapshot_time:.2f}s')
+
+    lookups = [(rng.randint(1, args.accounts),
+                start + timedelta(seconds=rng.randint(0, args.entries)))
+               for _ in range(args.lookups)]
+
+    print(f'{"as of":<18} {"p50 ms":>8} {"p99 ms":>8}')
+    results = {}
+    for name, lookup in (('sum all entries', full_sum),
+                         ('snapshot + delta', balance_as_of)):
+        latencies = []
+        results[name] = []
+        for account_id, as_of in lookups:
+            begin = time.perf_counter()
+            results[name].append(lookup(account_id, as_of))
+            latencies.append(time.perf_counter() - begin)
+        stats = percentiles(latencies)
+        print(f'{name:<18} {stats["p50"]:>8.2f} {stats["p99"]:>8.2f}')
+    assert results['sum all entries'] == results['snapshot + delta']
+
+    with Timer() as first_verify:
+        verify()
+    with Timer() as second_verify:
+        verify()
+    print(f'all snapshots verified in {first_verify.elapsed:.2f}s, '
+          f'nothing new to verify in {second_verify.elapsed:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
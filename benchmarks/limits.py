@@ -0,0 +1,81 @@
+"""Measure the cost of transfer limits per transfer, with many accounts.
+
+Transfers alternate between limits off and every rule on, set high enough
+never to refuse one, on a database holding ``--accounts`` accounts and
+``--entries`` ledger debits spread over the last day. Payers are drawn from
+all accounts, so most are seen for the first time and seeded from the
+ledger, then from ``--hot`` accounts whose windows are already in memory.
+"""
+import argparse
+import random
+import time
+from datetime import timedelta
+
+from sqlalchemy import insert
+
+from banking_api.limits import Limits, WINDOWS
+from banking_api.model import db, LedgerEntry, utc_now
+from banking_api.transfers import transfer
+from benchmarks.common import make_app, seed_accounts, percentiles, Timer
+
+
+def seed_debits(n_entries, n_accounts, chunk_size=100000):
+    """Insert n_entries ledger debits of random accounts over the last day."""
+    rng = random.Random(0)
+    now = utc_now()
+    for first in range(0, n_entries, chunk_size):
+        db.session.execute(insert(LedgerEntry.__table__), [
+            {'account_id': rng.randint(1, n_accounts),
+             'transaction_uuid': f'seed-{i}',
+             'amount': -rng.randint(1, 10000),
+             'created_at': now - timedelta(seconds=rng.randint(0, 24 * 3600))}
+            for i in range(first, min(first + chunk_size, n_entries))])
+        db.session.commit()
+
+
+def main():
+    """Run benchmark and print transfer latency with limits off and on."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--accounts', type=int, default=1000000)
+    parser.add_argument('--entries', type=int, default=2000000)
+    parser.add_argument('--transfers', type=int, default=4000)
+    parser.add_argument('--hot', type=int, default=1000)
+    args = parser.parse_args()
+
+    app = make_app()
+    with Timer() as seeding:
+        seed_accounts(args.accounts, balance=10 ** 6)
+        seed_debits(args.entries, args.accounts)
+    print(f'{args.accounts} accounts and {args.entries} ledger debits seeded in '
+          f'{seeding.elapsed:.0f} s')
+
+    limits = Limits(floor=0, max_amount=10 ** 9,
+                    windows=[(name, seconds, 10 ** 6, 10 ** 12)
+                             for name, seconds in WINDOWS])
+    rng = random.Random(1)
+    hot = rng.sample(range(1, args.accounts + 1), args.hot)
+    print(f'{"payers":<18} {"limits":<6} {"p50 ms":>8} {"p99 ms":>8} {"mean ms":>8}')
+    for name, payers in (('all accounts', range(1, args.accounts + 1)),
+                         (f'{args.hot} hot accounts', hot)):
+        latencies = {'off': [], 'on': []}
+        for i in range(args.transfers):
+            state = 'on' if i % 2 else 'off'
+            if state == 'on':
+                app.extensions['transfer_limits'] = limits
+            else:
+                app.extensions.pop('transfer_limits', None)
+            account_id_from = rng.choice(payers)
+            account_id_to = rng.randint(1, args.accounts)
+            begin = time.perf_counter()
+            transfer(account_id_from, account_id_to, rng.randint(1, 10000))
+            latencies[state].append(time.perf_counter() - begin)
+        for state, samples in latencies.items():
+            stats = percentiles(samples)
+            mean = sum(samples) / len(samples) * 1000
+            print(f'{name:<18} {state:<6} {stats["p50"]:>8.3f} {stats["p99"]:>8.3f} '
+                  f'{mean:>8.3f}')
+    print(f'{sum(map(len, limits.accounts.values()))} accounts tracked')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""Measure the overhead of request instrumentation and of the profiler."""
+import argparse
+import random
+import tempfile
+import time
+
+from banking_api.model import db
+from benchmarks.common import make_app, seed_accounts, percentiles
+
+
+def main():
+    """Run benchmark and print GET /account/<id> latency per setting."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--accounts', type=int, default=1000)
+    args = parser.parse_args()
+
+    profile_dir = tempfile.mkdtemp(prefix='banking_profiles_')
+    modes = [('metrics off', {'METRICS': False}),
+             ('metrics on', {'METRICS': True}),
+             ('profile 10%', {'PROFILE_SAMPLE_RATE': 0.1, 'PROFILE_DIR': profile_dir}),
+             ('profile 100%', {'PROFILE_SAMPLE_RATE': 1, 'PROFILE_DIR': profile_dir})]
+
+    print(f'{"setting":<13} {"p50 ms":>8} {"p99 ms":>8} {"req/s":>8}')
+    for name, settings in modes:
+        app = make_app(**settings)
+        client = app.test_client()
+        seed_accounts(args.accounts)
+        rng = random.Random(0)
+        latencies = []
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            response = client.get(f'/account/{rng.randint(1, args.accounts)}')
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code == 200
+
+        stats = percentiles(latencies)
+        print(f'{name:<13} {stats["p50"]:>8.3f} {stats["p99"]:>8.3f} '
+              f'{len(latencies) / sum(latencies):>8.0f}')
+        db.session.remove()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Measure read latency while transfers run, with and without a read replica.
+
+``--writers`` threads post transfers while ``--readers`` threads read
+balances and history pages, for ``--seconds`` per setup: all reads on the
+main database, reads on a read-only connection to the same SQLite file, and
+reads on a copy refreshed every ``--interval`` seconds by the replication
+stand-in. Readers never wrote, so they are not kept on the main database.
+"""
+import argparse
+import os
+import random
+import threading
+import time
+
+from banking_api.replica import copy_database
+from benchmarks.common import make_app, seed_accounts, percentiles
+
+
+def run(app, n_writers, n_readers, n_accounts, seconds, sync=None):
+    """Return (read latencies, history latencies, transfers) of one timed run."""
+    stop = threading.Event()
+    reads, histories, transfers = [], [], []
+
+    def writer(seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        while not stop.is_set():
+            client.post('/transactions', json={
+                'account_id_from': rng.randint(1, n_accounts),
+                'account_id_to': rng.randint(1, n_accounts), 'amount': 1})
+            transfers.append(1)
+
+    def reader(seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        while not stop.is_set():
+            account_id = rng.randint(1, n_accounts)
+            begin = time.perf_counter()
+            client.get(f'/account/{account_id}')
+            middle = time.perf_counter()
+            client.get(f'/account/{account_id}/transactions?limit=100')
+            reads.append(middle - begin)
+            histories.append(time.perf_counter() - middle)
+
+    threads = ([threading.Thread(target=writer, args=(i,)) for i in range(n_writers)]
+               + [threading.Thread(target=reader, args=(-i,)) for i in range(n_readers)])
+    if sync is not None:
+        threads.append(threading.Thread(target=sync, args=(stop,)))
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return reads, histories, len(transfers)
+
+
+def main():
+    """Run benchmark and print read latency and transfer rate per setup."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--accounts', type=int, default=1000)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--interval', type=float, default=1)
+    args = parser.parse_args()
+
+    print(f'{"reads from":<12} {"balance p50":>11} {"p99 ms":>8} {"history p50":>11} '
+          f'{"p99 ms":>8} {"transfers/s":>11}')
+    for name in ('main', 'same file', 'copy'):
+        app = make_app()
+        path = app.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):]
+        replica_path = os.path.join(os.path.dirname(path), 'replica.db')
+        seed_accounts(args.accounts, balance=10 ** 6)
+        if name != 'main':
+            app = make_app(path, fresh=False, READ_REPLICA_URI='sqlite:///' + (
+                path if name == 'same file' else replica_path))
+        if name == 'copy':
+            copy_database(path, replica_path)
+
+        def sync(stop):
+            while not stop.wait(args.interval):
+                copy_database(path, replica_path)
+
+        reads, histories, transfers = run(app, args.writers, args.readers, args.accounts,
+                                          args.seconds, sync if name == 'copy' else None)
+        balance, history = percentiles(reads), percentiles(histories)
+        print(f'{name:<12} {balance["p50"]:>11.2f} {balance["p99"]:>8.2f} '
+              f'{history["p50"]:>11.2f} {history["p99"]:>8.2f} '
+              f'{transfers / args.seconds:>11.0f}')
+
+
+if __name__ == '__main__':
+    main()
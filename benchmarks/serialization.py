@@ -0,0 +1,82 @@
+"""Compare encoding a transaction history with the serializers and per row.
+
+The per row path is how histories were streamed before banking_api.serializers:
+a mapping and a dict per row, one json.dumps call and one response chunk per
+row. The serializers fetch plain tuples in batches and encode a chunk of rows
+per call, with orjson when it is installed and with the standard library json
+module as fallback.
+"""
+import argparse
+import json
+from unittest import mock
+
+from banking_api import serializers
+from banking_api.model import db, from_cents
+from banking_api.pagination import encode_chunks
+from banking_api.routes import _history_query
+from banking_api.serializers import records
+from benchmarks.common import make_app, seed_accounts, Timer
+from benchmarks.history import seed_history
+
+
+def per_row(result):
+    """Yield JSON chunks of a history as streamed before the serializers."""
+    for i, row in enumerate(result):
+        transaction = dict(row._mapping)
+        transaction['amount'] = from_cents(transaction['amount'])
+        yield (',' if i else '') + json.dumps(transaction)
+
+
+def chunked(result):
+    """Yield JSON chunks of a history as streamed by the serializers."""
+    return encode_chunks(records(result, money=('amount',)))
+
+
+def encode(path, n_rows):
+    """Return seconds to query and encode the whole history of account 1."""
+    result = db.session.connection().execute(_history_query(1))
+    with Timer() as timer:
+        size = sum(len(chunk) for chunk in path(result))
+    assert size > n_rows * 50
+    return timer.elapsed
+
+
+def main():
+    """Run benchmark and print encoding time per path and history size."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    app = make_app()
+    client = app.test_client()
+    seed_accounts(100)
+    paths = [('per row, json', per_row, True),
+             ('serializers, json', chunked, False),
+             ('serializers, orjson', chunked, True)]
+
+    print(f'{"rows":>7} {"path":<22} {"encode s":>9} {"us/row":>7} {"GET s":>7}')
+    seeded = 0
+    for size in sorted(args.sizes):
+        seed_history(size - seeded, start=seeded)
+        seeded = size
+        for name, path, use_orjson in paths:
+            # the fallback is measured by hiding orjson from the serializers
+            with mock.patch.object(serializers, 'orjson',
+                                   serializers.orjson if use_orjson else None):
+                elapsed = min(encode(path, size) for _ in range(args.repeat))
+                if path is chunked:
+                    with Timer() as request:
+                        response = client.get('/account/1/transactions', buffered=False)
+                        for _ in response.response:
+                            pass
+                    get = f'{request.elapsed:>7.2f}'
+                else:
+                    get = f'{"":>7}'
+            print(f'{size:>7} {name:<22} {elapsed:>9.3f} '
+                  f'{elapsed / size * 10 ** 6:>7.1f} {get}')
+        db.session.remove()
+
+
+if __name__ == '__main__':
+    main()
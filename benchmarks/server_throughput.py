@@ -0,0 +1,141 @@
+"""Compare request throughput of the run.py dev server and gunicorn.
+
+Each server is started as a subprocess on a copy of the same seeded SQLite
+database and driven over HTTP by client threads with a mix of balance reads
+and transfers.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine
+
+from banking_api.migrations import upgrade
+from banking_api.model import Customer, Account, to_cents
+from benchmarks.common import percentiles
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# settings reproducing the original config.py, no pooling and SQLite defaults
+ORIGINAL_SETTINGS = {'DB_POOL_SIZE': '0', 'SQLITE_JOURNAL_MODE': '',
+                     'SQLITE_SYNCHRONOUS': '', 'SQLITE_MMAP_SIZE': ''}
+
+
+def seed_database(path, n_accounts):
+    """Create database file with customers and accounts."""
+    engine = create_engine(f'sqlite:///{path}')
+    upgrade(engine)
+    with engine.begin() as connection:
+        connection.execute(Customer.__table__.insert(), [
+            {'id': i, 'name': f'Customer {i}', 'identification': f'id{i}'}
+            for i in range(1, n_accounts + 1)])
+        connection.execute(Account.__table__.insert(), [
+            {'id': i, 'balance': to_cents(10 ** 6), 'customer_id': i}
+            for i in range(1, n_accounts + 1)])
+    engine.dispose()
+
+
+def start_server(command, env, port):
+    """Start server subprocess and wait until it accepts requests."""
+    process = subprocess.Popen(command, cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(200):
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/account/1')
+            connection.getresponse().read()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f'server {command} did not start')
+
+
+def drive(port, n_clients, duration, n_accounts, write_ratio):
+    """Send requests from client threads for duration seconds, return latencies."""
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + duration
+
+    def client(seed):
+        rng = random.Random(seed)
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            if rng.random() < write_ratio:
+                body = json.dumps({'account_id_from': rng.randint(1, n_accounts),
+                                   'account_id_to': rng.randint(1, n_accounts),
+                                   'amount': 1})
+                connection.request('POST', '/transactions', body,
+                                   {'Content-Type': 'application/json'})
+            else:
+                connection.request('GET', f'/account/{rng.randint(1, n_accounts)}')
+            response = connection.getresponse()
+            response.read()
+            latencies.append(time.perf_counter() - start)
+            if response.status >= 300:
+                errors.append(response.status)
+
+    threads = [threading.Thread(target=client, args=(seed,))
+               for seed in range(n_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+
+def main():
+    """Run benchmark against each server and print a comparison table."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--accounts', type=int, default=10000)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='banking_bench_')
+    seed_database(os.path.join(workdir, 'seed.db'), args.accounts)
+
+    servers = [
+        ('run.py, original config', [sys.executable, 'run.py'], ORIGINAL_SETTINGS),
+        ('run.py, tuned config', [sys.executable, 'run.py'], {}),
+        (f'gunicorn {args.workers} workers, tuned config',
+         [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'],
+         {'WEB_CONCURRENCY': str(args.workers)}),
+    ]
+
+    print(f'{args.clients} clients, {args.write_ratio:.0%} transfers, '
+          f'{args.duration:.0f} s per server, {os.cpu_count()} CPUs')
+    print(f'{"server":<36} {"req/s":>8} {"p50 ms":>8} {"p99 ms":>8} {"errors":>7}')
+    for name, command, settings in servers:
+        path = os.path.join(workdir, 'bench.db')
+        shutil.copy(os.path.join(workdir, 'seed.db'), path)
+        env = dict(os.environ, DATABASE_URL=f'sqlite:///{path}',
+                   PORT=str(args.port), **settings)
+
+        process = start_server(command, env, args.port)
+        try:
+            latencies, errors = drive(args.port, args.clients, args.duration,
+                                      args.accounts, args.write_ratio)
+        finally:
+            process.terminate()
+            process.wait()
+
+        stats = percentiles(latencies)
+        print(f'{name:<36} {len(latencies) / args.duration:>8.0f} '
+              f'{stats["p50"]:>8.1f} {stats["p99"]:>8.1f} {len(errors):>7}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""Measure transfer throughput of gunicorn as the number of shards grows.
+
+For each shard count a main database and that many shard files are seeded
+with the same accounts, dealt out one id at a time, and gunicorn is driven
+over HTTP by client threads sending transfers between random accounts. With
+N shards, 1 - 1/N of them cross shards and take the two-phase path, so
+``--local`` also runs with pairs of accounts of the same shard, which shows
+the scaling of the write locks alone. 0 shards is the unsharded app.
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+from sqlalchemy import create_engine
+
+from banking_api.migrations import upgrade
+from banking_api.model import AccountSequence, Customer, Account, to_cents
+from benchmarks.common import percentiles
+from benchmarks.server_throughput import ROOT, seed_database, start_server
+from benchmarks.suite import HttpTarget, drive
+
+
+def seed_shards(workdir, n_accounts, n_shards):
+    """Create main database and shard files, return (main URI, shard URIs)."""
+    main_uri = f'sqlite:///{workdir}/main.db'
+    shard_uris = [f'sqlite:///{workdir}/shard{i}.db' for i in range(n_shards)]
+
+    engine = create_engine(main_uri)
+    upgrade(engine)
+    with engine.begin() as connection:
+        connection.execute(Customer.__table__.insert(), [
+            {'id': i, 'name': f'Customer {i}', 'identification': f'id{i}'}
+            for i in range(1, n_accounts + 1)])
+        connection.execute(AccountSequence.__table__.insert(), [
+            {'id': i} for i in range(1, n_accounts + 1)])
+    engine.dispose()
+
+    for shard, uri in enumerate(shard_uris):
+        engine = create_engine(uri)
+        upgrade(engine)
+        with engine.begin() as connection:
+            connection.execute(Account.__table__.insert(), [
+                {'id': i, 'balance': to_cents(10 ** 6), 'customer_id': i}
+                for i in range(shard + 1, n_accounts + 1, n_shards)])
+        engine.dispose()
+    return main_uri, shard_uris
+
+
+def transfers(n_accounts, n_shards, local):
+    """Return request factory of transfers, between accounts of one shard if local."""
+    def make_request(rng):
+        account_id_from = rng.randint(1, n_accounts)
+        account_id_to = rng.randint(1, n_accounts)
+        if local and n_shards:
+            # same remainder, same shard
+            account_id_to -= (account_id_to - account_id_from) % n_shards
+            if account_id_to < 1:
+                account_id_to += n_shards
+        return 'POST', '/transactions', {'account_id_from': account_id_from,
+                                         'account_id_to': account_id_to,
+                                         'amount': 0.01}
+    return make_request
+
+
+def main():
+    """Run benchmark and print transfer throughput per shard count."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--shards', type=int, nargs='+', default=[0, 1, 2, 4])
+    parser.add_argument('--accounts', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--local', action='store_true',
+                        help='also run with transfers within one shard only')
+    args = parser.parse_args()
+
+    print(f'{os.cpu_count()} CPUs, {args.workers} workers, {args.clients} clients')
+    print(f'{"shards":>6} {"transfers":<9} {"req/s":>8} {"p50 ms":>8} {"p99 ms":>8} '
+          f'{"errors":>7}')
+    for n_shards in args.shards:
+        for local in ([False, True] if args.local and n_shards > 1 else [False]):
+            workdir = tempfile.mkdtemp(prefix='banking_shards_')
+            env = dict(os.environ, PORT=str(args.port),
+                       WEB_CONCURRENCY=str(args.workers), SHARD_BLOCK_SIZE='1')
+            if n_shards:
+                main_uri, shard_uris = seed_shards(workdir, args.accounts, n_shards)
+                env.update(DATABASE_URL=main_uri, SHARD_URIS=','.join(shard_uris))
+            else:
+                seed_database(f'{workdir}/main.db', args.accounts)
+                env.update(DATABASE_URL=f'sqlite:///{workdir}/main.db', SHARD_URIS='')
+
+            process = start_server([sys.executable, '-m', 'gunicorn', '-c',
+                                    'gunicorn.conf.py', 'wsgi:app'], env, args.port)
+            try:
+                latencies, errors, elapsed = drive(
+                    HttpTarget(args.port), transfers(args.accounts, n_shards, local),
+                    args.clients, args.requests)
+            finally:
+                process.terminate()
+                process.wait()
+
+            stats = percentiles(latencies)
+            print(f'{n_shards:>6} {"local" if local else "random":<9} '
+                  f'{len(latencies) / elapsed:>8.0f} {stats["p50"]:>8.2f} '
+                  f'{stats["p99"]:>8.2f} {len(errors):>7}')
+
+
+if __name__ == '__main__':
+    os.chdir(ROOT)
+    main()
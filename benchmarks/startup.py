@@ -0,0 +1,65 @@
+"""Measure app cold start and homepage cost.
+
+Cold start is the wall time of a fresh interpreter importing ``wsgi`` (what a
+gunicorn worker does before serving) and of ``run.py`` up to the point it
+would start serving, best of several runs. The homepage and /healthz are then
+requested through the test client.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.common import make_app
+from benchmarks.server_throughput import ROOT
+
+
+def cold_start(code, runs):
+    """Return best wall time in seconds of running code in a new interpreter."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    """Run benchmark and print cold start times and homepage throughput."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    baseline = cold_start('pass', args.runs)
+    print(f'{"cold start":<28} {"seconds":>8}')
+    print(f'{"python":<28} {baseline:>8.3f}')
+    print(f'{"import wsgi":<28} {cold_start("import wsgi", args.runs):>8.3f}')
+    # run.py up to serving, on a throwaway database
+    run_code = ("import runpy, tempfile, os; "
+                "os.environ['DATABASE_URL'] = 'sqlite:///' + tempfile.mktemp(); "
+                "runpy.run_path('run.py', run_name='not_main')")
+    print(f'{"run.py":<28} {cold_start(run_code, args.runs):>8.3f}')
+
+    app = make_app()
+    client = app.test_client()
+    client.get('/')
+
+    etag = client.get('/').headers.get('ETag', '')
+    requests = [('GET /', '/', {}),
+                ('GET / with If-None-Match', '/', {'If-None-Match': etag}),
+                ('GET /healthz', '/healthz', {})]
+    for name, path, headers in requests:
+        start = time.perf_counter()
+        for _ in range(args.requests):
+            response = client.get(path, headers=headers)
+        elapsed = time.perf_counter() - start
+        print(f'{name:<28} {args.requests / elapsed:>8.0f} req/s, '
+              f'status {response.status_code}')
+
+
+if __name__ == '__main__':
+    os.chdir(ROOT)
+    main()
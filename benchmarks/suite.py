@@ -0,0 +1,328 @@
+"""Benchmark every route through the test client and a multi-worker server.
+
+For each data size a database is seeded with customers, accounts and
+transactions, then each route is driven by client threads, first in process
+through the Flask test client and then over HTTP against gunicorn. Results
+(throughput, p50/p95/p99 latency, errors and peak RSS) are printed and
+written as JSON. With ``--baseline`` they are compared with an earlier run
+and the exit status is 1 when any route got slower by more than
+``--tolerance``, so CI can flag regressions::
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --baseline results.json --output new.json
+    python -m benchmarks.suite --compare new.json --baseline results.json
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from banking_api.ledger import backfill
+from banking_api.model import db, Customer, Account, Transaction, to_cents
+from banking_api.pagination import encode_cursor
+from benchmarks.common import make_app, percentiles, Timer
+from benchmarks.server_throughput import ROOT, start_server
+
+TRANSACTIONS_PER_ACCOUNT = 10
+SEED_START = datetime(2020, 1, 1)
+
+
+def seed_database(path, size):
+    """Create database file with size customers and accounts, and their history."""
+    app = make_app(path)
+    rng = random.Random(size)
+    with db.engine.begin() as connection:
+        connection.execute(Customer.__table__.insert(), [
+            {'id': i, 'name': f'Customer {i}', 'identification': f'id{i}'}
+            for i in range(1, size + 1)])
+        connection.execute(Account.__table__.insert(), [
+            {'id': i, 'balance': to_cents(10 ** 6), 'customer_id': i}
+            for i in range(1, size + 1)])
+    # transactions do not change the seeded balances, as with the importer
+    n_transactions = size * TRANSACTIONS_PER_ACCOUNT
+    for first in range(0, n_transactions, 50000):
+        with db.engine.begin() as connection:
+            connection.execute(Transaction.__table__.insert(), [
+                {'uuid': _seed_uuid(i),
+                 'account_id_from': rng.randint(1, size),
+                 'account_id_to': rng.randint(1, size),
+                 'amount': rng.randint(1, 10000),
+                 'transaction_timestamp': SEED_START + timedelta(seconds=i)}
+                for i in range(first, min(first + 50000, n_transactions))])
+    backfill()
+    db.session.remove()
+    db.engine.dispose()
+    return app
+
+
+def _seed_uuid(i):
+    """Return uuid of the i-th seeded transaction."""
+    return f'seed-{i:012d}'
+
+
+def routes(size):
+    """Return (name, request factory) of each route, factories take a Random."""
+    counter = itertools.count()
+    n_transactions = size * TRANSACTIONS_PER_ACCOUNT
+
+    def account(rng):
+        return rng.randint(1, size)
+
+    def transfer(rng):
+        return {'account_id_from': account(rng), 'account_id_to': account(rng),
+                'amount': rng.randint(1, 1000) / 100}
+
+    def new_account(rng):
+        customer_id = account(rng)
+        return 'POST', '/accounts', {
+            'first_name': 'Customer', 'surname': str(customer_id),
+            'identification': f'id{customer_id}', 'deposit': 100}
+
+    def balance_as_of(rng):
+        as_of = SEED_START + timedelta(seconds=rng.randint(0, n_transactions))
+        return 'GET', f'/account/{account(rng)}/balance?as_of={as_of.isoformat()}', None
+
+    return [
+        ('GET /customers?limit=100', lambda rng: (
+            'GET', f'/customers?limit=100&after={encode_cursor((account(rng),))}', None)),
+        ('POST /customers', lambda rng: (
+            'POST', '/customers', {'first_name': 'Bench', 'surname': f'C{next(counter)}',
+                                   'identification': f'bench{rng.getrandbits(32)}'})),
+        ('POST /accounts', new_account),
+        ('GET /account/<id>', lambda rng: ('GET', f'/account/{account(rng)}', None)),
+        ('GET /account/<id>/balance', balance_as_of),
+        ('GET /account/<id>/transactions', lambda rng: (
+            'GET', f'/account/{account(rng)}/transactions?limit=50', None)),
+        ('GET /transactions/<uuid>', lambda rng: (
+            'GET', f'/transactions/{_seed_uuid(rng.randrange(n_transactions))}', None)),
+        ('POST /transactions', lambda rng: ('POST', '/transactions', transfer(rng))),
+        ('POST /transactions/batch', lambda rng: (
+            'POST', '/transactions/batch',
+            {'transactions': [transfer(rng) for _ in range(50)]})),
+        ('GET /cache/stats', lambda rng: ('GET', '/cache/stats', None)),
+    ]
+
+
+class ClientTarget():
+    """Send requests through the Flask test client of an app."""
+
+    def __init__(self, app):
+        """Create target for app."""
+        self.app = app
+
+    def session(self):
+        """Return a function sending one request, for one client thread."""
+        client = self.app.test_client()
+
+        def send(method, path, body):
+            return client.open(path, method=method, json=body).status_code
+        return send
+
+
+class HttpTarget():
+    """Send requests over HTTP to a server on localhost."""
+
+    def __init__(self, port):
+        """Create target for server listening on port."""
+        self.port = port
+
+    def session(self):
+        """Return a function sending one request, for one client thread."""
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+
+        def send(method, path, body):
+            headers = {'Content-Type': 'application/json'} if body is not None else {}
+            connection.request(method, path, json.dumps(body) if body is not None
+                               else None, headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        return send
+
+
+def drive(target, make_request, n_clients, n_requests):
+    """Send n_requests from client threads and return latencies and errors."""
+    latencies = []
+    errors = []
+
+    def client(seed):
+        rng = random.Random(seed)
+        send = target.session()
+        for _ in range(n_requests // n_clients):
+            method, path, body = make_request(rng)
+            start = time.perf_counter()
+            status = send(method, path, body)
+            latencies.append(time.perf_counter() - start)
+            if status >= 300:
+                errors.append(status)
+
+    threads = [threading.Thread(target=client, args=(seed,))
+               for seed in range(n_clients)]
+    with Timer() as timer:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return latencies, errors, timer.elapsed
+
+
+def peak_rss(pid=None):
+    """Return peak resident memory in MB of this process, or of a process tree."""
+    if pid is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    # the server is a master process with forked workers, sum their peaks
+    total = 0
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/status') as status_file:
+                status = dict(line.split(':', 1) for line in status_file)
+        except OSError:
+            continue
+        if int(entry) == pid or int(status.get('PPid', 0)) == pid:
+            total += int(status.get('VmHWM', '0 kB').split()[0])
+    return total / 1024
+
+
+def run(args):
+    """Run every route on every target and data size, return result records."""
+    results = []
+    workdir = tempfile.mkdtemp(prefix='banking_bench_')
+    for size in args.sizes:
+        seed_path = os.path.join(workdir, f'seed-{size}.db')
+        with Timer() as seeding:
+            seed_database(seed_path, size)
+        print(f'\n{size} customers and accounts, {size * TRANSACTIONS_PER_ACCOUNT} '
+              f'transactions, seeded in {seeding.elapsed:.1f}s')
+
+        for target_name in args.targets:
+            path = os.path.join(workdir, f'{target_name}-{size}.db')
+            shutil.copy(seed_path, path)
+            process = None
+            if target_name == 'client':
+                app = make_app(path, fresh=False)
+                target = ClientTarget(app)
+            else:
+                env = dict(os.environ, DATABASE_URL=f'sqlite:///{path}',
+                           PORT=str(args.port), WEB_CONCURRENCY=str(args.workers))
+                process = start_server(
+                    [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+                     'wsgi:app'], env, args.port)
+                target = HttpTarget(args.port)
+
+            try:
+                print(f'{target_name:<7} {"route":<32} {"req/s":>8} {"p50 ms":>8} '
+                      f'{"p95 ms":>8} {"p99 ms":>8} {"errors":>7}')
+                for route, make_request in routes(size):
+                    latencies, errors, elapsed = drive(
+                        target, make_request, args.clients, args.requests)
+                    stats = percentiles(latencies)
+                    record = dict(target=target_name, size=size, route=route,
+                                  requests=len(latencies),
+                                  throughput=len(latencies) / elapsed,
+                                  errors=len(errors), **stats)
+                    results.append(record)
+                    print(f'{target_name:<7} {route:<32} {record["throughput"]:>8.0f} '
+                          f'{stats["p50"]:>8.2f} {stats["p95"]:>8.2f} '
+                          f'{stats["p99"]:>8.2f} {len(errors):>7}')
+
+                rss = peak_rss(process.pid if process else None)
+                results.append(dict(target=target_name, size=size, route='peak RSS',
+                                    peak_rss_mb=rss))
+                print(f'{target_name:<7} peak RSS {rss:.0f} MB')
+            finally:
+                if process is not None:
+                    process.terminate()
+                    process.wait()
+                else:
+                    db.session.remove()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return descriptions of results worse than baseline by more than tolerance."""
+    base = {(r['target'], r['size'], r['route']): r for r in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        before = base.get((result['target'], result['size'], result['route']))
+        if before is None:
+            continue
+        name = f"{result['target']} {result['size']} {result['route']}"
+
+        # lower is better for latency and memory, higher for throughput
+        checks = [('p95', 1), ('p99', 1), ('peak_rss_mb', 1), ('throughput', -1)]
+        for key, direction in checks:
+            if before.get(key) and result.get(key) is not None:
+                change = (result[key] - before[key]) / before[key] * direction
+                if change > tolerance:
+                    regressions.append(f'{name}: {key} {before[key]:.2f} -> '
+                                       f'{result[key]:.2f} ({change:+.0%} worse)')
+        if result.get('errors', 0) > before.get('errors', 0):
+            regressions.append(f"{name}: errors {before['errors']} -> {result['errors']}")
+    return regressions
+
+
+def main():
+    """Run suite or compare results, and exit with 1 on regressions."""
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                        help='customers and accounts to seed, one run per size')
+    parser.add_argument('--targets', nargs='+', choices=['client', 'server'],
+                        default=['client', 'server'])
+    parser.add_argument('--requests', type=int, default=400, help='per route')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--compare', help='compare this JSON results file, do not run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction a metric may get worse before it is flagged')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare) as results_file:
+            results = json.load(results_file)
+    else:
+        os.chdir(ROOT)
+        results = {
+            'created': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'commit': subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                     capture_output=True, text=True).stdout.strip(),
+            'settings': {k: getattr(args, k) for k in ('sizes', 'requests', 'clients',
+                                                       'workers')},
+            'results': run(args),
+        }
+        if args.output:
+            with open(args.output, 'w') as results_file:
+                json.dump(results, results_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        print(f'\n{len(regressions)} regressions against {args.baseline}')
+        for regression in regressions:
+            print(f'  {regression}')
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""Measure group commit of queued transfers against synchronous transfers."""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import select
+
+from banking_api.model import db
+from banking_api.transfer_queue import process_batch, queued_transfer, start_writer
+from benchmarks.common import make_app, seed_accounts, percentiles, Timer
+
+
+def batch_sizes(queue, depths, accounts):
+    """Print time to apply a queue of each depth in one commit."""
+    rng = random.Random(0)
+    print(f'{"queue depth":>11} {"commit ms":>10} {"us/transfer":>12}')
+    for depth in depths:
+        for _ in range(depth):
+            queue.put(*rng.sample(range(1, accounts + 1), 2), 1)
+        with Timer() as timer:
+            assert process_batch(queue, depth) == depth
+        print(f'{depth:>11} {timer.elapsed * 1000:>10.1f} '
+              f'{timer.elapsed / depth * 10 ** 6:>12.0f}')
+
+
+def load(app, n_threads, n_transfers, accounts, queue=None):
+    """Post transfers from threads and return request latencies and peak depth."""
+    latencies = []
+    depths = []
+    done = threading.Event()
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        for _ in range(n_transfers):
+            start = time.perf_counter()
+            response = client.post('/transactions', json={
+                'account_id_from': rng.randint(1, accounts),
+                'account_id_to': rng.randint(1, accounts), 'amount': 0.01})
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code in (201, 202), response.json
+
+    def monitor():
+        while not done.wait(0.01):
+            depths.append(queue.depth())
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(n_threads)]
+    if queue is not None:
+        threads.append(threading.Thread(target=monitor))
+    for thread in threads:
+        thread.start()
+    for thread in threads[:n_threads]:
+        thread.join()
+    # wait for the writer to apply everything
+    while queue is not None and queue.depth():
+        time.sleep(0.01)
+    done.set()
+    for thread in threads[n_threads:]:
+        thread.join()
+    return latencies, max(depths, default=0)
+
+
+def async_app(writer, accounts, synchronous):
+    """Create async app with its own queue, and start a writer process if asked."""
+    directory = tempfile.mkdtemp(prefix='banking_bench_')
+    settings = {'SQLALCHEMY_DATABASE_URI': f'sqlite:///{directory}/bench.db',
+                'SQLITE_SYNCHRONOUS': synchronous,
+                'TRANSFER_MODE': 'async', 'TRANSFER_QUEUE_WRITER': writer,
+                'TRANSFER_QUEUE_PATH': f'{directory}/queue.db'}
+    app = make_app(f'{directory}/bench.db', **settings)
+    seed_accounts(accounts, balance=10 ** 6)
+    if writer == 'thread':
+        return app, start_writer(app).stop
+
+    config_path = f'{directory}/writer_config.py'
+    with open(config_path, 'w') as config_file:
+        for key, value in settings.items():
+            config_file.write(f'{key} = {value!r}\n')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'banking_api.transfer_queue', '--config', config_path],
+        env=dict(os.environ, PYTHONPATH=os.getcwd()))
+    return app, process.terminate
+
+
+def main():
+    """Run benchmark and print commit latency per queue depth and per mode."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--depths', type=int, nargs='+', default=[1, 10, 100, 500, 2000])
+    parser.add_argument('--threads', type=int, nargs='+', default=[4, 16])
+    parser.add_argument('--transfers', type=int, default=200, help='per thread')
+    parser.add_argument('--accounts', type=int, default=1000)
+    parser.add_argument('--synchronous', default='NORMAL',
+                        help='SQLITE_SYNCHRONOUS, FULL makes every commit dearer')
+    args = parser.parse_args()
+
+    app, stop = async_app('thread', args.accounts, args.synchronous)
+    stop()
+    batch_sizes(app.extensions['transfer_queue'], args.depths, args.accounts)
+    db.session.remove()
+
+    print(f'\n{"mode":<15} {"threads":>7} {"req p50":>8} {"req p99":>8} '
+          f'{"commit p50":>10} {"commit p99":>10} {"peak depth":>10} {"transfers/s":>12}')
+    for n_threads in args.threads:
+        app = make_app(SQLITE_SYNCHRONOUS=args.synchronous)
+        seed_accounts(args.accounts, balance=10 ** 6)
+        with Timer() as timer:
+            latencies, _ = load(app, n_threads, args.transfers, args.accounts)
+        stats = percentiles(latencies)
+        print(f'{"sync":<15} {n_threads:>7} {stats["p50"]:>8.2f} {stats["p99"]:>8.2f} '
+              f'{stats["p50"]:>10.2f} {stats["p99"]:>10.2f} {"-":>10} '
+              f'{len(latencies) / timer.elapsed:>12.0f}')
+        db.session.remove()
+
+        for writer in ('thread', 'process'):
+            app, stop = async_app(writer, args.accounts, args.synchronous)
+            queue = app.extensions['transfer_queue']
+            # let a writer process start up before timing
+            time.sleep(0 if writer == 'thread' else 2)
+            with Timer() as timer:
+                latencies, peak = load(app, n_threads, args.transfers, args.accounts,
+                                       queue)
+            stop()
+
+            # time from enqueueing to the commit of the transfer
+            with queue.engine.connect() as connection:
+                commits = [(done - queued).total_seconds() for queued, done in
+                           connection.execute(select(queued_transfer.c.enqueued_at,
+                                                     queued_transfer.c.done_at))]
+            stats = percentiles(latencies)
+            commit = percentiles(commits)
+            print(f'{"async " + writer:<15} {n_threads:>7} {stats["p50"]:>8.2f} '
+                  f'{stats["p99"]:>8.2f} {commit["p50"]:>10.2f} {commit["p99"]:>10.2f} '
+                  f'{peak:>10} {len(latencies) / timer.elapsed:>12.0f}')
+            db.session.remove()
+
+
+if __name__ == '__main__':
+    main()
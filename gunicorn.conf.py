@@ -0,0 +1,31 @@
+"""Gunicorn settings for serving banking API in production.
+
+Every setting can be overridden with an environment variable.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 80)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('WEB_THREADS', 4))
+worker_class = 'gthread'
+keepalive = int(os.environ.get('WEB_KEEPALIVE', 5))
+timeout = int(os.environ.get('WEB_TIMEOUT', 30))
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+accesslog = os.environ.get('WEB_ACCESSLOG')
+
+
+def on_starting(server):
+    """Create or upgrade the database once, before any worker is forked."""
+    from banking_api import create_app
+    from banking_api.migrations import upgrade
+    from banking_api.model import db
+    from banking_api.sharding import upgrade_shards
+
+    app = create_app('config.py')
+    with app.app_context():
+        upgrade(db.engine)
+        upgrade_shards(app)
+        # workers open their own connections
+        db.engine.dispose()
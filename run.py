@@ -1,12 +1,22 @@
-"""Run file for flask app."""
+"""Run file for flask app, for development. Use wsgi.py in production."""
+import os
+
 from banking_api import create_app
+from banking_api.account_index import start_loading
 from banking_api.model import db
+from banking_api.migrations import upgrade
+from banking_api.sharding import upgrade_shards
+from banking_api.transfer_queue import start_writer
 
 app = create_app('config.py')
 
-# initialise database
+# initialise database, or bring an existing one up to date, unless told it is
 app.app_context().push()
-db.create_all()
+if os.environ.get('DB_UPGRADE_ON_START', '1') != '0':
+    upgrade(db.engine)
+    upgrade_shards(app)
+start_writer(app)
+start_loading(app)
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=80, debug=False)
+    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 80)), debug=False)
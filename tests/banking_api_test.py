@@ -1,7 +1,8 @@
 """Unit tests for banking app classes and methods."""
+import json
 import pytest
 from banking_api import create_app
-from banking_api.model import db
+from banking_api.model import db, Account, Customer, TransferJournal
 
 
 @pytest.fixture(scope='session')
@@ -72,6 +73,60 @@ class TestCustomers():
         assert ("must provide ['surname'] parameters to "
                 "add new customer" == response.json['message'])
 
+    @staticmethod
+    def test_get_pages(client):
+        """Test get method pages through customers with limit and after cursor."""
+        for identification in ("page1", "page2", "page3"):
+            client.post("/customers", json={"first_name": "trinity",
+                                            "surname": "page",
+                                            "identification": identification})
+        full = client.get("/customers").json['customers']
+
+        pages = []
+        response = client.get("/customers?limit=2")
+        while True:
+            assert 200 == response.status_code
+            pages.extend(response.json['customers'])
+            if response.json['next'] is None:
+                break
+            response = client.get("/customers?limit=2&after=" + response.json['next'])
+
+        assert full == pages
+        assert sorted(c['id'] for c in full) == [c['id'] for c in full]
+        assert {'id', 'name', 'identification'} == set(full[0])
+
+    @staticmethod
+    def test_get_bad_page_arguments(client):
+        """Test get method with badly formed cursors and limits."""
+        from banking_api.pagination import encode_cursor
+
+        for values in ([], ['x'], [True], [1, 2]):
+            cursor = encode_cursor(values)
+            response = client.get(f"/customers?limit=2&after={cursor}")
+            assert 400 == response.status_code
+            assert f"invalid cursor '{cursor}'" == response.json['message']
+        for limit in ('abc', '0', '1.5'):
+            response = client.get(f"/customers?limit={limit}")
+            assert 400 == response.status_code
+            assert ('limit must be an integer between 1 and 1000'
+                    == response.json['message'])
+
+    @staticmethod
+    def test_duplicate_customers_block_migration(tmp_path):
+        """Test unique customer migration refuses to run over duplicates."""
+        from sqlalchemy import create_engine
+        from banking_api.migrations import unique_customers, MigrationError
+
+        engine = create_engine(f'sqlite:///{tmp_path / "duplicates.db"}')
+        with engine.begin() as connection:
+            connection.execute('CREATE TABLE customer (id INTEGER PRIMARY KEY, '
+                               'name VARCHAR(50), identification VARCHAR(20))')
+            connection.execute("INSERT INTO customer (name, identification) "
+                               "VALUES ('Neo', 'abc'), ('Neo', 'abc')")
+
+        with pytest.raises(MigrationError, match='Neo'):
+            unique_customers(engine.connect())
+
 
 class TestAccounts():
     """Unit tests for Accounts class."""
@@ -174,6 +229,17 @@ class TestTransactions():
         assert -10 == (response_acc2_before.json['SUCCESS']['balance']
                        - response_acc2_after.json['SUCCESS']['balance'])
 
+    @staticmethod
+    def test_post_same_account(client):
+        """Test post method for a transfer of an account to itself."""
+        before = client.get("/account/1").json['SUCCESS']['balance']
+        response = client.post("/transactions", json={"account_id_from": 1,
+                                                      "account_id_to": 1,
+                                                      "amount": 10})
+
+        assert 201 == response.status_code
+        assert before == client.get("/account/1").json['SUCCESS']['balance']
+
     @staticmethod
     def test_post_nonexistent_account(client):
         """Test post method for transaction with non-existent accounts."""
@@ -204,6 +270,322 @@ class TestTransactions():
         assert ("must provide ['account_id_to'] parameters to "
                 "process transaction" == response.json['message'])
 
+    @staticmethod
+    def test_post_fractional_cents(client):
+        """Test post method for transaction with an amount below one cent."""
+        response = client.post("/transactions", json={"account_id_from": 1,
+                                                      "account_id_to": 2,
+                                                      "amount": 10.555})
+
+        assert 400 == response.status_code
+        assert ('amount must not have more than 2 decimal places'
+                == response.json['message'])
+
+    @staticmethod
+    def test_post_amount_text(client):
+        """Test post method for transaction with an amount sent as text."""
+        response = client.post("/transactions", json={"account_id_from": 1,
+                                                      "account_id_to": 2,
+                                                      "amount": "10.5"})
+
+        assert 400 == response.status_code
+        assert 'amount must be a number' == response.json['message']
+
+    @staticmethod
+    def test_post_bad_values(client):
+        """Test post method for transaction with ids or amount of the wrong kind."""
+        for transaction, message in (
+                ({"account_id_from": "1", "account_id_to": "2", "amount": 1},
+                 'account ids must be integers'),
+                ({"account_id_from": 1, "account_id_to": True, "amount": 1},
+                 'account ids must be integers'),
+                ({"account_id_from": 1, "account_id_to": 2, "amount": 10 ** 30},
+                 'amount must not exceed 10000000000000')):
+            response = client.post("/transactions", json=transaction)
+
+            assert 400 == response.status_code
+            assert message == response.json['message']
+
+    @staticmethod
+    def test_post_exact_cents(client):
+        """Test post method keeps balances exact for decimal amounts."""
+        response_before = client.get("/account/2")
+        for _ in range(10):
+            client.post("/transactions", json={"account_id_from": 1,
+                                               "account_id_to": 2,
+                                               "amount": 0.1})
+        response_after = client.get("/account/2")
+
+        assert 1 == round(response_after.json['SUCCESS']['balance']
+                          - response_before.json['SUCCESS']['balance'], 2)
+
+
+class TestTransactionsBatch():
+    """Unit tests for TransactionsBatch class."""
+
+    @staticmethod
+    def test_post_success(client):
+        """Test post method for transferring several amounts in one batch."""
+        response_acc1_before = client.get("/account/1")
+        response_acc2_before = client.get("/account/2")
+        response = client.post("/transactions/batch", json={"transactions": [
+            {"account_id_from": 1, "account_id_to": 2, "amount": 10},
+            {"account_id_from": 2, "account_id_to": 1, "amount": 5}]})
+        response_acc1_after = client.get("/account/1")
+        response_acc2_after = client.get("/account/2")
+
+        assert 201 == response.status_code
+        assert 0 == response.json['SUCCESS']['failed']
+        assert ['processed', 'processed'] == [
+            r['status'] for r in response.json['SUCCESS']['results']]
+        assert 5 == (response_acc1_before.json['SUCCESS']['balance']
+                     - response_acc1_after.json['SUCCESS']['balance'])
+        assert -5 == (response_acc2_before.json['SUCCESS']['balance']
+                      - response_acc2_after.json['SUCCESS']['balance'])
+
+    @staticmethod
+    def test_post_atomic_failure(client):
+        """Test post method for an all-or-nothing batch with a failing item."""
+        response_before = client.get("/account/1")
+        response = client.post("/transactions/batch", json={"transactions": [
+            {"account_id_from": 1, "account_id_to": 2, "amount": 10},
+            {"account_id_from": 1, "account_id_to": 102, "amount": 10}]})
+        response_after = client.get("/account/1")
+
+        assert 400 == response.status_code
+        assert ['not processed', 'failed'] == [
+            r['status'] for r in response.json['results']]
+        assert 'Check account id' == response.json['results'][1]['message']
+        assert (response_before.json['SUCCESS']['balance']
+                == response_after.json['SUCCESS']['balance'])
+
+    @staticmethod
+    def test_post_partial_failure(client):
+        """Test post method for a batch that allows individual items to fail."""
+        response_before = client.get("/account/1")
+        response = client.post("/transactions/batch", json={
+            "atomic": False,
+            "transactions": [
+                {"account_id_from": 1, "account_id_to": 2, "amount": 10},
+                {"account_id_from": 1, "account_id_to": 2, "amount": -10},
+                {"account_id_from": 1, "amount": 10}]})
+        response_after = client.get("/account/1")
+        results = response.json['SUCCESS']['results']
+
+        assert 201 == response.status_code
+        assert 2 == response.json['SUCCESS']['failed']
+        assert ['processed', 'failed', 'failed'] == [r['status'] for r in results]
+        assert 'amount must be positive and not zero' == results[1]['message']
+        assert ("must provide ['account_id_to'] parameters to "
+                "process transaction" == results[2]['message'])
+        assert 10 == (response_before.json['SUCCESS']['balance']
+                      - response_after.json['SUCCESS']['balance'])
+
+    @staticmethod
+    def test_post_empty(client):
+        """Test post method for a batch without any transactions."""
+        response = client.post("/transactions/batch", json={"transactions": []})
+
+        assert 400 == response.status_code
+
+    @staticmethod
+    def test_post_bad_values(client):
+        """Test post method for a batch with a body, flag or ids of the wrong kind."""
+        for body, message in (
+                ([{"account_id_from": 1, "account_id_to": 2, "amount": 1}],
+                 'request body must be an object'),
+                ({"atomic": "no", "transactions": [
+                    {"account_id_from": 1, "account_id_to": 2, "amount": 1}]},
+                 'atomic must be true or false')):
+            response = client.post("/transactions/batch", json=body)
+
+            assert 400 == response.status_code
+            assert message == response.json['message']
+
+        response = client.post("/transactions/batch", json={
+            "atomic": False,
+            "transactions": [
+                {"account_id_from": "1", "account_id_to": 2, "amount": 1},
+                {"account_id_from": 1, "account_id_to": [2], "amount": 1},
+                {"account_id_from": False, "account_id_to": 2, "amount": 1}]})
+
+        assert 400 == response.status_code
+        assert 3 * ['account ids must be integers'] == [
+            r['message'] for r in response.json['results']]
+
+
+@pytest.fixture
+def cached(app):
+    """Serve balances through a local balance cache following the ledger, for one test."""
+    from banking_api.cache import BalanceCache, LRUCache
+
+    cache = app.extensions['balance_cache'] = BalanceCache(LRUCache(),
+                                                           follow_ledger=True)
+    yield cache
+    del app.extensions['balance_cache']
+
+
+class TestBalanceCache():
+    """Unit tests for the balance cache of Account_id class."""
+
+    @staticmethod
+    def test_get_hits_cache(client, cached):
+        """Test repeated balance lookups are served from the cache."""
+        before = client.get("/cache/stats").json['balance_cache']
+        client.get("/account/1")
+        client.get("/account/1")
+        after = client.get("/cache/stats").json['balance_cache']
+
+        assert after['hits'] > before['hits']
+
+    @staticmethod
+    def test_transfer_invalidates(client, cached):
+        """Test a transfer is visible straight away to cached balance lookups."""
+        before = client.get("/account/1").json['SUCCESS']['balance']
+        client.post("/transactions", json={"account_id_from": 1,
+                                           "account_id_to": 2,
+                                           "amount": 1})
+        after = client.get("/account/1").json['SUCCESS']['balance']
+
+        assert 1 == round(before - after, 2)
+
+    @staticmethod
+    def test_other_worker_transfer(app, client, cached):
+        """Test transfers of other workers are visible straight away to cached lookups."""
+        from banking_api import transfers
+
+        before = client.get("/account/1").json['SUCCESS']['balance']
+        assert before == client.get("/account/1").json['SUCCESS']['balance']
+        # committed without invalidating this cache, as another worker would
+        del app.extensions['balance_cache']
+        try:
+            with app.test_request_context():
+                transfers.transfer(1, 2, 100)
+        finally:
+            app.extensions['balance_cache'] = cached
+        after = client.get("/account/1").json['SUCCESS']['balance']
+
+        assert 1 == round(before - after, 2)
+
+    @staticmethod
+    def test_local_cache_settings(tmp_path):
+        """Test caches that cannot see the writes of every worker are refused."""
+        for settings in ("BALANCE_CACHE = 'shared'\n",
+                         "BALANCE_CACHE = 'local'\n"
+                         "SHARD_URIS = ['sqlite:///0.db', 'sqlite:///1.db']\n"):
+            config = tmp_path / 'cache.py'
+            config.write_text("SQLALCHEMY_DATABASE_URI = 'sqlite:///cache.db'\n"
+                              "SQLALCHEMY_TRACK_MODIFICATIONS = False\n" + settings)
+            with pytest.raises(ValueError):
+                create_app(str(config))
+
+    @staticmethod
+    def test_no_stale_fill():
+        """Test a lookup overlapping a write does not cache the old balance."""
+        from banking_api.cache import (BalanceCache, LRUCache, SharedCache,
+                                       LocalSharedStore)
+
+        for backend in (LRUCache(), SharedCache(LocalSharedStore())):
+            cache = BalanceCache(backend)
+
+            def load_then_write(account_id):
+                cache.invalidate([account_id])
+                return 100
+
+            assert 100 == cache.get_balance(1, load_then_write)
+            assert 200 == cache.get_balance(1, lambda account_id: 200)
+            assert 200 == cache.get_balance(1, lambda account_id: 300)
+            assert {'hits': 1, 'misses': 2} == {
+                k: v for k, v in cache.stats().items() if k in ('hits', 'misses')}
+
+    @staticmethod
+    def test_no_stale_fill_after_check():
+        """Test a write landing between the counter check and the set is not missed."""
+        from banking_api.cache import BalanceCache, LRUCache
+
+        class WriteBeforeSet(LRUCache):
+            def set(self, key, value, ttl=None):
+                # the writer counts and deletes, then the lookup sets
+                cache.invalidate([1])
+                super().set(key, value, ttl)
+
+        cache = BalanceCache(WriteBeforeSet())
+        assert 100 == cache.get_balance(1, lambda account_id: 100)
+        assert cache.backend.get('balance:1') is None
+
+    @staticmethod
+    def test_lru_eviction_and_expiry():
+        """Test least recently used entries are evicted and old entries expire."""
+        from banking_api.cache import LRUCache
+
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        assert 1 == cache.get('a')
+        assert cache.get('b') is None
+
+        cache.set('d', 4, ttl=-1)
+        assert cache.get('d') is None
+
+
+class TestConcurrentTransfers():
+    """Stress tests for transfers from many threads at once."""
+
+    @staticmethod
+    def test_no_lost_updates(app, client):
+        """Test concurrent transfers keep every balance consistent with history."""
+        import random
+        import threading
+        import time
+
+        client.post("/customers", json={"first_name": "agent", "surname": "smith",
+                                        "identification": "xyz"})
+        account_ids = [client.post("/accounts", json={
+            "first_name": "agent", "surname": "smith", "identification": "xyz",
+            "deposit": 1000}).json['SUCCESS']['id'] for _ in range(5)]
+
+        n_threads, n_transfers = 8, 40
+        failures = []
+
+        def worker(seed):
+            rng = random.Random(seed)
+            thread_client = app.test_client()
+            for _ in range(n_transfers):
+                account_id_from, account_id_to = rng.sample(account_ids, 2)
+                response = thread_client.post("/transactions", json={
+                    "account_id_from": account_id_from,
+                    "account_id_to": account_id_to,
+                    "amount": rng.randint(1, 100) / 100})
+                if response.status_code != 201:
+                    failures.append(response.json)
+
+        threads = [threading.Thread(target=worker, args=(seed,))
+                   for seed in range(n_threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        print(f'{n_threads * n_transfers / elapsed:.0f} transfers/s '
+              f'with {n_threads} threads')
+
+        assert [] == failures
+
+        balances = {}
+        for account_id in account_ids:
+            balance = client.get(f"/account/{account_id}").json['SUCCESS']['balance']
+            history = client.get(f"/account/{account_id}/transactions")
+            net = sum(t['amount'] if t['account_id_to'] == account_id
+                      else -t['amount'] for t in history.json['transactions'])
+            balances[account_id] = balance
+            assert round(1000 + net, 2) == balance
+
+        assert 5000 == round(sum(balances.values()), 2)
+
 
 class TestAccountTransactions():
     """Unit tests for AccountTransactions class."""
@@ -221,3 +603,1485 @@ class TestAccountTransactions():
         response = client.get("/account/100")
 
         assert 404 == response.status_code
+
+    @staticmethod
+    def test_get_history(client):
+        """Test get method streams the whole history of an account in order."""
+        response = client.get("/account/2/transactions")
+        timestamps = [t['transaction_timestamp']
+                      for t in response.json['transactions']]
+
+        assert 200 == response.status_code
+        assert len(timestamps) >= 4
+        assert sorted(timestamps) == timestamps
+
+    @staticmethod
+    def test_get_pages(client):
+        """Test get method pages through history with limit and after cursor."""
+        full = client.get("/account/2/transactions").json['transactions']
+
+        pages = []
+        response = client.get("/account/2/transactions?limit=2")
+        while True:
+            assert 200 == response.status_code
+            assert len(response.json['transactions']) <= 2
+            pages.extend(response.json['transactions'])
+            if response.json['next'] is None:
+                break
+            response = client.get("/account/2/transactions?limit=2&after="
+                                  + response.json['next'])
+
+        assert full == pages
+
+    @staticmethod
+    def test_get_bad_page_arguments(client):
+        """Test get method with invalid limit and cursor arguments."""
+        from banking_api.pagination import encode_cursor
+
+        assert 400 == client.get("/account/2/transactions?limit=0").status_code
+        assert 400 == client.get("/account/2/transactions?after=xyz").status_code
+        for values in ([], [1, 'uuid'], ['2020-10-10 13:30:02', 'uuid', 1]):
+            cursor = encode_cursor(values)
+            assert 400 == client.get(
+                f"/account/2/transactions?limit=2&after={cursor}").status_code
+
+    @staticmethod
+    def test_history_uses_indexes(app):
+        """Test history query reads through the account and timestamp indexes."""
+        from banking_api.routes import _history_query
+
+        query = _history_query(2, ['2020-01-01', ''], 10)
+        compiled = query.compile(db.engine, compile_kwargs={'literal_binds': True})
+        plan = ' '.join(str(row[-1]) for row in
+                        db.session.execute(f'EXPLAIN QUERY PLAN {compiled}'))
+
+        assert 'ix_transaction_from_timestamp' in plan
+        assert 'ix_transaction_to_timestamp' in plan
+
+
+class TestMigrations():
+    """Unit tests for migrations of existing databases."""
+
+    @staticmethod
+    def make_float_database(path):
+        """Create a database with the original float money columns."""
+        import sqlite3
+
+        connection = sqlite3.connect(path)
+        connection.executescript("""
+            CREATE TABLE customer (id INTEGER NOT NULL, name VARCHAR(50) NOT NULL,
+                identification VARCHAR(20) NOT NULL, PRIMARY KEY (id));
+            CREATE TABLE account (id INTEGER NOT NULL, balance FLOAT NOT NULL,
+                customer_id INTEGER NOT NULL, PRIMARY KEY (id));
+            CREATE TABLE "transaction" (uuid VARCHAR(80) NOT NULL,
+                account_id_from INTEGER NOT NULL, account_id_to INTEGER NOT NULL,
+                amount FLOAT NOT NULL, transaction_timestamp VARCHAR(50) NOT NULL,
+                PRIMARY KEY (uuid));
+            INSERT INTO customer VALUES (1, 'Thomas Anderson', 'abc');
+        """)
+        connection.executemany("INSERT INTO account VALUES (?, ?, 1)",
+                               [(i, i * 10.1) for i in range(1, 101)])
+        connection.executemany(
+            'INSERT INTO "transaction" VALUES (?, ?, ?, ?, ?)',
+            [(f'uuid{i}', i % 100 + 1, (i + 1) % 100 + 1, 0.05 * (i + 1),
+              f'2020-10-10 13:30:{i % 60:02d}') for i in range(250)])
+        connection.commit()
+        connection.close()
+
+    def test_money_to_cents_resumes(self, tmp_path):
+        """Test float money columns are rewritten as cents after an interruption."""
+        from sqlalchemy import create_engine, inspect
+        from banking_api import migrations
+
+        path = tmp_path / 'float.db'
+        self.make_float_database(path)
+        engine = create_engine(f'sqlite:///{path}')
+
+        # stop the rewrite of the account table part way through
+        with engine.connect() as connection:
+            with connection.begin():
+                connection.execute('ALTER TABLE account RENAME TO _account_float')
+            with connection.begin():
+                connection.execute(
+                    'CREATE TABLE account (id INTEGER NOT NULL, balance BIGINT '
+                    'NOT NULL, customer_id INTEGER NOT NULL, PRIMARY KEY (id))')
+                connection.execute(
+                    'INSERT INTO account (rowid, id, balance, customer_id) '
+                    'SELECT rowid, id, CAST(ROUND(balance * 100) AS INTEGER), '
+                    'customer_id FROM _account_float WHERE rowid <= 40')
+
+        migrations.money_to_cents(engine.connect(), chunk_size=25)
+
+        with engine.connect() as connection:
+            totals, problems = migrations.reconcile(connection)
+            balances = connection.execute(
+                'SELECT id, balance FROM account ORDER BY id').fetchall()
+            tables = inspect(connection).get_table_names()
+
+        assert [] == problems
+        assert [(i, i * 1010) for i in range(1, 101)] == balances
+        assert 5 * sum(range(1, 251)) == totals['total_transferred']
+        assert '_account_float' not in tables
+        assert '_transaction_float' not in tables
+
+    def test_upgrade_reports_duplicates(self, tmp_path):
+        """Test upgrading a database with duplicate customers lists them."""
+        from sqlalchemy import create_engine, inspect
+        from banking_api import migrations
+
+        path = tmp_path / 'duplicates.db'
+        self.make_float_database(path)
+        engine = create_engine(f'sqlite:///{path}')
+        with engine.begin() as connection:
+            connection.execute("INSERT INTO customer "
+                               "VALUES (2, 'Thomas Anderson', 'abc')")
+
+        with pytest.raises(migrations.MigrationError,
+                           match=r'Thomas Anderson \(abc\) x2'):
+            migrations.upgrade(engine)
+
+        with engine.begin() as connection:
+            connection.execute('DELETE FROM customer WHERE id = 2')
+        assert ['unique_customers', 'utc_timestamps'] == migrations.upgrade(engine)
+        with engine.connect() as connection:
+            assert 'ix_customer_identification_name' in [
+                index['name'] for index in inspect(connection).get_indexes('customer')]
+
+    @staticmethod
+    def test_utc_timestamps(tmp_path, monkeypatch):
+        """Test local time text of transfers is rewritten as UTC, only once."""
+        import time
+        from sqlalchemy import create_engine, inspect
+        from banking_api import migrations
+
+        engine = create_engine(f'sqlite:///{tmp_path / "local.db"}')
+        db.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute('INSERT INTO "transaction" VALUES (?, 1, 2, 100, ?)', [
+                (f'uuid{i}', f'2021-03-01 12:00:0{i}.250000') for i in range(5)])
+            connection.execute('INSERT INTO "transaction" VALUES '
+                               "('uuid5', 2, 1, 100, '2021-03-01 00:30:00')")
+            connection.execute('INSERT INTO ledger_entry VALUES '
+                               "(1, 2, 'uuid5', -100, '2021-03-01 00:30:00.000000')")
+            connection.execute('INSERT INTO account_stats VALUES '
+                               "(1, 100, 500, 6, '2021-03-01 12:00:04.250000'), "
+                               '(3, 0, 0, 0, NULL)')
+            connection.execute('INSERT INTO shard_range VALUES '
+                               "(1, 1, 3, 1, 'done', '2021-03-01 00:30:00.000000')")
+
+        # the API ran two hours ahead of UTC
+        monkeypatch.setenv('TZ', 'XYZ-2')
+        time.tzset()
+        try:
+            migrations.utc_timestamps(engine.connect(), chunk_size=2)
+            migrations.utc_timestamps(engine.connect(), chunk_size=2)
+        finally:
+            monkeypatch.undo()
+            time.tzset()
+
+        with engine.connect() as connection:
+            timestamps = connection.execute('SELECT transaction_timestamp FROM '
+                                            '"transaction" ORDER BY uuid').scalars().all()
+            entry = connection.execute('SELECT created_at FROM ledger_entry').scalar()
+            moved = connection.execute('SELECT created_at FROM shard_range').scalar()
+            activity = connection.execute('SELECT last_activity FROM account_stats '
+                                          'ORDER BY account_id').scalars().all()
+            tables = inspect(connection).get_table_names()
+
+        assert ([f'2021-03-01 10:00:0{i}.250000' for i in range(5)]
+                + ['2021-02-28 22:30:00.000000']) == timestamps
+        assert '2021-02-28 22:30:00.000000' == entry == moved
+        assert ['2021-03-01 10:00:04.250000', None] == activity
+        assert not [table for table in tables if table.endswith('_local')]
+
+    @staticmethod
+    def test_utc_timestamps_refuses_bad_times(tmp_path):
+        """Test a table holding text that is not a time is left as it is."""
+        from sqlalchemy import create_engine
+        from banking_api import migrations
+
+        engine = create_engine(f'sqlite:///{tmp_path / "bad.db"}')
+        db.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute('INSERT INTO "transaction" VALUES '
+                               "('uuid0', 1, 2, 100, 'yesterday')")
+
+        with pytest.raises(migrations.MigrationError):
+            migrations.utc_timestamps(engine.connect())
+        with engine.connect() as connection:
+            assert 'yesterday' == connection.execute(
+                'SELECT transaction_timestamp FROM "transaction"').scalar()
+
+
+class TestImporter():
+    """Unit tests for bulk importer."""
+
+    @staticmethod
+    def test_import_file_with_rejects(app, tmp_path):
+        """Test customers, accounts and transactions files are imported in chunks."""
+        from banking_api.importer import import_file
+
+        (tmp_path / 'customers.json').write_text(
+            '[{"name": "import one", "identification": "imp1"},'
+            ' {"name": "import two", "identification": "imp2"},'
+            ' {"name": "import one", "identification": "imp1"},'
+            ' {"name": "no identification"}]')
+        stats = import_file('customers', str(tmp_path / 'customers.json'),
+                            chunk_size=2)
+        ids = [c['id'] for c in app.test_client().get("/customers").json['customers']
+               if c['identification'] in ('imp1', 'imp2')]
+
+        (tmp_path / 'accounts.csv').write_text(
+            'customer_id,balance\n'
+            f'{ids[0]},10.50\n{ids[1]},20\n{ids[1]},abc\n999999,5\n')
+        account_stats = import_file('accounts', str(tmp_path / 'accounts.csv'))
+        balances = [a.balance for a in Account.query.filter(
+            Account.customer_id.in_(ids)).order_by(Account.id)]
+
+        rejects = (tmp_path / 'customers.json.rejects.csv').read_text()
+        account_rejects = (tmp_path / 'accounts.csv.rejects.csv').read_text()
+
+        assert (2, 2) == (stats['imported'], stats['rejected'])
+        assert 'customer repeated in file' not in rejects
+        assert 'customer already exists' in rejects
+        assert "missing ['identification']" in rejects
+        assert [1050, 2000] == balances
+        assert (2, 2) == (account_stats['imported'], account_stats['rejected'])
+        assert 'balance: amount must be a number' in account_rejects
+        assert 'customer does not exist' in account_rejects
+
+    @staticmethod
+    def test_import_resumes(app, tmp_path):
+        """Test an interrupted import carries on after the last committed chunk."""
+        from banking_api.importer import import_records
+
+        def records(fail_after=None):
+            for i in range(10):
+                if i == fail_after:
+                    raise RuntimeError('crash')
+                yield {'name': f'resume {i}', 'identification': f'resume{i}'}
+
+        with pytest.raises(RuntimeError):
+            import_records('customers', records(fail_after=7), source='resume',
+                           chunk_size=3)
+        imported = Customer.query.filter(Customer.name.like('Resume %')).count()
+        stats = import_records('customers', records(), source='resume', chunk_size=3)
+
+        assert 6 == imported
+        assert 6 == stats['skipped']
+        assert (10, 0) == (stats['imported'], stats['rejected'])
+        assert 10 == Customer.query.filter(Customer.name.like('Resume %')).count()
+
+    @staticmethod
+    def test_read_json_array_in_blocks(tmp_path):
+        """Test JSON arrays are decoded item by item across read blocks."""
+        import io
+        from banking_api.importer import _iter_json_array
+
+        items = [{"name": f"customer {i}", "nested": [i, {"x": "]"}]}
+                 for i in range(50)]
+        source = io.StringIO(json.dumps(items, indent=2))
+
+        assert items == list(_iter_json_array(source, block_size=7))
+
+
+class TestLedger():
+    """Unit tests for the ledger and AccountBalance class."""
+
+    @staticmethod
+    def test_balance_as_of(client):
+        """Test past balances are rebuilt from snapshots and later entries."""
+        import time
+        from banking_api.ledger import backfill, take_snapshots, verify
+        from banking_api.model import utc_now
+
+        # accounts added by the importer tests have no entries yet
+        backfill()
+
+        def transfer(amount):
+            client.post("/transactions", json={"account_id_from": 1,
+                                               "account_id_to": 2,
+                                               "amount": amount})
+            time.sleep(0.01)
+            return utc_now().isoformat(), client.get(
+                "/account/1").json['SUCCESS']['balance']
+
+        history = [transfer(1)]
+        take_snapshots(every=1, lag=0)
+        history.append(transfer(2))
+        history.append(transfer(3))
+        take_snapshots(every=2, lag=0)
+        history.append(transfer(4))
+
+        for as_of, balance in history:
+            response = client.get(f"/account/1/balance?as_of={as_of}")
+            assert balance == response.json['SUCCESS']['balance']
+        assert history[-1][1] == client.get(
+            "/account/1/balance").json['SUCCESS']['balance']
+
+        report = verify(chunk_size=2)
+        assert report['snapshots_verified'] >= 3
+        assert [] == report['snapshot_mismatches'] == report['balance_mismatches']
+        assert 0 == verify()['snapshots_verified']
+
+    @staticmethod
+    def test_verify_finds_mismatch(app):
+        """Test verify reports a balance the ledger does not add up to."""
+        from banking_api.ledger import verify
+
+        account = db.session.get(Account, 1)
+        account.balance += 1
+        db.session.commit()
+        mismatches = verify()['balance_mismatches']
+        account.balance -= 1
+        db.session.commit()
+
+        assert [1] == [m['account_id'] for m in mismatches]
+
+    @staticmethod
+    def test_bad_arguments(client):
+        """Test unknown accounts and malformed dates are refused."""
+        assert 404 == client.get("/account/999999/balance").status_code
+        assert 400 == client.get("/account/1/balance?as_of=yesterday").status_code
+
+
+@pytest.fixture
+def queue(app, tmp_path):
+    """Switch app to async transfers, with a queue of its own, for one test."""
+    from banking_api.transfer_queue import TransferQueue
+
+    app.extensions['transfer_queue'] = TransferQueue(str(tmp_path / 'queue.db'))
+    yield app.extensions['transfer_queue']
+    del app.extensions['transfer_queue']
+
+
+class TestTransferQueue():
+    """Unit tests for async transfers and TransactionStatus class."""
+
+    @staticmethod
+    def test_queued_transfer_is_applied(client, queue):
+        """Test a queued transfer is answered with 202 and applied by the writer."""
+        from banking_api.transfer_queue import drain
+
+        before = client.get("/account/1").json['SUCCESS']['balance']
+        response = client.post("/transactions", json={"account_id_from": 1,
+                                                      "account_id_to": 2,
+                                                      "amount": 2.5})
+        transaction_uuid = response.json['SUCCESS']['uuid']
+        queued = client.get(f"/transactions/{transaction_uuid}").json
+
+        assert 202 == response.status_code
+        assert 'queued' == queued['status']
+        assert before == client.get("/account/1").json['SUCCESS']['balance']
+
+        assert 1 == drain(queue)
+        committed = client.get(f"/transactions/{transaction_uuid}").json
+
+        assert ('committed', 2.5) == (committed['status'], committed['amount'])
+        assert 2.5 == round(
+            before - client.get("/account/1").json['SUCCESS']['balance'], 2)
+        assert 0 == queue.depth()
+
+        # queue times are UTC, as all stored times
+        from banking_api.model import utc_now
+        row = queue.get(transaction_uuid)
+        assert abs(utc_now() - row['enqueued_at']).total_seconds() < 60
+        assert row['enqueued_at'] <= row['done_at'] <= utc_now()
+
+    @staticmethod
+    def test_bad_account_refused(client, queue):
+        """Test transfers involving unknown accounts are not queued."""
+        response = client.post("/transactions", json={"account_id_from": 1,
+                                                      "account_id_to": 999999,
+                                                      "amount": 1})
+
+        assert 400 == response.status_code
+        assert 0 == queue.depth()
+
+    @staticmethod
+    def test_applied_once_after_crash(client, queue):
+        """Test a transfer committed before its queue row was updated is not repeated."""
+        from banking_api.model import Transaction
+        from banking_api.transfer_queue import drain
+        from banking_api.transfers import transfer_batch
+
+        before = client.get("/account/1").json['SUCCESS']['balance']
+        transaction_uuid = queue.put(1, 2, 100)
+        # the writer committed the transfer, then crashed
+        transfer_batch([(1, 2, 100)], uuids=[transaction_uuid])
+        drain(queue)
+
+        assert 'committed' == queue.get(transaction_uuid)['status']
+        assert 1 == Transaction.query.filter_by(uuid=transaction_uuid).count()
+        assert 1 == round(before - client.get("/account/1").json['SUCCESS']['balance'], 2)
+
+    @staticmethod
+    def test_writer_thread(app, client, queue):
+        """Test the writer thread applies transfers as they are queued."""
+        import time
+        from banking_api.transfer_queue import start_writer
+
+        writer = start_writer(app)
+        try:
+            uuids = [client.post("/transactions", json={
+                "account_id_from": 2, "account_id_to": 1, "amount": 1}
+            ).json['SUCCESS']['uuid'] for _ in range(5)]
+            deadline = time.monotonic() + 10
+            while queue.depth() and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            writer.stop()
+
+        statuses = [client.get(f"/transactions/{u}").json['status'] for u in uuids]
+        assert ['committed'] * 5 == statuses
+
+    @staticmethod
+    def test_unknown_transaction(client):
+        """Test status of an unknown uuid is not found."""
+        assert 404 == client.get("/transactions/no-such-uuid").status_code
+
+
+class TestMetrics():
+    """Unit tests for request and SQL instrumentation."""
+
+    @staticmethod
+    def test_metrics_endpoint(client):
+        """Test requests and their SQL statements are counted per route."""
+        client.get("/account/1")
+        text = client.get("/metrics").data.decode()
+
+        assert ('banking_http_requests_total{route="/account/<int:account_id>",'
+                'method="GET",status="200"}') in text
+        assert 'banking_http_request_sql_statements_count{route="/customers"}' in text
+        assert 'banking_sql_statements_total{route="/transactions"}' in text
+        assert '# TYPE banking_http_request_seconds histogram' in text
+
+    @staticmethod
+    def test_n_plus_one_detected():
+        """Test a statement repeated in one request is flagged, whatever its IN list."""
+        from banking_api.metrics import RequestStats
+
+        stats = RequestStats('/account/<int:account_id>')
+        for i in range(10):
+            stats.add('SELECT balance FROM account WHERE id = ?', 0.001)
+        stats.add('SELECT id FROM account WHERE id IN (?, ?)', 0.001)
+        stats.add('SELECT id FROM account WHERE id IN (?, ?, ?)', 0.001)
+
+        assert [('SELECT balance FROM account WHERE id = ?', 10)] == stats.repeated(10)
+        assert 2 == dict(stats.repeated(2))['SELECT id FROM account WHERE id IN (?)']
+        assert 12 == stats.count
+
+    @staticmethod
+    def test_profiler_writes_folded_stacks(tmp_path):
+        """Test sampled stacks are written per endpoint in folded format."""
+        import threading
+        import time
+        from banking_api.metrics import Profiler
+
+        def busy_wait():
+            deadline = time.monotonic() + 0.1
+            while time.monotonic() < deadline:
+                pass
+
+        profiler = Profiler(interval=0.001)
+        profiler.start(threading.get_ident(), 'routes.busy')
+        busy_wait()
+        _, stacks = profiler.stop(threading.get_ident())
+        profiler.dump(str(tmp_path), 'routes.busy')
+        lines = (tmp_path / 'routes.busy.folded').read_text().splitlines()
+
+        assert stacks
+        assert any(line.rsplit(' ', 1)[0].endswith(':busy_wait') for line in lines)
+        assert all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+
+
+class TestHomepage():
+    """Unit tests for homepage and health check."""
+
+    @staticmethod
+    def test_homepage_not_modified(client):
+        """Test homepage has an ETag and a matching request gets 304 without body."""
+        response = client.get("/")
+        etag = response.headers['ETag']
+
+        assert 200 == response.status_code
+        assert b'<h1>banking API</h1>' in response.data
+
+        response = client.get("/", headers={'If-None-Match': etag})
+        assert 304 == response.status_code
+        assert b'' == response.data
+
+    @staticmethod
+    def test_rendered_again_when_file_changes(tmp_path):
+        """Test markdown file is rendered once and again after it changes."""
+        import os
+        from banking_api.homepage import RenderedFile
+
+        path = tmp_path / 'README.md'
+        path.write_text('# first')
+        page = RenderedFile(str(path))
+        html, etag = page.get()
+
+        assert '<h1>first</h1>' == html
+        assert (html, etag) == page.get()
+
+        path.write_text('# second')
+        os.utime(path, ns=(0, 0))
+        html, new_etag = page.get()
+        assert '<h1>second</h1>' == html
+        assert etag != new_etag
+
+    @staticmethod
+    def test_healthz(client):
+        """Test health check answers when the database does."""
+        response = client.get("/healthz")
+
+        assert 200 == response.status_code
+        assert {'status': 'ok'} == json.loads(response.data)
+
+
+class TestSerializers():
+    """Unit tests for JSON encoding of responses."""
+
+    @staticmethod
+    def test_stdlib_fallback_same_json(monkeypatch):
+        """Test encoding without orjson gives the same compact JSON."""
+        from banking_api import serializers
+
+        data = {'transactions': [{'uuid': 'a', 'amount': 10.5, 'name': 'Zoë'}],
+                'next': None}
+        encoded = serializers.dumps(data)
+        monkeypatch.setattr(serializers, 'orjson', None)
+
+        assert encoded == serializers.dumps(data)
+        assert data == json.loads(encoded)
+
+    @staticmethod
+    def test_records_in_chunks(app):
+        """Test rows become dicts with amounts in units, encoded a chunk at a time."""
+        from banking_api.serializers import encode_chunks, records
+        from sqlalchemy import literal, select
+
+        query = select(literal('a').label('uuid'), literal(1050).label('amount'))
+        rows = list(records(db.session.execute(query), money=('amount',)))
+        chunks = list(encode_chunks([{'id': i} for i in range(5)], chunk_size=2))
+
+        assert [{'uuid': 'a', 'amount': 10.5}] == rows
+        assert 3 == len(chunks)
+        assert [{'id': i} for i in range(5)] == json.loads(b'[' + b''.join(chunks) + b']')
+
+
+@pytest.fixture
+def sharded(app, tmp_path):
+    """Create app keeping accounts in two shards, alternating by account id."""
+    from banking_api.sharding import upgrade_shards
+
+    config = tmp_path / 'sharded.py'
+    config.write_text(f"SQLALCHEMY_DATABASE_URI = 'sqlite:///{tmp_path}/main.db'\n"
+                      f"SHARD_URIS = ['sqlite:///{tmp_path}/0.db', "
+                      f"'sqlite:///{tmp_path}/1.db']\n"
+                      "SHARD_BLOCK_SIZE = 1\n"
+                      "SHARD_MAP_TTL = 0\n"
+                      "SQLALCHEMY_TRACK_MODIFICATIONS = False\n")
+    sharded = create_app(str(config))
+    # sessions are per thread, not per app
+    db.session.remove()
+    with sharded.app_context():
+        db.create_all()
+        upgrade_shards(sharded)
+        client = sharded.test_client()
+        client.post("/customers", json={"first_name": "Shard", "surname": "Owner",
+                                        "identification": "shard"})
+        for _ in range(3):
+            client.post("/accounts", json={"first_name": "Shard", "surname": "Owner",
+                                           "identification": "shard", "deposit": 100})
+        yield sharded
+        db.session.remove()
+    db.session.remove()
+
+
+class TestSharding():
+    """Unit tests for accounts partitioned across shards."""
+
+    @staticmethod
+    def balances(client):
+        """Return balances of the three accounts of the sharded fixture."""
+        return [client.get(f"/account/{i}").json['SUCCESS']['balance']
+                for i in (1, 2, 3)]
+
+    @staticmethod
+    def test_accounts_spread_over_shards(sharded):
+        """Test accounts are stored on the shard of their id and read from it."""
+        router = sharded.extensions['shard_router']
+
+        assert [0, 1, 0] == [router.shard_for(i) for i in (1, 2, 3)]
+        assert [1, 3] == sorted(router.sessions[0].execute(
+            db.select(Account.id)).scalars())
+        assert [100, 100, 100] == TestSharding.balances(sharded.test_client())
+
+    @staticmethod
+    def test_transfers_within_and_across_shards(sharded):
+        """Test both kinds of transfer update balances and both histories."""
+        client = sharded.test_client()
+        within = client.post("/transactions", json={
+            "account_id_from": 1, "account_id_to": 3, "amount": 10})
+        across = client.post("/transactions", json={
+            "account_id_from": 1, "account_id_to": 2, "amount": 5})
+        refused = client.post("/transactions", json={
+            "account_id_from": 1, "account_id_to": 4, "amount": 5})
+        uuid = across.json['SUCCESS']['uuid']
+
+        assert (201, 201, 400) == (within.status_code, across.status_code,
+                                   refused.status_code)
+        assert [85, 105, 110] == TestSharding.balances(client)
+        assert [uuid] == [t['uuid'] for t in
+                          client.get("/account/2/transactions").json['transactions']]
+        assert 2 == len(client.get("/account/1/transactions").json['transactions'])
+        assert 'committed' == client.get(f"/transactions/{uuid}").json['status']
+
+    @staticmethod
+    def test_recover_interrupted_transfers(sharded):
+        """Test prepared transfers commit if the coordinator did, abort otherwise."""
+        from datetime import timedelta
+        from banking_api.model import utc_now
+        from banking_api.sharding import _journal
+        from banking_api.transfers import new_transaction
+
+        router = sharded.extensions['shard_router']
+        committed = new_transaction(1, 2, 700)
+        aborted = new_transaction(1, 2, 900)
+        # both prepared by shard 1, only the first committed by shard 0
+        for transaction in (committed, aborted):
+            router.sessions[1].add(_journal(transaction, 'participant', 0, 'prepared'))
+        router.sessions[1].commit()
+        router.sessions[0].add(_journal(committed, 'coordinator', 1, 'committed'))
+        router.sessions[0].commit()
+
+        prepared = router.sessions[1].get(TransferJournal, committed['uuid'])
+        assert abs(utc_now() - prepared.created_at) < timedelta(minutes=1)
+        assert {'committed': 0, 'aborted': 0} == router.recover(age=60)
+        assert {'committed': 1, 'aborted': 1} == router.recover(age=0)
+        assert 'aborted' == router.sessions[0].get(TransferJournal, aborted['uuid']).state
+        assert [100, 107, 100] == TestSharding.balances(sharded.test_client())
+        assert {'committed': 0, 'aborted': 0} == router.recover(age=0)
+
+    @staticmethod
+    def test_move_range(sharded):
+        """Test a moved range is served by its new shard with its history."""
+        from banking_api.sharding import move_range
+
+        router = sharded.extensions['shard_router']
+        client = sharded.test_client()
+        client.post("/transactions", json={
+            "account_id_from": 1, "account_id_to": 2, "amount": 5})
+
+        assert 2 == move_range(router, 1, 3, 1, recovery_age=0)
+        assert [1, 1, 1] == [router.shard_for(i) for i in (1, 2, 3)]
+        assert [] == router.sessions[0].execute(db.select(Account.id)).all()
+        assert [95, 105, 100] == TestSharding.balances(client)
+        assert 1 == len(client.get("/account/1/transactions").json['transactions'])
+
+
+class TestSummary():
+    """Unit tests for AccountSummary and CustomerSummary classes."""
+
+    @staticmethod
+    def test_summaries_follow_transfers(client):
+        """Test totals of accounts and of their customer change with each transfer."""
+        client.post("/customers", json={"first_name": "Summary", "surname": "Owner",
+                                        "identification": "summ1"})
+        account_ids = [client.post("/accounts", json={
+            "first_name": "Summary", "surname": "Owner", "identification": "summ1",
+            "deposit": 50}).json['SUCCESS']['id'] for _ in range(2)]
+        customer_id = client.post("/accounts", json={
+            "first_name": "Summary", "surname": "Owner", "identification": "summ1",
+            "deposit": 0}).json['SUCCESS']['customer_id']
+        first, second = account_ids
+
+        client.post("/transactions", json={"account_id_from": first,
+                                           "account_id_to": second, "amount": 12.5})
+        client.post("/transactions/batch", json={"transactions": [
+            {"account_id_from": second, "account_id_to": first, "amount": 2},
+            {"account_id_from": second, "account_id_to": second, "amount": 1}]})
+        summary = client.get(f"/account/{second}/summary").json['SUCCESS']
+        customer = client.get(f"/customers/{customer_id}/summary").json['SUCCESS']
+
+        assert (60.5, 13.5, 3.0, 3) == (summary['balance'], summary['total_in'],
+                                        summary['total_out'], summary['transfer_count'])
+        assert summary['last_activity']
+        assert ([first, second] == [a['account_id'] for a in customer['accounts'][:2]])
+        # transfers between the customer's own accounts count on both sides
+        assert (100, 15.5, 15.5, 5) == (customer['balance'], customer['total_in'],
+                                        customer['total_out'], customer['transfer_count'])
+
+    @staticmethod
+    def test_backfill_matches_incremental(app, client):
+        """Test statistics rebuilt from history equal the ones kept per transfer."""
+        from banking_api.model import AccountStats
+        from banking_api.stats import backfill
+
+        client.post("/transactions", json={"account_id_from": 1,
+                                           "account_id_to": 2, "amount": 3})
+        ids = [r.account_id for r in AccountStats.query.all()]
+        kept = {i: client.get(f"/account/{i}/summary").json['SUCCESS'] for i in ids}
+        backfill(chunk_size=2)
+        rebuilt = {i: client.get(f"/account/{i}/summary").json['SUCCESS'] for i in ids}
+
+        assert kept == rebuilt
+
+    @staticmethod
+    def test_unknown_ids(client):
+        """Test summaries of unknown accounts and customers are not found."""
+        assert 404 == client.get("/account/999999/summary").status_code
+        assert 404 == client.get("/customers/999999/summary").status_code
+
+
+class TestAnalytics():
+    """Unit tests for analytics reports."""
+
+    @staticmethod
+    def test_reports_of_new_accounts(app, client):
+        """Test reports add up transfers read in chunks, a few accounts at a time."""
+        import pandas
+        from banking_api.analytics import analyze
+
+        def open_account(name, deposit):
+            client.post("/customers", json={"first_name": name, "surname": "Analytics",
+                                            "identification": name})
+            return client.post("/accounts", json={
+                "first_name": name, "surname": "Analytics", "identification": name,
+                "deposit": deposit}).json['SUCCESS']
+        first = open_account("Alpha", 100)
+        second = open_account("Alpha", 0)
+        other = open_account("Beta", 50)
+        for account_from, account_to, amount in [(first, other, 10), (other, second, 4),
+                                                 (first, second, 1), (first, first, 2)]:
+            client.post("/transactions", json={"account_id_from": account_from['id'],
+                                               "account_id_to": account_to['id'],
+                                               "amount": amount})
+        reports = {}
+        with db.engine.connect() as connection:
+            for report, frame in analyze(connection, chunk_size=2, rows_per_pass=4):
+                reports[report] = pandas.concat([reports.get(report), frame])
+
+        volume = reports['daily_volume'].loc[first['id']]
+        top = reports['top_counterparties'].loc[first['id']]
+        flows = reports['customer_flows'].loc[(first['customer_id'],
+                                               other['customer_id'])]
+        balances = reports['daily_balances'].loc[second['id']]
+
+        assert [200, 1300, 1, 3] == volume.sum().tolist()
+        assert [other['id'], second['id']] == top['counterparty_id'].tolist()
+        assert [1000, 100] == top['sent'].tolist()
+        assert [600, 1400, 2] == flows.tolist()
+        assert 500 == balances['balance'].iloc[-1]
+
+    @staticmethod
+    def test_export_files(app, tmp_path):
+        """Test reports are written as compressed CSV files with amounts in cents."""
+        import pandas
+        from banking_api.analytics import export
+
+        written = export(str(tmp_path), reports=['customer_flows', 'daily_balances'])
+        balances = pandas.read_csv(written['daily_balances'][0])
+
+        assert str(tmp_path / 'daily_balances.csv.gz') == written['daily_balances'][0]
+        assert ['account_id', 'day', 'net_cents', 'balance_cents'] == list(balances)
+        assert written['daily_balances'][1] == len(balances)
+
+
+@pytest.fixture
+def limits(app):
+    """Enforce transfer limits set by the test, for one test."""
+    from banking_api.limits import Limits
+
+    def set_limits(**rules):
+        app.extensions['transfer_limits'] = Limits(**rules)
+        return app.extensions['transfer_limits']
+
+    yield set_limits
+    app.extensions.pop('transfer_limits', None)
+
+
+def _new_account(client, identification, deposit):
+    """Return id of a new account of a new customer."""
+    customer = {"first_name": "Limit", "surname": "Holder",
+                "identification": identification}
+    client.post("/customers", json=customer)
+    return client.post("/accounts", json=dict(customer, deposit=deposit)
+                       ).json['SUCCESS']['id']
+
+
+class TestLimits():
+    """Unit tests for transfer limits."""
+
+    @staticmethod
+    def test_balance_floor(client, limits):
+        """Test transfers cannot take a balance below the floor, except to itself."""
+        limits(floor=0, max_amount=2000)
+        account_id = _new_account(client, 'limit1', 10)
+        payee_id = _new_account(client, 'limit1', 0)
+
+        def send(account_id_to, amount):
+            return client.post("/transactions", json={"account_id_from": account_id,
+                                                      "account_id_to": account_id_to,
+                                                      "amount": amount})
+
+        too_large = send(payee_id, 25)
+        overdraft = send(payee_id, 15)
+
+        assert ({'message': 'amount is above the limit of 20.0'}, 400) == (
+            too_large.json, too_large.status_code)
+        assert ({'message': 'balance cannot go below 0.0'}, 400) == (
+            overdraft.json, overdraft.status_code)
+        assert 201 == send(payee_id, 10).status_code
+        assert 201 == send(account_id, 5).status_code
+        assert 0 == client.get(f"/account/{account_id}").json['SUCCESS']['balance']
+
+    @staticmethod
+    def test_rolling_window(client, limits):
+        """Test count and amount per minute, over single and batch transfers."""
+        limits(windows=[('minute', 60, 3, 1000)])
+        account_id = _new_account(client, 'limit2', 100)
+        other_id = _new_account(client, 'limit2', 100)
+
+        first = client.post("/transactions", json={"account_id_from": account_id,
+                                                   "account_id_to": other_id,
+                                                   "amount": 6})
+        items = [{"account_id_from": account_id_from, "account_id_to": account_id_to,
+                  "amount": amount}
+                 for account_id_from, account_id_to, amount in [
+                     (account_id, other_id, 5), (account_id, other_id, 3),
+                     (other_id, account_id, 5), (account_id, other_id, 1)]]
+        batch = client.post("/transactions/batch", json={"atomic": False,
+                                                         "transactions": items})
+        last = client.post("/transactions", json={"account_id_from": account_id,
+                                                  "account_id_to": other_id,
+                                                  "amount": 1})
+        results = batch.json['SUCCESS']['results']
+
+        assert 201 == first.status_code
+        assert (['failed', 'processed', 'processed', 'processed']
+                == [r['status'] for r in results])
+        assert 'more than 10.0 transferred per minute' == results[0]['message']
+        assert {'message': 'more than 3 transfers per minute'} == last.json
+
+    @staticmethod
+    def test_windows_follow_ledger(client, limits):
+        """Test windows are seeded from and kept up to date with the ledger."""
+        from banking_api.limits import Limits
+
+        rule = [('minute', 60, 2, None)]
+        limits(windows=rule)
+        # the limits of another process, sharing the database
+        other = Limits(windows=rule)
+        account_id = _new_account(client, 'limit3', 100)
+        payee_id = _new_account(client, 'limit3', 0)
+
+        def send():
+            return client.post("/transactions", json={
+                "account_id_from": account_id, "account_id_to": payee_id, "amount": 1})
+
+        assert 201 == send().status_code
+        assert other.check(db.session, account_id, 100) is None
+        assert 201 == send().status_code
+        assert 'more than 2 transfers per minute' == other.check(db.session,
+                                                                 account_id, 100)
+        assert 400 == send().status_code
+        db.session.rollback()
+
+    @staticmethod
+    def test_window_buckets():
+        """Test payments leave a window bucket by bucket, in any arrival order."""
+        from banking_api.limits import Window
+
+        window = Window()
+        for bucket, amount in [(10, 5), (12, 3), (11, 2), (12, 1)]:
+            window.add(bucket, amount)
+        counted = (window.count, window.amount)
+        window.expire(12)
+
+        assert (4, 11) == counted
+        assert (2, 4) == (window.count, window.amount)
+        assert [[12, 2, 4]] == [list(b) for b in window.buckets]
+
+
+def _query_plan(query):
+    """Return the SQLite query plan of a query, one line per step."""
+    from datetime import datetime
+
+    with db.engine.connect() as connection:
+        compiled = query.compile(dialect=connection.dialect)
+        params = tuple(str(value) if isinstance(value, datetime) else value
+                       for value in (compiled.params[name]
+                                     for name in compiled.positiontup))
+        return [row[-1] for row in connection.exec_driver_sql(
+            f'EXPLAIN QUERY PLAN {compiled}', params)]
+
+
+class TestTimeRanges():
+    """Unit tests for UTC timestamps and time range filters of transactions."""
+
+    @staticmethod
+    def add_transactions(account_id, other_id):
+        """Insert transactions of an account at 10:00, 11:00 and 12:00 UTC."""
+        from datetime import datetime
+        from banking_api.model import Transaction
+
+        db.session.execute(Transaction.__table__.insert(), [
+            {'uuid': f'range-{account_id}-{hour}', 'account_id_from': account_id,
+             'account_id_to': other_id, 'amount': hour * 100,
+             'transaction_timestamp': datetime(1999, 12, 31, hour)}
+            for hour in (10, 11, 12)])
+        db.session.commit()
+
+    def test_account_history_range(self, client):
+        """Test from and to select a time range, with or without a UTC offset."""
+        account_id = _new_account(client, 'range1', 0)
+        other_id = _new_account(client, 'range1', 0)
+        self.add_transactions(account_id, other_id)
+        history = f"/account/{account_id}/transactions"
+
+        utc = client.get(f"{history}?from=1999-12-31T10:30:00&to=1999-12-31T12:00:00")
+        offset = client.get(f"{history}?from=1999-12-31T12:30:00%2B02:00"
+                            "&to=1999-12-31T12:00:00Z&limit=10")
+
+        assert (['1999-12-31 11:00:00.000000']
+                == [t['transaction_timestamp'] for t in utc.json['transactions']])
+        assert utc.json['transactions'] == offset.json['transactions']
+        assert 400 == client.get(f"{history}?from=noon").status_code
+
+    def test_all_transactions_range(self, client):
+        """Test all transactions of a time range are paged through in time order."""
+        account_id = _new_account(client, 'range2', 0)
+        self.add_transactions(account_id, 1)
+        query = "/transactions?from=1999-12-31T10:00:00&to=1999-12-31T11:00:01"
+
+        pages = [client.get(f"{query}&limit=1").json]
+        while pages[-1]['next']:
+            pages.append(client.get(f"{query}&limit=1&after={pages[-1]['next']}").json)
+        streamed = client.get(query, buffered=True).json['transactions']
+        uuids = [f'range-{account_id}-{hour}' for hour in (10, 11)]
+
+        assert uuids == [t['uuid'] for t in streamed
+                         if t['account_id_from'] == account_id]
+        assert streamed == [t for page in pages for t in page['transactions']]
+        assert 400 == client.get("/transactions?from=1999-12-31T10:00:00").status_code
+
+    def test_pages_ordered_by_datetime(self, client):
+        """Test pages are ordered by datetimes, formatted only in the response."""
+        from datetime import datetime
+        from banking_api.routes import _history_query, _merge_histories
+
+        account_id = _new_account(client, 'range3', 0)
+        self.add_transactions(account_id, 1)
+        rows = db.session.execute(_history_query(account_id)).fetchall()
+        assert [datetime(1999, 12, 31, hour) for hour in (10, 11, 12)] == [
+            row.transaction_timestamp for row in rows]
+
+        # records of shards and archive segments are merged by their datetimes
+        records = [[{'uuid': 'b', 'transaction_timestamp': datetime(2000, 1, 1, 10)}],
+                   [{'uuid': 'a', 'transaction_timestamp':
+                     datetime(2000, 1, 1, 9, 59, 59, 500000)}]]
+        assert ['a', 'b'] == [row['uuid'] for row in _merge_histories(records)]
+
+        page = client.get(f"/account/{account_id}/transactions?limit=1").json
+        after = client.get(f"/account/{account_id}/transactions?limit=1"
+                           f"&after={page['next']}").json
+        assert ['1999-12-31 10:00:00.000000', '1999-12-31 11:00:00.000000'] == [
+            p['transactions'][0]['transaction_timestamp'] for p in (page, after)]
+
+    @staticmethod
+    def test_query_plans(app):
+        """Test time ranges are read from timestamp indexes, not by scanning."""
+        from datetime import datetime
+        from banking_api.routes import _history_query, _range_query
+
+        start, end = datetime(1999, 12, 31), datetime(2000, 1, 1)
+        plans = [_query_plan(_range_query(start, end)),
+                 _query_plan(_range_query(start, end, (start, 'uuid'), 101)),
+                 _query_plan(_history_query(1, None, None, start, end)),
+                 _query_plan(_history_query(1, (start, 'uuid'), 101, start, end))]
+        searches = [[step for step in plan if step.startswith(('SEARCH', 'SCAN'))
+                     and ' transaction ' in f'{step} '] for plan in plans]
+
+        assert [['ix_transaction_timestamp']] * 2 == [
+            [step.split(' USING INDEX ')[1].split()[0] for step in steps]
+            for steps in searches[:2]]
+        assert [['ix_transaction_from_timestamp', 'ix_transaction_to_timestamp']] * 2 == [
+            [step.split(' USING INDEX ')[1].split()[0] for step in steps]
+            for steps in searches[2:]]
+        assert all('transaction_timestamp>?' in step and 'transaction_timestamp<?' in step
+                   for steps in searches for step in steps)
+
+
+def _events_config(tmp_path):
+    """Write config of an app with a database of its own, return its path."""
+    config = tmp_path / 'events.py'
+    config.write_text(f"SQLALCHEMY_DATABASE_URI = 'sqlite:///{tmp_path}/events.db'\n"
+                      "SQLALCHEMY_TRACK_MODIFICATIONS = False\n"
+                      "EVENTS_POLL_MS = 10\n")
+    return str(config)
+
+
+class TestEvents():
+    """Unit tests for Events and EventConsumers classes."""
+
+    @staticmethod
+    def test_delivered_once_in_order_across_restarts(app, tmp_path):
+        """Test a consumer storing its position gets each transfer once, in order."""
+        config = _events_config(tmp_path)
+        committed, handled = [], []
+
+        def consume(client, pages, store=True):
+            for _ in range(pages):
+                page = client.get("/events?consumer=audit&limit=3").json
+                if not page['events']:
+                    return
+                if store:
+                    handled.extend(event['uuid'] for event in page['events'])
+                    assert 200 == client.put("/events/consumers/audit",
+                                             json={"position": page['next']}).status_code
+
+        db.session.remove()
+        for run in range(2):
+            # a restart: a new app on the same database
+            restarted = create_app(config)
+            with restarted.app_context():
+                db.create_all()
+                client = restarted.test_client()
+                if run == 0:
+                    client.post("/customers", json={"first_name": "Event", "surname":
+                                                    "Owner", "identification": "ev"})
+                    for _ in range(2):
+                        client.post("/accounts", json={
+                            "first_name": "Event", "surname": "Owner",
+                            "identification": "ev", "deposit": 100})
+                for _ in range(4):
+                    committed.append(client.post("/transactions", json={
+                        "account_id_from": 1, "account_id_to": 2, "amount": 1}
+                    ).json['SUCCESS']['uuid'])
+                batch = client.post("/transactions/batch", json={"transactions": [
+                    {"account_id_from": 2, "account_id_to": 1, "amount": 1}] * 2})
+                committed.extend(r['uuid'] for r in batch.json['SUCCESS']['results'])
+
+                consume(client, 1)
+                # read, then stopped before storing its position
+                consume(client, 1, store=False)
+                if run == 1:
+                    consume(client, 10)
+                db.session.remove()
+
+        assert 12 == len(committed)
+        assert committed == handled
+
+    @staticmethod
+    def test_long_poll_returns_new_event(client):
+        """Test a waiting read returns as soon as a transfer is committed."""
+        import threading
+        import time
+        from banking_api.model import TransferEvent
+
+        last = db.session.query(db.func.max(TransferEvent.seq)).scalar() or 0
+        account_id = _new_account(client, 'events1', 10)
+        timer = threading.Timer(0.2, client.post, args=("/transactions",), kwargs={
+            "json": {"account_id_from": account_id, "account_id_to": 1, "amount": 1}})
+        timer.start()
+        begin = time.monotonic()
+        page = client.get(f"/events?after={last}&wait=10").json
+        timer.join()
+
+        assert time.monotonic() - begin < 5
+        assert [account_id] == [e['account_id_from'] for e in page['events']]
+        assert page['events'][0]['seq'] == page['next'] > last
+        assert [] == client.get(f"/events?after={page['next']}").json['events']
+        assert 400 == client.get("/events?wait=100").status_code
+        assert 400 == client.get("/events?after=-1").status_code
+
+    @staticmethod
+    def test_compaction_keeps_unhandled_events(client):
+        """Test compaction only deletes events every consumer handled."""
+        from banking_api.events import compact
+        from banking_api.model import TransferEvent
+
+        account_id = _new_account(client, 'events2', 10)
+        for _ in range(3):
+            client.post("/transactions", json={"account_id_from": account_id,
+                                               "account_id_to": 1, "amount": 1})
+        seqs = [seq for seq, in db.session.query(TransferEvent.seq)
+                .order_by(TransferEvent.seq)]
+        consumers = "/events/consumers/"
+
+        assert 200 == client.put(f"{consumers}slow", json={"position": seqs[-3]}
+                                 ).status_code
+        assert 400 == client.put(f"{consumers}slow", json={"position": seqs[-4]}
+                                 ).status_code
+        assert 400 == client.put(f"{consumers}slow", json={"position": seqs[-1] + 1}
+                                 ).status_code
+        assert 0 == compact(retention=3600)
+        compact(retention=0)
+        kept = [e['seq'] for e in client.get("/events").json['events']]
+
+        assert seqs[-2:] == kept
+        assert {'name': 'slow', 'position': seqs[-3]} == client.get(
+            f"{consumers}slow").json
+        assert 200 == client.delete(f"{consumers}slow").status_code
+        assert 404 == client.delete(f"{consumers}slow").status_code
+        compact(retention=0)
+        assert [seqs[-1]] == [e['seq'] for e in client.get("/events").json['events']]
+
+        client.post("/transactions", json={"account_id_from": account_id,
+                                           "account_id_to": 1, "amount": 1})
+        assert seqs[-1] + 1 == client.get("/events").json['next']
+
+    @staticmethod
+    def test_events_of_shards(sharded):
+        """Test a transfer has one event, on the shard of the paying account."""
+        client = sharded.test_client()
+        uuids = [client.post("/transactions", json={
+            "account_id_from": 1, "account_id_to": to, "amount": 1}
+        ).json['SUCCESS']['uuid'] for to in (3, 2)]
+
+        assert uuids == [e['uuid'] for e in client.get("/events?shard=0").json['events']]
+        assert [] == client.get("/events?shard=1").json['events']
+        assert 400 == client.get("/events?shard=2").status_code
+
+
+@pytest.fixture
+def replicated(app, tmp_path):
+    """Create app reading from a replica file, copied from its database on demand."""
+    from banking_api.replica import copy_database
+
+    config = tmp_path / 'replicated.py'
+    config.write_text(f"SQLALCHEMY_DATABASE_URI = 'sqlite:///{tmp_path}/primary.db'\n"
+                      f"READ_REPLICA_URI = 'sqlite:///{tmp_path}/replica.db'\n"
+                      "READ_AFTER_WRITE_SECONDS = 60\n"
+                      "READ_REPLICA_MAX_LAG = 3600\n"
+                      "READ_REPLICA_LAG_CHECK = 0\n"
+                      "SQLALCHEMY_TRACK_MODIFICATIONS = False\n")
+    replicated = create_app(str(config))
+    db.session.remove()
+    with replicated.app_context():
+        db.create_all()
+        client = replicated.test_client()
+        client.post("/customers", json={"first_name": "Read", "surname": "Only",
+                                        "identification": "ro"})
+        for _ in range(2):
+            client.post("/accounts", json={"first_name": "Read", "surname": "Only",
+                                           "identification": "ro", "deposit": 100})
+        replicated.sync = lambda: copy_database(f'{tmp_path}/primary.db',
+                                                f'{tmp_path}/replica.db')
+        replicated.sync()
+        yield replicated
+        db.session.remove()
+    db.session.remove()
+
+
+class TestReadReplica():
+    """Unit tests for reads routed to a read replica."""
+
+    @staticmethod
+    def test_reads_follow_writes_and_lag(replicated):
+        """Test a writer reads its own writes, others the replica until it lags."""
+        writer, reader = replicated.test_client(), replicated.test_client()
+        replica = replicated.extensions['read_replica']
+
+        assert 201 == writer.post("/transactions", json={
+            "account_id_from": 1, "account_id_to": 2, "amount": 10}).status_code
+        assert 90 == writer.get("/account/1").json['SUCCESS']['balance']
+        assert 100 == reader.get("/account/1").json['SUCCESS']['balance']
+        assert [] == reader.get("/account/1/transactions").json['transactions']
+        stats = reader.get("/replica/stats").json['read_replica']
+        assert (1, 1, 2) == (stats['lag_events'], stats['sticky'], stats['replica'])
+
+        replica.max_lag = 0
+        assert 90 == reader.get("/account/1").json['SUCCESS']['balance']
+        assert 1 == replica.stats()['lagging']
+
+        replicated.sync()
+        assert (0, 0) == replica.lag()
+        assert 90 == reader.get("/account/1").json['SUCCESS']['balance']
+        assert 1 == len(reader.get("/account/1/transactions").json['transactions'])
+        assert 'banking_replica_lag_events 0' in reader.get("/metrics").get_data(
+            as_text=True)
+
+    @staticmethod
+    def test_replica_is_read_only(replicated):
+        """Test nothing can be written through the replica engine."""
+        from sqlalchemy.exc import OperationalError
+
+        with pytest.raises(OperationalError, match='readonly'):
+            with replicated.extensions['read_replica'].engine.begin() as connection:
+                connection.execute(db.text('DELETE FROM account'))
+
+
+@pytest.fixture
+def indexed(app):
+    """Serve balances and account checks from a loaded account index, for one test."""
+    from banking_api.account_index import AccountIndex
+
+    index = app.extensions['account_index'] = AccountIndex(refresh=3600)
+    index.load(db.engine)
+    yield index
+    del app.extensions['account_index']
+
+
+class TestAccountIndex():
+    """Unit tests for the in-process account index."""
+
+    @staticmethod
+    def test_balances_follow_writes(client, indexed):
+        """Test balances come from the index once new accounts and transfers are in."""
+        account_id = _new_account(client, 'index1', 50)
+        payee_id = _new_account(client, 'index1', 0)
+
+        # created after loading, read from the database until the next catch up
+        assert 50 == client.get(f"/account/{account_id}").json['SUCCESS']['balance']
+        assert (0, 1) == (indexed.hits, indexed.misses)
+
+        assert 201 == client.post("/transactions", json={
+            "account_id_from": account_id, "account_id_to": payee_id,
+            "amount": 20}).status_code
+        assert 30 == client.get(f"/account/{account_id}").json['SUCCESS']['balance']
+        assert 20 == client.get(f"/account/{payee_id}").json['SUCCESS']['balance']
+        assert 1 == len(client.get(f"/account/{payee_id}/transactions"
+                                   ).json['transactions'])
+        assert 3 == indexed.hits
+        assert 0 == indexed.verify()['mismatches']
+
+    @staticmethod
+    def test_writes_of_other_processes(client, indexed):
+        """Test a write not made by the process is read after the refresh interval."""
+        from banking_api.transfers import transfer
+
+        account_id = _new_account(client, 'index2', 10)
+        indexed.catch_up()
+        transfer(account_id, 1, 400)
+        # as if another process had made the transfer
+        indexed._stale = False
+
+        assert 10 == client.get(f"/account/{account_id}").json['SUCCESS']['balance']
+        indexed._next_refresh = 0
+        assert 6 == client.get(f"/account/{account_id}").json['SUCCESS']['balance']
+
+    @staticmethod
+    def test_verify_reports_differences(client, indexed):
+        """Test verify finds a balance changed without a ledger entry."""
+        from sqlalchemy import update
+
+        account_id = _new_account(client, 'index3', 10)
+        indexed.catch_up()
+        for change in (1, -1):
+            db.session.execute(update(Account).where(Account.id == account_id)
+                               .values(balance=Account.balance + change))
+            db.session.commit()
+            report = client.get("/account-index/verify").json['account_index']
+            if change > 0:
+                assert 1 == report['mismatches']
+                assert [{'account_id': account_id, 'index': 10, 'database': 10.01}
+                        ] == report['different']
+        assert (0, 0) == (report['mismatches'], report['unknown'])
+        assert report['accounts'] == report['indexed']
+
+    @staticmethod
+    def test_unknown_accounts(client, indexed, queue):
+        """Test accounts missing from the index and the database are refused."""
+        assert 404 == client.get("/account/99999").status_code
+        assert 404 == client.get("/account/99999/transactions").status_code
+        assert 404 == client.get("/account/99999/balance").status_code
+        assert 400 == client.post("/transactions", json={
+            "account_id_from": 1, "account_id_to": 99999, "amount": 1}).status_code
+        assert 202 == client.post("/transactions", json={
+            "account_id_from": 1, "account_id_to": 2, "amount": 1}).status_code
+
+    @staticmethod
+    def test_reads_use_database_until_loaded(client, app):
+        """Test an index still loading leaves reads to the database."""
+        from banking_api.account_index import AccountIndex
+
+        app.extensions['account_index'] = AccountIndex()
+        try:
+            assert 200 == client.get("/account/1").status_code
+            assert 503 == client.get("/account-index/verify").status_code
+            assert 0 == client.get("/account-index/stats").json['account_index']['hits']
+        finally:
+            del app.extensions['account_index']
+
+    @staticmethod
+    def test_far_apart_ids(tmp_path):
+        """Test ids far apart are held sorted and new accounts keep the arrays bounded."""
+        from sqlalchemy import create_engine, insert
+        from banking_api.account_index import AccountIndex
+        from banking_api.model import LedgerEntry, utc_now
+
+        engine = create_engine(f'sqlite:///{tmp_path}/sparse.db')
+        db.metadata.create_all(engine, tables=[Account.__table__, LedgerEntry.__table__])
+
+        def add(accounts, entries):
+            with engine.begin() as connection:
+                if accounts:
+                    connection.execute(insert(Account.__table__), [
+                        {'id': a, 'balance': b, 'customer_id': 1} for a, b in accounts])
+                connection.execute(insert(LedgerEntry.__table__), [
+                    {'account_id': a, 'amount': b, 'transaction_uuid': u,
+                     'created_at': utc_now()} for a, b, u in entries])
+
+        add([(1, 100), (2, 200)], [(1, 100, None), (2, 200, None)])
+        dense = AccountIndex(refresh=3600)
+        dense.load(engine)
+        add([(9 * 10 ** 9, 300)], [(9 * 10 ** 9, 300, None)])
+        dense.catch_up()
+        assert (None, 3, 2) == (dense.ids, len(dense.balances), dense.accounts)
+        assert dense.balance(9 * 10 ** 9) is None
+
+        sparse = AccountIndex(refresh=3600)
+        sparse.load(engine)
+        assert [1, 2, 9 * 10 ** 9] == list(sparse.ids)
+        assert 48 == sparse.stats()['bytes']
+        assert 300 == sparse.balance(9 * 10 ** 9)
+        # above every id, or in between
+        add([(9 * 10 ** 9 + 1, 50), (3, 60)],
+            [(9 * 10 ** 9 + 1, 50, None), (3, 60, None), (2, -20, 'sparse1')])
+        with engine.begin() as connection:
+            connection.execute(db.text('UPDATE account SET balance = 180 WHERE id = 2'))
+        sparse.catch_up()
+        assert (50, None, 180) == (sparse.balance(9 * 10 ** 9 + 1), sparse.balance(3),
+                                   sparse.balance(2))
+        assert (1, 0, 4) == tuple(sparse.verify()[key] for key in (
+            'not_indexed', 'mismatches', 'indexed'))
+        assert (3, 1) == (sparse.hits, sparse.misses)
+
+    @staticmethod
+    def test_index_settings():
+        """Test the index is refused where ledger ids may not commit in order."""
+        from flask import Flask
+        from banking_api.account_index import init_account_index
+
+        for settings in ({'SQLALCHEMY_DATABASE_URI': 'postgresql://localhost/bank'},
+                         {'SQLALCHEMY_DATABASE_URI': 'sqlite:///index.db',
+                          'SHARD_URIS': ['sqlite:///0.db', 'sqlite:///1.db']}):
+            app = Flask(__name__)
+            app.config.update(settings, ACCOUNT_INDEX=True)
+            with pytest.raises(ValueError):
+                init_account_index(app)
+
+
+@pytest.fixture
+def archived(tmp_path):
+    """Create app with three accounts and a history going back to 2021, for one test."""
+    from datetime import datetime, timedelta
+    from banking_api import ledger, stats
+    from banking_api.model import Transaction
+
+    config = tmp_path / 'archived.py'
+    config.write_text(f"SQLALCHEMY_DATABASE_URI = 'sqlite:///{tmp_path}/archived.db'\n"
+                      f"ARCHIVE_DIR = '{tmp_path}/archive'\n"
+                      "SQLALCHEMY_TRACK_MODIFICATIONS = False\n")
+    archived = create_app(str(config))
+    db.session.remove()
+    with archived.app_context():
+        db.create_all()
+        client = archived.test_client()
+        client.post("/customers", json={"first_name": "Old", "surname": "Timer",
+                                        "identification": "old"})
+        for _ in range(3):
+            client.post("/accounts", json={"first_name": "Old", "surname": "Timer",
+                                           "identification": "old", "deposit": 1000})
+        db.session.execute(db.insert(Transaction.__table__), [
+            {'uuid': f'old-{i:03d}', 'account_id_from': i % 3 + 1,
+             'account_id_to': (i * 7) % 3 + 1, 'amount': 100 + i,
+             'transaction_timestamp': datetime(2021, 1, 1) + timedelta(days=2 * i)}
+            for i in range(60)])
+        db.session.commit()
+        for i in range(3):
+            client.post("/transactions", json={"account_id_from": 1,
+                                               "account_id_to": i + 1, "amount": 1})
+        ledger.backfill()
+        stats.backfill()
+        archived.directory = str(tmp_path / 'archive')
+        yield archived
+        db.session.remove()
+    db.session.remove()
+
+
+def _histories(client):
+    """Return streamed and paged histories of the accounts of the archived fixture."""
+    histories = []
+    for account_id in (1, 2, 3):
+        url = f"/account/{account_id}/transactions"
+        histories.append(client.get(url).json['transactions'])
+        ranged = url + "?from=2021-02-10&to=2021-03-20T08:00:00%2B02:00"
+        histories.append(client.get(ranged).json['transactions'])
+        pages, after = [], ''
+        while after is not None:
+            page = client.get(url + f"?limit=7&after={after}").json
+            pages.append(page['transactions'])
+            after = page['next']
+        histories.append(pages)
+    return histories
+
+
+class TestArchive():
+    """Unit tests for moving old transactions to archive segments."""
+
+    @staticmethod
+    def test_history_merges_archive(archived):
+        """Test histories, ranges and pages stay the same after archiving."""
+        from datetime import datetime
+        from banking_api import archive
+        from banking_api.model import Transaction
+
+        client = archived.test_client()
+        before = _histories(client)
+        summaries = [client.get(f"/account/{a}/summary").json for a in (1, 2, 3)]
+
+        # one segment of January and February each, March up to the 15th
+        assert (37, 3) == archive.move_transactions(archived.directory,
+                                                    datetime(2021, 3, 15),
+                                                    segment_rows=20, chunk_size=7)
+        assert 3 + 60 - 37 == db.session.query(Transaction).count()
+        assert before == _histories(client)
+
+        # found in the archive by uuid, as it is in the history
+        response = client.get("/transactions/old-004")
+        assert 200 == response.status_code
+        assert dict(before[3][1], status='committed', archived=True) == response.json
+        assert 404 == client.get("/transactions/old-999").status_code
+
+        from banking_api import stats
+        stats.backfill()
+        assert summaries == [client.get(f"/account/{a}/summary").json for a in (1, 2, 3)]
+        assert [] == archive.verify(archived.directory)
+
+    @staticmethod
+    def test_stopped_run_is_finished(archived, monkeypatch):
+        """Test a run stopped while deleting is finished, each transaction read once."""
+        from datetime import datetime
+        from banking_api import archive
+        from banking_api.model import ArchiveSegment, Transaction
+
+        client = archived.test_client()
+        before = _histories(client)
+
+        def stop(*args):
+            raise KeyboardInterrupt
+        monkeypatch.setattr(archive, '_delete', stop)
+        with pytest.raises(KeyboardInterrupt):
+            archive.move_transactions(archived.directory, datetime(2022, 1, 1))
+        assert 63 == db.session.query(Transaction).count()
+        assert before == _histories(client)
+        monkeypatch.undo()
+
+        # January is deleted first, then one segment per month
+        assert (44, 3) == archive.move_transactions(archived.directory,
+                                                    datetime(2022, 1, 1))
+        assert ['done'] * 4 == [s.state for s in ArchiveSegment.query.all()]
+        assert 3 == db.session.query(Transaction).count()
+        assert before == _histories(client)
+        assert [] == archive.verify(archived.directory)
+
+        segment = ArchiveSegment.query.first()
+        with open(f'{archived.directory}/{segment.path}', 'r+b') as damaged:
+            damaged.write(b'\0' * 20)
+        # the segment cannot be read, and its transfers are missing from the sums
+        assert 2 == len(archive.verify(archived.directory))
@@ -0,0 +1,12 @@
+"""Production entry point, serve with ``gunicorn -c gunicorn.conf.py wsgi:app``."""
+from banking_api import create_app
+from banking_api.account_index import start_loading
+from banking_api.transfer_queue import start_writer
+
+app = create_app('config.py')
+
+# applies queued transfers in async mode, one worker at a time holds the queue
+start_writer(app)
+
+# loads the account index of this worker, reads use the database meanwhile
+start_loading(app)